@@ -1 +1,3 @@
-for f in ./model_en2*/train.log; do ff=(${f//// }); cat $f | grep -m 1 -e 'Training finished' | sed "s/\(.*\)/${ff[1]} \1/"; done
+# models with 'Training finished' in train.log: model_en2xx [time] Training finished
+# only the new part of each train.log is read (../../scripts/model_status.py)
+../../scripts/model_status.py list --state converged --finished-line
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+# evaluates one decoder served by marian-server on all test sets of its target languages
+#
+# called by test_models_distributed.sh after marian-server is started:
+#   ./evaluate_decoder.py --port $PORT --server-pid $SERVER_PID \
+#       --model $MODEL --best-by $BEST_BY --decoder $decoder \
+#       --store $RESULT_DIR/results.sqlite ar bg
+# without a GPU, against an echo server:
+#   ./evaluate_decoder.py --stub --port 8090 --model model_en2bg --best-by translation bg
+#
+# Tagged source lines are deduplicated across test sets and looked up in the
+# translation cache of the checkpoint (--translation-cache), only the rest is
+# translated. Waits until the server accepts connections, then sends batches
+# over one websocket connection, keeping --in-flight batches queued in the
+# server, so it does not idle between test sets. Translations
+# of a finished test set are postprocessed and scored in a process pool
+# while the next batches are translated. Translations and results.tsv lines
+# are the same as the ones of the former shell loop; results go to the
+# results_store.py database (--store) and/or are appended to --results files.
+
+import argparse
+import asyncio
+import glob
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../scripts'))
+
+from eval_cache import EvalCache, reference_bleu
+from postprocess import postprocess
+from results_store import ResultsStore
+from translation_cache import TranslationCache, checkpoint_key
+
+
+def main():
+    args = parse_args()
+    asyncio.run(evaluate(args))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Test set evaluation through marian-server')
+    parser.add_argument('langs', nargs='+', help='Target languages of the model')
+    parser.add_argument('--port', '-p', type=int, required=True, help='marian-server port')
+    parser.add_argument('--model', '-m', type=str, required=True, help='Model folder')
+    parser.add_argument('--best-by', type=str, required=True, help='Validation metric of the checkpoint')
+    parser.add_argument(
+        '--decoder', '-d',
+        type=str,
+        default=None,
+        help='Decoder config of the served checkpoint, identifies it in the translation cache',
+    )
+    parser.add_argument(
+        '--results', '-r',
+        action='append',
+        default=[],
+        help='results.tsv file to append to, repeat for more files',
+    )
+    parser.add_argument(
+        '--store', '-s',
+        type=str,
+        default=os.environ.get('RESULTS_STORE'),
+        help='Database of results (results_store.py)',
+    )
+    parser.add_argument(
+        '--test-dir',
+        type=str,
+        default='data/raw/test',
+        help='Folder with en2xx/<corpus>/<version> test sets',
+    )
+    parser.add_argument(
+        '--server-pid',
+        type=int,
+        default=None,
+        help='Fail if this process ends before the server is ready',
+    )
+    parser.add_argument(
+        '--ready-timeout',
+        type=float,
+        default=600.,
+        help='Max. seconds to wait for the server',
+    )
+    parser.add_argument(
+        '--batch-size', '-b',
+        type=int,
+        default=512,
+        help='Lines per message (as client_example.py)',
+    )
+    parser.add_argument(
+        '--in-flight',
+        type=int,
+        default=4,
+        help='Batches sent to the server before their translations arrive',
+    )
+    parser.add_argument(
+        '--jobs', '-j',
+        type=int,
+        default=os.cpu_count(),
+        help='Worker processes for postprocessing and scoring',
+    )
+    parser.add_argument(
+        '--sacremoses',
+        action='store_true',
+        help='Postprocess with sacremoses instead of postprocess.sh',
+    )
+    parser.add_argument(
+        '--cache',
+        type=str,
+        default=os.environ.get('EVAL_CACHE'),
+        help='Cache of reference BLEU statistics (eval_cache.py)',
+    )
+    parser.add_argument(
+        '--translation-cache',
+        type=str,
+        default=os.environ.get('TRANSLATION_CACHE'),
+        help='Folder with translations of checkpoints (translation_cache.py), needs --decoder',
+    )
+    parser.add_argument(
+        '--stub',
+        action='store_true',
+        help='Run an echo server on the port instead of using marian-server (for testing)',
+    )
+
+    args = parser.parse_args()
+    if args.translation_cache and args.decoder is None:
+        parser.error('--translation-cache needs --decoder')
+    return args
+
+
+def test_sets(test_dir, lang):
+    """ data/raw/test/en2xx/<corpus>/<version> folders """
+    return sorted(
+        path for path in glob.glob(os.path.join(test_dir, f'en2{lang}', '*', '*'))
+        if os.path.isdir(path)
+    )
+
+
+def read_source(dataset):
+    lines = []
+    for path in sorted(glob.glob(os.path.join(dataset, '*.bpe.en'))):
+        with open(path, encoding='utf-8') as f:
+            lines.extend(line.rstrip('\n') for line in f)
+    return lines
+
+
+def translated_path(model, dataset):
+    """ model/translated_test/<en2xx/corpus/version>/translated.txt """
+    return os.path.join(model, 'translated_test', dataset.split('test/', 1)[-1], 'translated.txt')
+
+
+# runs in the worker processes
+
+def score_test_set(lang, translations, gold_pattern, output, script, cache_dir):
+    """ writes postprocessed translations, returns BLEU as printed by sacrebleu --score-only """
+    hypotheses = postprocess(translations, lang, script)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        f.writelines(line + '\n' for line in hypotheses)
+    gold = sorted(glob.glob(gold_pattern))[0]
+    with open(gold, encoding='utf-8') as f:
+        references = [line.rstrip('\n') for line in f]
+    cache = EvalCache(cache_dir) if cache_dir else None
+    bleu = reference_bleu(cache, references, lang)
+    return f'{bleu.corpus_score(hypotheses, None).score:.1f}'
+
+
+class TranslationClient:
+    """
+    One websocket connection to marian-server. The server answers messages
+    of a connection in order, so responses are matched to requests FIFO.
+    """
+    def __init__(self, uri, in_flight):
+        self.uri = uri
+        self.in_flight = asyncio.Semaphore(in_flight)
+        self.pending = deque()
+        self.connection = None
+        self.receiver = None
+
+    async def connect(self, timeout, server_pid=None):
+        """ retries until the server accepts the connection """
+        import websockets
+        start = time.time()
+        while True:
+            try:
+                self.connection = await websockets.connect(self.uri, max_size=None)
+                break
+            except (OSError, websockets.exceptions.WebSocketException):
+                # not listening yet or not answering the handshake yet
+                if server_pid is not None and not process_exists(server_pid):
+                    raise RuntimeError(f'marian-server ({server_pid}) has ended')
+                if time.time() - start > timeout:
+                    raise RuntimeError(f'{self.uri} is not ready after {timeout:.0f}s')
+                await asyncio.sleep(1)
+        print(f'server ready after {time.time() - start:.1f}s', flush=True)
+        self.receiver = asyncio.ensure_future(self._receive())
+
+    async def _receive(self):
+        try:
+            async for message in self.connection:
+                self.pending.popleft().set_result(message)
+                self.in_flight.release()
+        except Exception as e:
+            error = e
+        else:
+            error = ConnectionError('connection closed by the server')
+        while self.pending:
+            self.pending.popleft().set_exception(error)
+
+    async def translate_batch(self, lines):
+        """ sends the batch, returns a future of the translated lines """
+        await self.in_flight.acquire()
+        if self.receiver.done():
+            raise ConnectionError('connection closed by the server')
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(future)
+        await self.connection.send(''.join(line + '\n' for line in lines))
+        return future
+
+    async def close(self):
+        await self.connection.close()
+        await self.receiver
+
+
+def process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def split_translations(message, n_lines):
+    if message.endswith('\n'):
+        message = message[:-1]
+    translations = message.split('\n')
+    if len(translations) != n_lines:
+        raise RuntimeError(f'{n_lines} lines sent, {len(translations)} translated')
+    return translations
+
+
+async def evaluate(args):
+    loop = asyncio.get_running_loop()
+    script = None if args.sacremoses else './postprocess.sh'
+    start = time.time()
+
+    sources = [
+        (lang, dataset, read_source(dataset))
+        for lang in args.langs
+        for dataset in test_sets(args.test_dir, lang)
+    ]
+    # tagged sources repeat across test sets, each is translated once
+    unique = list(dict.fromkeys(line for _, _, source in sources for line in source))
+    cache = None
+    translations = {}
+    if args.translation_cache:
+        cache = TranslationCache(args.translation_cache, checkpoint_key(args.decoder))
+        translations = cache.get_many(unique)
+    todo = [line for line in unique if line not in translations]
+    print(
+        f'{sum(len(source) for _, _, source in sources)} lines, {len(unique)} unique, '
+        f'{len(unique) - len(todo)} cached, {len(todo)} to translate', flush=True,
+    )
+
+    batches = [todo[i:i + args.batch_size] for i in range(0, len(todo), args.batch_size)]
+    batches_done = [loop.create_future() for _ in batches]
+    batch_of_line = {line: n for n, batch in enumerate(batches) for line in batch}
+
+    stub = client = sender = None
+    if batches:
+        stub = await start_stub_server(args.port) if args.stub else None
+        client = TranslationClient(f'ws://localhost:{args.port}/translate', args.in_flight)
+        await client.connect(args.ready_timeout, args.server_pid)
+
+        async def receive(batch, future, done):
+            try:
+                translated = split_translations(await future, len(batch))
+            except Exception as e:
+                done.set_exception(e)
+                return
+            translations.update(zip(batch, translated))
+            if cache is not None:
+                cache.put_many(zip(batch, translated))
+            done.set_result(None)
+
+        async def send():
+            try:
+                for batch, done in zip(batches, batches_done):
+                    future = await client.translate_batch(batch)
+                    asyncio.ensure_future(receive(batch, future, done))
+            except Exception as e:
+                for done in batches_done:
+                    if not done.done():
+                        done.set_exception(e)
+                raise
+
+        sender = asyncio.ensure_future(send())
+
+    store = ResultsStore(args.store) if args.store else None
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+
+        async def score(lang, dataset, source):
+            needed = sorted({batch_of_line[line] for line in source if line in batch_of_line})
+            await asyncio.gather(*(batches_done[n] for n in needed))
+            return await loop.run_in_executor(
+                pool, score_test_set, lang, [translations[line] for line in source],
+                os.path.join(dataset, f'*en2{lang}.{lang}'),
+                translated_path(args.model, dataset), script, args.cache,
+            )
+
+        scored = [
+            (lang, dataset, asyncio.ensure_future(score(lang, dataset, source)))
+            for lang, dataset, source in sources
+        ]
+        for lang, dataset, result in scored:
+            bleu = await result
+            line = f'{args.model}\t{lang}\t{args.best_by}\t{dataset}\t{float(bleu):.2f}\n'
+            if store is not None:
+                store.put(args.model, lang, args.best_by, dataset, float(bleu))
+            for results in args.results:
+                with open(results, 'a', encoding='utf-8') as f:
+                    f.write(line)
+            print(line, end='', flush=True)
+
+    if sender is not None:
+        await sender
+        await client.close()
+    if stub is not None:
+        stub.close()
+        await stub.wait_closed()
+    if cache is not None:
+        cache.close()
+    if store is not None:
+        store.close()
+    print(f'{len(scored)} test sets in {time.time() - start:.1f}s')
+
+
+async def start_stub_server(port):
+    """ echoes the lines back, slowly, like a GPU would """
+    import websockets
+
+    async def translate(connection, *_):
+        async for message in connection:
+            await asyncio.sleep(0.001 * message.count('\n'))
+            await connection.send(message)
+
+    return await websockets.serve(translate, 'localhost', port, max_size=None)
+
+
+if __name__ == '__main__':
+    main()
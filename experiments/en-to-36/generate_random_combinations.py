@@ -3,8 +3,9 @@
 import argparse
 import random
 import itertools
+import math
 import sys
-from collections import defaultdict, deque
+from collections import deque
 
 
 def main():
@@ -83,23 +84,56 @@ def read_elements(args):
     return result
 
 
-def get_combinations(elements, comb_size, min_count):
-    counts = defaultdict(int)
-    N = len(elements)
-    combinations = list(itertools.combinations(elements, comb_size))
-    random.shuffle(combinations)
+def random_ranks(total):
+    """
+    Ranks 0..total-1 in random order, lazily: Fisher-Yates shuffle
+    that keeps only the swapped positions, memory grows with the drawn ranks
+    """
+    swapped = {}
+    for i in range(total):
+        j = random.randrange(i, total)
+        rank = swapped.get(j, j)
+        swapped[j] = swapped.pop(i, i)
+        yield rank
+
+
+def unrank_combination(elements, comb_size, rank):
+    """
+    rank-th combination of itertools.combinations(elements, comb_size),
+    in the combinatorial number system, without generating the others
+    """
     result = []
-    for combination in combinations:
-        if any([counts[lang] < min_count for lang in combination]):
-            result.append(combination)
-            for lang in combination:
-                counts[lang] += 1
+    start = 0
+    for position in range(comb_size, 0, -1):
+        for i in range(start, len(elements)):
+            # combinations starting with elements[i] at this position
+            count = math.comb(len(elements) - i - 1, position - 1)
+            if rank < count:
+                break
+            rank -= count
+        result.append(elements[i])
+        start = i + 1
+    return tuple(result)
 
-            if N is not None and len(counts) < N:
-                continue
 
-            if all(v >= min_count for v in counts.values()):
-                break
+def get_combinations(elements, comb_size, min_count):
+    """
+    Uniformly random combinations without replacement, each one adds an
+    element that is not yet min_count times present, until all are
+    """
+    counts = {element: 0 for element in elements}
+    missing = len(counts) if min_count > 0 else 0
+    result = []
+    for rank in random_ranks(math.comb(len(elements), comb_size)):
+        if not missing:
+            break
+        combination = unrank_combination(elements, comb_size, rank)
+        if any(counts[element] < min_count for element in combination):
+            result.append(combination)
+            for element in combination:
+                counts[element] += 1
+                if counts[element] == min_count:
+                    missing -= 1
     return result
 
 
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+# plans a set of combinations of target languages with the least estimated GPU time
+#
+# ./plan_combinations.py --sizes 3-5 --min_count 2 > tasks/planned_3_5.task
+# ./plan_combinations.py --sizes 2-4 --family tasks/cyrillic_group.txt --logs 'model_*/train.log'
+# ./plan_combinations.py --candidates tasks/random_g1_3_5.task --min_count 1
+#
+# The cost of a combination is estimated from the size of its training data
+# (sentences * average target subwords of each language, from
+# train_set_statistics.csv). With --logs, finished trainings are used to fit
+# GPU hours = a * words^b (hours are the summed Time of the training lines,
+# i.e. words/s of the log); without them hours = epochs * words / speed.
+# --overhead is added per combination (start, validation, testing).
+#
+# Each language must be in min_count planned combinations. Combinations
+# have one of --sizes and are either taken from --candidates (a .task/.txt
+# file) or built from --langs, within one --family when families are given.
+# The plan is a greedy weighted set multicover (cheapest estimated hours per
+# language still missing coverage), followed by removing combinations that
+# are not needed for the coverage, most expensive first.
+# The combinations are printed in the .task format, the estimate to stderr.
+
+import argparse
+import csv
+import glob
+import heapq
+import math
+import os
+import sys
+from statistics import median
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../scripts'))
+
+from generate_random_combinations import cs_range
+
+DEFAULT_STATISTICS = '../stats_en-to-36/train_set_statistics.csv'
+
+
+def main():
+    args = parse_args()
+    words = read_statistics(args.statistics)
+    langs = read_langs(args.langs) if args.langs else list(words)
+    unknown = [lang for lang in langs if lang not in words]
+    if unknown:
+        sys.exit(f'no statistics for {" ".join(unknown)} in {args.statistics}')
+
+    cost = CostModel(words, args.epochs, args.speed, args.overhead)
+    if args.logs:
+        cost.fit(training_history(sorted(glob.glob(args.logs)), words))
+
+    if args.candidates:
+        candidates = [
+            combination for combination in read_combinations(args.candidates)
+            if args.sizes is None or len(combination) in args.sizes
+        ]
+        plan = plan_from_candidates(candidates, cost, args.min_count)
+    else:
+        if args.sizes is None:
+            sys.exit('--sizes is needed without --candidates')
+        families = [
+            [lang for lang in langs if lang in set(family_langs(path))] for path in args.family
+        ] or [langs]
+        plan = plan_from_families(families, args.sizes, cost, args.min_count)
+
+    for combination in plan:
+        print(' '.join(combination))
+    print(
+        f'{len(plan)} combinations, {sum(cost(c) for c in plan):.1f} estimated GPU hours '
+        f'({cost.describe()})',
+        file=sys.stderr,
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Combinations covering each language with least GPU hours')
+    parser.add_argument(
+        '--sizes',
+        type=cs_range,
+        default=None,
+        help='Sizes of combinations. 2,4-6,8 is 2,4,5,6,8',
+    )
+    parser.add_argument(
+        '--min_count',
+        type=int,
+        default=1,
+        help='Each language is in min_count combinations (default 1)',
+    )
+    parser.add_argument(
+        '--langs',
+        type=str,
+        default=None,
+        help='File with languages, one per line; all languages of the statistics by default',
+    )
+    parser.add_argument(
+        '--family',
+        action='append',
+        default=[],
+        help='File with languages of a family (any .txt/.task); combinations stay within '
+             'one family, languages outside of families are not covered. Can be repeated.',
+    )
+    parser.add_argument(
+        '--candidates',
+        type=str,
+        default=None,
+        help='Choose only combinations of this .task/.txt file',
+    )
+    parser.add_argument(
+        '--statistics',
+        type=str,
+        default=DEFAULT_STATISTICS,
+        help='train_set_statistics.csv',
+    )
+    parser.add_argument(
+        '--logs',
+        type=str,
+        default=None,
+        help="Glob of train.log files of finished trainings, e.g. 'model_*/train.log'",
+    )
+    parser.add_argument(
+        '--epochs',
+        type=float,
+        default=10.,
+        help='Epochs until convergence, without --logs',
+    )
+    parser.add_argument(
+        '--speed',
+        type=float,
+        default=20000.,
+        help='Training words/s, without --logs',
+    )
+    parser.add_argument(
+        '--overhead',
+        type=float,
+        default=0.,
+        help='GPU hours added to each combination',
+    )
+
+    args = parser.parse_args()
+    return args
+
+
+def read_statistics(path):
+    """ lang -> target subwords of the training data """
+    words = {}
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            words[row['target_lang']] = int(row['sentences_count']) * float(row['avg_subwords_tgt'])
+    return words
+
+
+def read_langs(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def read_combinations(path):
+    combinations = []
+    with open(path) as f:
+        for line in f:
+            combination = tuple(line.split())
+            if combination and combination not in combinations:
+                combinations.append(combination)
+    return combinations
+
+
+def family_langs(path):
+    return list(dict.fromkeys(lang for combination in read_combinations(path) for lang in combination))
+
+
+def model_langs(model_dir):
+    """ .../model_en2arbg -> ['ar', 'bg'] """
+    targets = os.path.basename(os.path.normpath(model_dir)).split('en2', 1)[1]
+    return [targets[i:i + 2] for i in range(0, len(targets), 2)]
+
+
+def training_history(paths, words):
+    """ (training words, GPU hours, median words/s) of the finished trainings """
+    from bulk_log_parser import parse_logs
+    history = []
+    for path, result in zip(paths, parse_logs(paths)):
+        langs = model_langs(os.path.dirname(os.path.abspath(path)))
+        if not result.finished or any(lang not in words for lang in langs):
+            continue
+        times = [data['train/time'] for _, data in result.records if 'train/time' in data]
+        speeds = [data['train/speed'] for _, data in result.records if 'train/speed' in data]
+        if times:
+            history.append((sum(words[lang] for lang in langs), sum(times) / 3600, median(speeds)))
+    return history
+
+
+class CostModel:
+    """ estimated GPU hours of a combination """
+    def __init__(self, words, epochs, speed, overhead):
+        self.words = words
+        self.epochs = epochs
+        self.speed = speed
+        self.overhead = overhead
+        # hours = scale * words^exponent once fitted
+        self.scale = None
+        self.exponent = None
+        self.trainings = 0
+
+    def fit(self, history):
+        """ least squares line of log(hours) over log(words) """
+        points = [(math.log(w), math.log(h)) for w, h, _ in history if w > 0 and h > 0]
+        self.trainings = len(points)
+        if len(points) < 2:
+            if history:
+                self.speed = median(speed for _, _, speed in history)
+            return
+        mean_x = sum(x for x, _ in points) / len(points)
+        mean_y = sum(y for _, y in points) / len(points)
+        variance = sum((x - mean_x) ** 2 for x, _ in points)
+        if variance == 0:
+            return
+        self.exponent = sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+        self.scale = math.exp(mean_y - self.exponent * mean_x)
+
+    def words_of(self, combination):
+        return sum(self.words[lang] for lang in combination)
+
+    def hours(self, words):
+        if self.scale is not None:
+            return self.overhead + self.scale * words ** self.exponent
+        return self.overhead + self.epochs * words / self.speed / 3600
+
+    def __call__(self, combination):
+        return self.hours(self.words_of(combination))
+
+    def describe(self):
+        if self.scale is not None:
+            return f'hours = {self.scale:.3g} * words^{self.exponent:.3f} from {self.trainings} trainings'
+        return f'{self.epochs:g} epochs at {self.speed:.0f} words/s'
+
+
+def cheapest_subsets(langs, size, cost):
+    """
+    Subsets of langs of the size by increasing cost (best first search over
+    langs sorted by their words); the cost grows with the words of a subset
+    """
+    langs = sorted(langs, key=lambda lang: cost.words[lang])
+    if size > len(langs):
+        return
+    if size == 0:
+        yield ()
+        return
+    start = tuple(range(size))
+    heap = [(cost.words_of(langs[i] for i in start), start)]
+    seen = {start}
+    while heap:
+        _, indices = heapq.heappop(heap)
+        yield tuple(langs[i] for i in indices)
+        for position in range(size):
+            limit = indices[position + 1] if position + 1 < size else len(langs)
+            if indices[position] + 1 < limit:
+                following = indices[:position] + (indices[position] + 1,) + indices[position + 1:]
+                if following not in seen:
+                    seen.add(following)
+                    heapq.heappush(heap, (cost.words_of(langs[i] for i in following), following))
+
+
+def best_new_combination(family, missing, size, cost, planned):
+    """
+    Cheapest combination of the size not planned yet, made of languages
+    still missing coverage, filled up with the cheapest other languages
+    """
+    needed = [lang for lang in family if lang in missing]
+    others = [lang for lang in family if lang not in missing]
+    if len(needed) >= size:
+        subsets = cheapest_subsets(needed, size, cost)
+    else:
+        subsets = (
+            tuple(needed) + filling
+            for filling in cheapest_subsets(others, size - len(needed), cost)
+        )
+    for subset in subsets:
+        combination = tuple(lang for lang in family if lang in subset)
+        if combination not in planned:
+            return combination
+    return None
+
+
+def missing_coverage(langs, min_count):
+    return {lang: min_count for lang in langs} if min_count > 0 else {}
+
+
+def add_to_plan(plan, combination, missing):
+    plan.append(combination)
+    for lang in combination:
+        if lang in missing:
+            missing[lang] -= 1
+            if not missing[lang]:
+                del missing[lang]
+
+
+def plan_from_families(families, sizes, cost, min_count):
+    missing = missing_coverage({lang for family in families for lang in family}, min_count)
+    plan = []
+    planned = set()
+    while missing:
+        best = None
+        for family in families:
+            if not any(lang in missing for lang in family):
+                continue
+            for size in sizes:
+                combination = best_new_combination(family, missing, size, cost, planned)
+                if combination is None:
+                    continue
+                gain = sum(lang in missing for lang in combination)
+                ratio = cost(combination) / gain
+                if best is None or ratio < best[0]:
+                    best = (ratio, combination)
+        if best is None:
+            sys.exit(f'coverage of {" ".join(sorted(missing))} can not be reached with sizes {sizes}')
+        planned.add(best[1])
+        add_to_plan(plan, best[1], missing)
+    return remove_redundant(plan, cost, min_count)
+
+
+def plan_from_candidates(candidates, cost, min_count):
+    missing = missing_coverage({lang for combination in candidates for lang in combination}, min_count)
+    plan = []
+    remaining = list(candidates)
+    while missing:
+        best = None
+        for n, combination in enumerate(remaining):
+            gain = sum(lang in missing for lang in combination)
+            if gain:
+                ratio = cost(combination) / gain
+                if best is None or ratio < best[0]:
+                    best = (ratio, n)
+        if best is None:
+            sys.exit(f'coverage of {" ".join(sorted(missing))} can not be reached with the candidates')
+        add_to_plan(plan, remaining.pop(best[1]), missing)
+    return remove_redundant(plan, cost, min_count)
+
+
+def remove_redundant(plan, cost, min_count):
+    """ drops combinations, most expensive first, while the coverage holds """
+    counts = {}
+    for combination in plan:
+        for lang in combination:
+            counts[lang] = counts.get(lang, 0) + 1
+    kept = set(range(len(plan)))
+    for n in sorted(kept, key=lambda n: -cost(plan[n])):
+        if all(counts[lang] > min_count for lang in plan[n]):
+            kept.remove(n)
+            for lang in plan[n]:
+                counts[lang] -= 1
+    return [combination for n, combination in enumerate(plan) if n in kept]
+
+
+if __name__ == '__main__':
+    main()
@@ -15,6 +15,31 @@ fi
 
 echo $TARGET_LANGS_REGEX
 
+# times for ../../scripts/pipeline_trace.py
+[[ ! -z "$SUBMIT_TIME" ]] && echo "Job submitted: $SUBMIT_TIME"
+echo "Data preparation of en2${TARGET_LANGS_STR} started: $(date '+%Y-%m-%d %H:%M:%S')"
+trap "echo \"Data preparation of en2${TARGET_LANGS_STR} finished: \$(date '+%Y-%m-%d %H:%M:%S')\"" EXIT
+
+# Fast path: concatenate per-language shards (see `make shards` in data folder)
+SHARDS=data/processed/shards
+if [ -e $SHARDS/manifest.json ] && [ ! -z "$SAMPLE_ARGS" ]
+then
+    # fixed-size corpus, e.g. SAMPLE_ARGS="--temperature 5 --max-lines 20000000";
+    # corpora are cached by their languages only, use one SAMPLE_ARGS per data/interim
+    ../../scripts/sample_corpus.py --shards $SHARDS $SAMPLE_ARGS \
+        --output data/interim/en2${TARGET_LANGS_STR} ${TARGET_LANGS[@]} \
+        && exit 0
+    echo Sampling from shards failed
+    exit 1
+fi
+if [ -e $SHARDS/manifest.json ]
+then
+    ../../scripts/shard_corpus.py build --shards $SHARDS \
+        --output data/interim/en2${TARGET_LANGS_STR} ${TARGET_LANGS[@]} \
+        && exit 0
+    echo Building from shards failed, falling back to grep
+fi
+
 # Training set
 paste data/processed/train.src data/processed/train.tgt \
     | grep -e $TARGET_LANGS_REGEX \
@@ -27,5 +27,7 @@ qsub -b y -cwd -m n -N aj_${1/\//_} \
         -v LOW_PRIORITY="$LOW_PRIORITY" \
 	-v MARIAN=$MARIAN \
 	-v EXPERIMENT_SET=$EXPERIMENT_SET \
+	-v LOG_WATCHER=$LOG_WATCHER \
+	-v SAMPLE_ARGS="$SAMPLE_ARGS" \
         -tc $CONC_TASKS \
         ./run-experiment.sh "$@"
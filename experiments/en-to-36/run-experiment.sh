@@ -75,14 +75,34 @@ then
 fi
 
 
-if [ ! -e ./data/interim/${SOURCE_LANG}2${TARGET_LANGS_STR}.train.target ]
+# corpora in data/interim are shared by the trainings (../../scripts/corpus_cache.py):
+# the task is a user of its corpus until it ends, unused ones are evicted over the budget
+CORPUS_CACHE_SCRIPT=../../scripts/corpus_cache.py
+CORPUS=${SOURCE_LANG}2${TARGET_LANGS_STR}
+if [ ! -z "$SGE_TASK_ID" ]
+then
+    $CORPUS_CACHE_SCRIPT acquire ${CORPUS} --pid $$
+    trap_add "echo releasing data; $CORPUS_CACHE_SCRIPT release ${CORPUS} --pid $$" EXIT
+fi
+
+if ! $CORPUS_CACHE_SCRIPT ready ${CORPUS} \
+    && [ -e ./data/processed/shards/manifest.json ]
+then
+    # shards are just concatenated - no need for a separate cpu job
+    $CORPUS_CACHE_SCRIPT build ${CORPUS} -- ./prepare_data.sh ${lang_arr[@]}
+fi
+
+if ! $CORPUS_CACHE_SCRIPT ready ${CORPUS}
 then
     mkdir -p run_logs
+    # tasks of the same combination wait for one builder
     prep_jid=$( qsub -b y -cwd -m n -N pr_${SOURCE_LANG}2${TARGET_LANGS_STR} \
         -j y -q cpu* -l mem_free=20G,act_mem_free=20G,h_vmem=30G \
         -o 'run_logs/$JOB_NAME.o$JOB_ID' \
         -terse \
-        ./prepare_data.sh ${lang_arr[@]} )
+        -v SAMPLE_ARGS="$SAMPLE_ARGS" \
+        -v SUBMIT_TIME="$(date '+%Y-%m-%d %H:%M:%S')" \
+        $CORPUS_CACHE_SCRIPT build ${CORPUS} -- ./prepare_data.sh ${lang_arr[@]} )
     echo Preparing data. 
     echo $prep_jid is the ID
 fi
@@ -93,9 +113,6 @@ echo $WAIT_FOR_PREP
 
 echo ${TARGET_LANGS[@]}
 
-# corpus creation is quite fast - so let's not occupy all the space
-[[ ! -z "$SGE_TASK_ID" ]] && trap_add "echo cleaning data; rm -f ./data/interim/${SOURCE_LANG}2${TARGET_LANGS_STR}.*.*" EXIT
-
 # if it is an array job - wait for a resp. gpu job
 [[ ! -z "$SGE_TASK_ID" ]] && SYNC_JOB="-sync y"
 
@@ -123,6 +140,9 @@ qsub -N "${SOURCE_LANG}2${TARGET_LANGS_STR}" -m n -j y -b y -cwd -q gpu* \
     -v  SOURCE_LANG=$SOURCE_LANG \
     -v MARIAN=$MARIAN \
     -v EXPERIMENT_SET=$EXPERIMENT_SET \
+    -v LOG_WATCHER=$LOG_WATCHER \
+    -v SAMPLE_ARGS="$SAMPLE_ARGS" \
+    -v SUBMIT_TIME="$(date '+%Y-%m-%d %H:%M:%S')" \
     $WAIT_FOR_PREP \
     $PRIORITY \
     $SYNC_JOB \
@@ -1,5 +1,7 @@
 #!/bin/bash -v
 
+source ./utils.sh
+
 # https://stackoverflow.com/a/17841619
 function join_by { local IFS="$1"; shift; echo "$*"; }
 function wandb_runner {
@@ -15,9 +17,13 @@ function wandb_runner {
     echo $RUNNER_PID WandD pid
     echo $TAGS
     sleep 15
-    trap "echo stopping W&B runner; kill $RUNNER_PID" EXIT
+    trap_add "echo stopping W&B runner; kill $RUNNER_PID" EXIT
 }
 
+# times for ../../scripts/pipeline_trace.py
+[[ ! -z "$SUBMIT_TIME" ]] && echo "Job submitted: $SUBMIT_TIME"
+echo "Job started: $(date '+%Y-%m-%d %H:%M:%S')"
+
 echo CUDA_HOME:${CUDA_HOME}
 nvcc --version
 
@@ -65,7 +71,8 @@ MODEL_NAME=${SOURCE_LANG}2${TARGET_LANGS_STR}
 MODEL=model_${MODEL_NAME}
 mkdir -p $MODEL
 
-wandb_runner $MODEL
+# with LOG_WATCHER set, logs are sent by one scripts/log_watcher.py process per node
+[[ -z "$LOG_WATCHER" ]] && wandb_runner $MODEL
 # WARNING! here's a hack to make validation script know about target languages
 # another part is in script itself
 cp ./validate.sh ${MODEL}/validate.sh
@@ -80,6 +87,13 @@ TRAIN_TARGET=$MODEL/train.target
 VAL_SOURCE=$MODEL/val.source
 VAL_TARGET=$MODEL/val.target
 
+# the corpus is kept while training, built again if it was evicted while waiting;
+# released on any exit, killed jobs included (signals exit through the EXIT trap)
+CORPUS_CACHE_SCRIPT=../../scripts/corpus_cache.py
+trap_add "echo releasing data; $CORPUS_CACHE_SCRIPT release ${MODEL_NAME} --pid $$" EXIT
+trap "exit 1" SIGINT SIGTERM
+$CORPUS_CACHE_SCRIPT acquire ${MODEL_NAME} --pid $$ --build ./prepare_data.sh ${TARGET_LANGS[@]} || exit 1
+
 # train model
 $MARIAN/build/marian \
     -c config.yml \
@@ -89,3 +103,5 @@ $MARIAN/build/marian \
     --valid-sets ${VAL_SOURCE} ${VAL_TARGET} \
 	--valid-script-path ${MODEL}/validate.sh \
     --log $MODEL/train.log --valid-log $MODEL/valid.log --tempdir $MODEL
+
+echo "Job finished: $(date '+%Y-%m-%d %H:%M:%S')"
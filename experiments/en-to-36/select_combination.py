@@ -1,47 +1,79 @@
 #!/usr/bin/env python3
-# ./select_combination.py N file_with_elements.txt 2-5,11
+# ./select_combination.py N file_with_elements.txt 2-5,11 [seed]
 # from `file_with_elements.txt` which is \n separated list of elements
 # select N-th combination and print to stdout
+#
+# The combinations of all sizes are indexed 0..total-1 (by size, then in
+# itertools.combinations order). N is mapped to an index by a seeded
+# permutation of the index space (Feistel network with cycle walking), and
+# the index is unranked to the combination. Tasks 0..total-1 get distinct
+# combinations, the next total tasks a differently shuffled cycle of them.
+# Nothing is enumerated, so each SGE task needs microseconds and no memory.
 
+import hashlib
+import math
+import os
 import sys
-import itertools
-import random
-
-random.seed(1)
-
-N = int(sys.argv[1])
-data = sys.argv[2]
-sizes = sys.argv[3]
-
-# read languages
-langs = []
-with open(data) as f:
-    for line in f:
-        langs.append(line.strip())
-
-# unfold combinations
-combinations = []
-for number in  sizes.split(','):
-    if number.find('-') == -1:
-        combinations.append(int(number))
-    else:
-        _from, _to = number.split('-')
-        for comb in range(int(_from), int(_to)+1):
-            combinations.append(comb)
-
-# combinations generator
-def combinations_generator(combinations, elements):
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from generate_random_combinations import unrank_combination
+
+FEISTEL_ROUNDS = 4
+
+
+def permute(index, total, key):
+    """ bijection of 0..total-1 given by key """
+    half_bits = ((total - 1).bit_length() + 1) // 2
+    mask = (1 << half_bits) - 1
     while True:
-        batch = []
-        for c in combinations:
-            batch.extend(itertools.combinations(elements, c))
+        left, right = index >> half_bits, index & mask
+        for round_ in range(FEISTEL_ROUNDS):
+            digest = hashlib.blake2b(f'{key} {round_} {right}'.encode(), digest_size=8).digest()
+            left, right = right, left ^ (int.from_bytes(digest, 'little') & mask)
+        index = (left << half_bits) | right
+        # the permutation is over 2**(2*half_bits) >= total values,
+        # walking the cycle until the index is in range keeps it a bijection
+        if index < total:
+            return index
+
+
+def select(N, elements, sizes, seed=1):
+    counts = [math.comb(len(elements), size) for size in sizes]
+    total = sum(counts)
+    cycle, index = divmod(N, total)
+    index = permute(index, total, f'{seed} {cycle}')
+    for size, count in zip(sizes, counts):
+        if index < count:
+            return unrank_combination(elements, size, index)
+        index -= count
+
+
+def main():
+    N = int(sys.argv[1])
+    data = sys.argv[2]
+    sizes = sys.argv[3]
+    seed = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+
+    # read languages
+    langs = []
+    with open(data) as f:
+        for line in f:
+            langs.append(line.strip())
 
-        random.shuffle(batch)
+    # unfold combinations
+    combinations = []
+    for number in sizes.split(','):
+        if number.find('-') == -1:
+            combinations.append(int(number))
+        else:
+            _from, _to = number.split('-')
+            for comb in range(int(_from), int(_to)+1):
+                combinations.append(comb)
+    combinations = sorted(set(combinations))
 
-        for combination in batch:
-            yield ' '.join([str(x) for x in combination])
+    print(' '.join(str(x) for x in select(N, langs, combinations, seed)))
 
-# select N-th
-gen = combinations_generator(combinations, langs)
-print(next(itertools.islice(gen, N, None)))
 
+if __name__ == '__main__':
+    main()
@@ -34,5 +34,7 @@ qsub -N aj_test_models -m n -j y -b y -cwd -q gpu-*.q \
     -o 'test_logs/$JOB_NAME.$JOB_ID.$TASK_ID' \
     -v RESULT_DIR="${RESULT_DIR}" \
     -v MODELS_LIST="${MODELS}" \
+    -v EVAL_CACHE="${EVAL_CACHE}" \
+    -v TRANSLATION_CACHE="${TRANSLATION_CACHE}" \
     -tc $CONC_TASKS \
     ./test_models_distributed.sh
@@ -4,8 +4,17 @@
 # 2. run server with this model
 # 3. iterate over langs
 # 4. evaluate for each dataset for selected lang
-# 5. write to  RESULT_DIR/results.tsv each result
-# 6. add model to RESULT_DIR/evaluated_models
+# 5. write each result to RESULT_DIR/results.sqlite (../../scripts/results_store.py)
+# 6. add model to the evaluated models of RESULT_DIR/results.sqlite
+# 7. export RESULT_DIR/results.tsv and RESULT_DIR/evaluated_models from it
+#
+# results.tsv and evaluated_models are no longer appended to by the tasks,
+# they are rewritten from the store after each model. Results of older runs
+# are loaded into the store once before the first run:
+#   ../../scripts/results_store.py import -s test_results/results.sqlite test_results/results.tsv
+#   while read model; do
+#       ../../scripts/results_store.py evaluated -s test_results/results.sqlite --add $model
+#   done < test_results/evaluated_models
 
 
 # 1. find out what model to evaluate; which languages
@@ -13,6 +22,7 @@ MODEL=$(sed "${SGE_TASK_ID}q;d" ${MODELS_LIST})
 langs=($(echo $MODEL | sed 's/model_en2\(.*\)/\1/g' | sed 's/\(..\)/\1 /g'))
 [[ -z "$RESULT_DIR" ]] && RESULT_DIR=test_results
 LOGDIR="$RESULT_DIR/logs"
+RESULTS_STORE="$RESULT_DIR/results.sqlite"
 mkdir -p $LOGDIR
 # different ports - tasks may be on the same cluster
 PORT=$(("$SGE_TASK_ID" + 8080))
@@ -31,36 +41,26 @@ do
         --mini-batch 64 --maxi-batch 50 --maxi-batch-sort src -w 9000 \
         &>$LOGDIR/${decoder//\//_}.log &
     SERVER_PID=$!
-    sleep 15
     trap "echo stopping marian server; kill $SERVER_PID" EXIT
     echo $SERVER_PID server pid
     echo $PORT port
     ps -p $SERVER_PID -o comm=
     BEST_BY=$(echo $decoder | cut -d '.' -f 3 | cut -d'-' -f 2- )
-# 3. iterate over langs
-    for TARGET_LANG in ${langs[@]}
-    do
-# 4. evaluate for each dataset for selected lang
-        for dataset in $(find data/raw/test/en2${TARGET_LANG} -maxdepth 2 -mindepth 2 -type d)
-        do
-            DATASET_NAME=$(echo $dataset | cut -d'/' -f 5-) 
-            # translate test set
-            TRANSLATED="${MODEL}/translated_test/${dataset##*test/}/translated.txt"
-            mkdir -p ${TRANSLATED%%/translated.txt}
-            cat $dataset/*.bpe.en | $MARIAN/scripts/server/client_example.py -p $PORT   \
-                         | tgt=$TARGET_LANG ./postprocess.sh \
-                         > $TRANSLATED
-            #get bleu
-            BLEU=$( cat $TRANSLATED | ./sacreBLEU/sacrebleu.py --score-only $dataset/*en2$TARGET_LANG.$TARGET_LANG )
-# 5. write to  RESULT_DIR/results.tsv each result
-            printf "%s\t%s\t%s\t%s\t%.2f\n" $MODEL $TARGET_LANG $BEST_BY $dataset $BLEU >> ${RESULT_DIR}/results.tsv
-            printf "%s\t%s\t%s\t%s\t%.2f\n" $MODEL $TARGET_LANG $BEST_BY $dataset $BLEU >> ${MODEL}/results.tsv
-            printf "%s\t%s\t%s\t%s\t%.2f\n" $MODEL $TARGET_LANG $BEST_BY $dataset $BLEU 
-        done
-    done
+# 3.-5. evaluate all datasets of all langs, write to RESULT_DIR/results.sqlite
+    # waits until the server is ready, keeps it busy while translations are scored
+    ./evaluate_decoder.py --port $PORT --server-pid $SERVER_PID \
+        --model $MODEL --best-by $BEST_BY --decoder $decoder \
+        --store ${RESULTS_STORE} \
+        ${langs[@]}
     
-# 6. add model to RESULT_DIR/evaluated_models
-    echo $MODEL >> ${RESULT_DIR}/evaluated_models
+# 6. add model to the evaluated models
+    ../../scripts/results_store.py evaluated -s ${RESULTS_STORE} --add $MODEL
     # kill marian server with the decoder
     kill $SERVER_PID
 done
+
+# results of the model in the results.tsv layout
+../../scripts/results_store.py export -s ${RESULTS_STORE} --model $MODEL -o ${MODEL}/results.tsv
+# 7. shared files of all models, replaced at once
+../../scripts/results_store.py export -s ${RESULTS_STORE} -o ${RESULT_DIR}/results.tsv
+../../scripts/results_store.py evaluated -s ${RESULTS_STORE} -o ${RESULT_DIR}/evaluated_models
@@ -37,11 +37,9 @@ function model_converged {
     local SRC=$1
     local TGTS=$2
 
-    if [ -e ./model_${SRC}2${TGTS}/train.log ]
-    then
-        local CONVERGED=$(cat ./model_${SOURCE_LANG}2${TARGET_LANGS_STR}/train.log | grep 'Training finished' | wc -l)
-        [[ "${CONVERGED}" !=  "0" ]] && echo "Model ${SOURCE_LANG}2${TARGET_LANGS_STR} has already converged"
-    fi
+    # reads only the new part of train.log (../../scripts/model_status.py)
+    local STATE=$(../../scripts/model_status.py state model_${SRC}2${TGTS})
+    [[ "${STATE}" == "converged" ]] && echo "Model ${SRC}2${TGTS} has already converged"
 }
 
 # trap_add from https://stackoverflow.com/a/7287873`
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# marian validation script: BLEU of each target language of the dev set
+#
+# called by model_*/validate.sh (marian --valid-script-path) in the model folder:
+#   ../validate.py <translations of val.source>
+# writes one '[valid] ... lang/bleu-xx' line per language into valid.log and
+# train.log, prints the geometric mean of the scores for marian
+#
+# Translations are split by the <2xx> tag of val.source in one pass, all
+# languages are postprocessed and scored at once in a process pool.
+# Postprocessing is ../postprocess.sh (moses perl scripts) as before, so the
+# scores do not change during a training; --sacremoses does the same steps
+# (remove @@, detruecase, detokenize) in the workers, the scores may differ
+# slightly from the perl ones. Postprocessed references and their BLEU
+# statistics are kept in the eval_cache.py cache (../cache by default).
+# Without sacremoses installed postprocess.sh is used, without sacrebleu the
+# lines are scored by ../sacreBLEU/sacrebleu.py --score-only as validate.sh did.
+
+import argparse
+import importlib.util
+import math
+import os
+import re
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../scripts'))
+
+from eval_cache import EvalCache, postprocessed_references, reference_bleu
+from postprocess import postprocess, postprocess_version
+
+POSTPROCESS_SCRIPT = '../postprocess.sh'
+SACREBLEU_SCRIPT = '../sacreBLEU/sacrebleu.py'
+# bytes read from the end of train.log at once when looking for the last training line
+TAIL_BLOCK_SIZE = 64 * 1024
+EPOCH = re.compile(r' Ep\. (\d+) :')
+UPDATE = re.compile(r' Up\. (\d+) :')
+
+
+def main():
+    args = parse_args()
+    langs = model_langs(os.getcwd())
+    epoch, update = last_epoch_and_update('train.log')
+    hypotheses, references = split_by_tag(
+        'val.source', os.path.basename(args.translations), 'val.target', langs,
+    )
+
+    script = POSTPROCESS_SCRIPT
+    if args.sacremoses:
+        if is_installed('sacremoses'):
+            script = None
+        else:
+            print(f'sacremoses not installed, postprocessing with {POSTPROCESS_SCRIPT}', file=sys.stderr)
+    scorer = score if is_installed('sacrebleu') else score_by_script
+    jobs = args.jobs or min(len(langs), os.cpu_count())
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [
+            pool.submit(
+                scorer, lang, hypotheses[lang], references[lang], script, args.cache,
+            )
+            for lang in langs
+        ]
+        results = [future.result() for future in futures]
+
+    with open('valid.log', 'a', encoding='utf-8') as valid_log, \
+         open('train.log', 'a', encoding='utf-8') as train_log:
+        for lang, result in zip(langs, results):
+            current_output = (
+                datetime.now().strftime('[%Y-%m-%d %H:%M:%S]')
+                + f' [valid] Ep. {epoch} : Up. {update} :'
+                + f' lang/bleu-{lang} : {result} :'
+                + ' no effect on early stopping'
+            )
+            valid_log.write(current_output + '\n')
+            train_log.write(current_output + '\n')
+
+    # geom. avg. of the printed scores, as validate.sh computed it
+    scores = [float(result) for result in results]
+    print(math.pow(math.prod(scores), 1. / len(scores)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Per-language BLEU on the dev set for marian')
+    parser.add_argument('translations', help='Translations of val.source')
+    parser.add_argument(
+        '--jobs', '-j',
+        type=int,
+        default=None,
+        help='Number of worker processes, one per language by default',
+    )
+    parser.add_argument(
+        '--sacremoses',
+        action='store_const',
+        const=True,
+        default=False,
+        help='Postprocess with sacremoses instead of ../postprocess.sh (moses perl scripts), '
+             'scores differ slightly',
+    )
+    parser.add_argument(
+        '--cache',
+        type=str,
+        default=os.environ.get('EVAL_CACHE', '../cache'),
+        help='Cache of postprocessed references (eval_cache.py), "" disables it',
+    )
+
+    args = parser.parse_args()
+    return args
+
+
+def is_installed(module):
+    return importlib.util.find_spec(module) is not None
+
+
+def model_langs(model_dir):
+    """ .../model_en2arbg -> ['ar', 'bg'] """
+    targets = os.path.basename(os.path.normpath(model_dir)).split('en2', 1)[1]
+    return [targets[i:i + 2] for i in range(0, len(targets), 2)]
+
+
+def last_epoch_and_update(train_log_path):
+    """ epoch and update of the last training line, read from the end of the log """
+    with open(train_log_path, 'rb') as f:
+        position = f.seek(0, os.SEEK_END)
+        tail = b''
+        while position > 0:
+            block_start = max(0, position - TAIL_BLOCK_SIZE)
+            f.seek(block_start)
+            tail = f.read(position - block_start) + tail
+            position = block_start
+            lines = tail.split(b'\n')
+            # the first line may be incomplete unless the start of the file was reached
+            candidates = lines if position == 0 else lines[1:]
+            for line in reversed(candidates):
+                line = line.decode('utf-8', errors='replace')
+                epoch, update = EPOCH.search(line), UPDATE.search(line)
+                if epoch and update:
+                    return epoch.group(1), update.group(1)
+            tail = lines[0]
+    return '', ''
+
+
+def split_by_tag(source_path, translations_path, target_path, langs):
+    """ lang -> lines of translations and of references, in one pass """
+    hypotheses = {lang: [] for lang in langs}
+    references = {lang: [] for lang in langs}
+    with open(source_path, encoding='utf-8') as source, \
+         open(translations_path, encoding='utf-8') as translations, \
+         open(target_path, encoding='utf-8') as target:
+        for src_line, hyp_line, ref_line in zip(source, translations, target):
+            # <2ln> source sentence
+            tag_end = src_line.find('>')
+            lang = src_line[2:tag_end] if src_line.startswith('<2') else None
+            if lang in hypotheses:
+                hypotheses[lang].append(hyp_line.rstrip('\n'))
+                references[lang].append(ref_line.rstrip('\n'))
+    return hypotheses, references
+
+
+# runs in the worker processes;
+# the references are postprocessed once and taken from the cache since then
+
+def score(lang, hypotheses, references, script=None, cache_dir=None):
+    """ BLEU as printed by sacrebleu --score-only """
+    cache = EvalCache(cache_dir) if cache_dir else None
+    references = postprocessed_references(
+        cache, references, lang, postprocess_version(script),
+        lambda lines, lang: postprocess(lines, lang, script),
+    )
+    hypotheses = postprocess(hypotheses, lang, script)
+    bleu = reference_bleu(cache, references, lang)
+    return f'{bleu.corpus_score(hypotheses, None).score:.1f}'
+
+
+def score_by_script(lang, hypotheses, references, script=POSTPROCESS_SCRIPT, cache_dir=None):
+    """ BLEU printed by ../sacreBLEU/sacrebleu.py --score-only """
+    cache = EvalCache(cache_dir) if cache_dir else None
+    references = postprocessed_references(
+        cache, references, lang, postprocess_version(script),
+        lambda lines, lang: postprocess(lines, lang, script),
+    )
+    hypotheses = postprocess(hypotheses, lang, script)
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', suffix='.ref') as reference_file:
+        reference_file.write('\n'.join(references) + '\n')
+        reference_file.flush()
+        return subprocess.run(
+            [SACREBLEU_SCRIPT, '--score-only', reference_file.name],
+            input='\n'.join(hypotheses) + '\n',
+            stdout=subprocess.PIPE, encoding='utf-8', check=True,
+        ).stdout.strip()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,83 +1,356 @@
 #!/usr/bin/env python3
+# per-language subword statistics of the multi-target corpus
+#
+# ./unique_subwords.py data/processed/train.src data/processed/train.tgt
+# ./unique_subwords.py --jobs 16 data/processed/train.src data/processed/train.tgt
+# ./unique_subwords.py --jobs 16 --vocab data/raw/vocab.multi.yml \
+#     data/processed/train.src data/processed/train.tgt
 
+import argparse
+import os
 import sys
 from collections import defaultdict, Counter
+from multiprocessing import Pool
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../scripts'))
 
-source_filename = sys.argv[1]
-target_filename = sys.argv[2]
 languages = \
-        ['ar', 'az', 'bg', 'bs', 'cs', 'da', 'de', 'el', 'es', 'et', 'fi', 'fr', 
-         'ga', 'he', 'hr', 'hu', 'is', 'it', 'ka', 'lt', 'lv', 'mk', 'mt', 'nl', 
+        ['ar', 'az', 'bg', 'bs', 'cs', 'da', 'de', 'el', 'es', 'et', 'fi', 'fr',
+         'ga', 'he', 'hr', 'hu', 'is', 'it', 'ka', 'lt', 'lv', 'mk', 'mt', 'nl',
          'no', 'pl', 'pt', 'ro', 'ru', 'sk', 'sl', 'sq', 'sr', 'sv', 'tr', 'uk', ]
 
-sentences_count = defaultdict(int)
-src_subwords_count = defaultdict(int)
-tgt_subwords_count = defaultdict(int)
 
-source_subwords = defaultdict(Counter)
-target_subwords = defaultdict(Counter)
+def main():
+    args = parse_args()
+    if args.jobs == 1 and args.vocab is None:
+        stats = count_sequential(args.source, args.target)
+    else:
+        stats = count_parallel(args.source, args.target, args.jobs, args.chunk_lines, args.vocab)
+    write_statistics(*stats)
+    print('Done')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Per-language subword statistics')
+    parser.add_argument('source', help='Source side, lines start with <2xx> tag')
+    parser.add_argument('target', help='Target side')
+    parser.add_argument(
+        '--jobs', '-j',
+        type=int,
+        default=1,
+        help='Number of worker processes',
+    )
+    parser.add_argument(
+        '--chunk-lines',
+        type=int,
+        default=200000,
+        help='Lines per chunk in parallel mode',
+    )
+    parser.add_argument(
+        '--vocab', '-v',
+        type=str,
+        default=None,
+        help='Marian vocabulary (vocab.multi.yml); count subword ids instead of strings',
+    )
+
+    args = parser.parse_args()
+    return args
+
+
+def count_sequential(source_filename, target_filename):
+    sentences_count = defaultdict(int)
+    src_subwords_count = defaultdict(int)
+    tgt_subwords_count = defaultdict(int)
+
+    source_subwords = defaultdict(Counter)
+    target_subwords = defaultdict(Counter)
+
+    with open(source_filename, encoding='utf-8') as source, \
+         open(target_filename, encoding='utf-8') as target:
+        for line, (src_line, tgt_line) in enumerate(zip(source, target)):
+            # <2ln> source sentence
+            # target sentence
+            src_tokens = src_line.strip().split()
+            tgt_tokens = tgt_line.strip().split()
+
+            # <2ln> -> ln
+            tgt_lang = src_tokens[0][2:-1]
+            src_tokens = src_tokens[1:]
+
+            sentences_count[tgt_lang] += 1
+            src_subwords_count[tgt_lang] += len(src_tokens)
+            tgt_subwords_count[tgt_lang] += len(tgt_tokens)
+
+            source_subwords[tgt_lang].update(src_tokens)
+            target_subwords[tgt_lang].update(tgt_tokens)
+
+            if line % 10000 == 0:
+                print('.', end='', flush=True)
+            if line % 1000000 == 0:
+                print(line)
+                print('sentences_count', sentences_count)
+                print('src_subwords_count ', src_subwords_count)
+                print('tgt_subwords_count ', tgt_subwords_count)
+                print()
+
+    ranked = lambda subwords: {lang: counter.most_common() for lang, counter in subwords.items()}
+    return (
+        sentences_count, src_subwords_count, tgt_subwords_count,
+        ranked(source_subwords), ranked(target_subwords),
+    )
+
+
+def write_statistics(sentences_count, src_subwords_count, tgt_subwords_count,
+                     source_subwords, target_subwords):
+    """ *_subwords: lang -> [(subword, count), ...] in Counter.most_common() order """
+    languages = list(sentences_count.keys())
+
+    for lang in languages:
+        try:
+            with open(f'{lang}.src.subwords', 'w', encoding='utf-8') as src:
+                for subword, count in source_subwords[lang]:
+                    src.write(f'{count}\t{subword}\n')
+            with open(f'{lang}.tgt.subwords', 'w', encoding='utf-8') as tgt:
+                for subword, count in target_subwords[lang]:
+                    tgt.write(f'{count}\t{subword}\n')
+        except:
+            print(f'no data for {lang}')
+            continue
+
+    avg_src_len = {
+        lang:src_subwords_count[lang] / sentences_count.get(lang,1)
+        for lang in languages
+    }
+
+    avg_tgt_len = {
+        lang:tgt_subwords_count[lang] / sentences_count.get(lang,1)
+        for lang in languages
+    }
+
+    with open('statistics.csv', 'w', encoding='utf-8') as f:
+        # csv header
+        f.write('target_lang,sentences_count,avg_subwords_src,avg_subwords_tgt,total_subwords_src,total_subwords_tgt\n')
+        for lang in languages:
+            f.write(f'{lang},')
+            f.write(f'{sentences_count.get(lang, "")},')
+            f.write(f'{avg_src_len.get(lang, "")},')
+            f.write(f'{avg_tgt_len.get(lang, "")},')
+            f.write(f'{len(source_subwords[lang])},')
+            f.write(f'{len(target_subwords[lang])}\n')
+
+
+# Parallel mode: files are split into chunks of whole lines using the
+# line-offset index, chunks are counted in a process pool and merged in
+# the corpus order. Merging in order keeps the first-occurrence order of
+# subwords, which decides the order of ties in most_common().
+
+_vocab = None
+
+
+def load_vocab(path):
+    """ Marian yml vocabulary: subword -> id """
+    import yaml
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    with open(path, encoding='utf-8') as f:
+        return yaml.load(f, Loader=loader)
+
+
+def init_worker(vocab_path):
+    global _vocab
+    if vocab_path is not None:
+        _vocab = load_vocab(vocab_path)
+
 
-with open(source_filename, encoding='utf-8') as source, \
-     open(target_filename, encoding='utf-8') as target:
-    for line, (src_line, tgt_line) in enumerate(zip(source, target)):
-        # <2ln> source sentence
-        # target sentence
+def read_lines(path, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode('utf-8')
+    if text.endswith('\n'):
+        text = text[:-1]
+    return text.split('\n')
+
+
+def count_chunk(task):
+    """ counts one chunk; returns per-language counts in order of appearance """
+    source, target, src_range, tgt_range = task
+    sentences_count = {}
+    src_subwords_count = {}
+    tgt_subwords_count = {}
+    source_subwords = {}
+    target_subwords = {}
+
+    for src_line, tgt_line in zip(read_lines(source, *src_range), read_lines(target, *tgt_range)):
         src_tokens = src_line.strip().split()
         tgt_tokens = tgt_line.strip().split()
-        
-        # <2ln> -> ln
+
         tgt_lang = src_tokens[0][2:-1]
         src_tokens = src_tokens[1:]
 
+        if tgt_lang not in sentences_count:
+            sentences_count[tgt_lang] = 0
+            src_subwords_count[tgt_lang] = 0
+            tgt_subwords_count[tgt_lang] = 0
+            source_subwords[tgt_lang] = new_counter()
+            target_subwords[tgt_lang] = new_counter()
+
         sentences_count[tgt_lang] += 1
+        source_subwords[tgt_lang].update(src_tokens, src_subwords_count[tgt_lang])
+        target_subwords[tgt_lang].update(tgt_tokens, tgt_subwords_count[tgt_lang])
         src_subwords_count[tgt_lang] += len(src_tokens)
         tgt_subwords_count[tgt_lang] += len(tgt_tokens)
 
-        source_subwords[tgt_lang].update(src_tokens)
-        target_subwords[tgt_lang].update(tgt_tokens)
-
-        if line % 10000 == 0:
-            print('.', end='', flush=True)
-        if line % 1000000 == 0:
-            print(line)
-            print('sentences_count', sentences_count)
-            print('src_subwords_count ', src_subwords_count)
-            print('tgt_subwords_count ', tgt_subwords_count)
-            print()
-
-languages = list(sentences_count.keys())
-
-for lang in languages:
-    try:
-        with open(f'{lang}.src.subwords', 'w', encoding='utf-8') as src:
-            for subword, count in source_subwords[lang].most_common():
-                src.write(f'{count}\t{subword}\n')
-        with open(f'{lang}.tgt.subwords', 'w', encoding='utf-8') as tgt:
-            for subword, count in target_subwords[lang].most_common():
-                tgt.write(f'{count}\t{subword}\n')
-    except:
-        print(f'no data for {lang}')
-        continue
-
-avg_src_len = {
-    lang:src_subwords_count[lang] / sentences_count.get(lang,1)
-    for lang in languages
-}
-
-avg_tgt_len = {
-    lang:tgt_subwords_count[lang] / sentences_count.get(lang,1)
-    for lang in languages
-}
-
-with open('statistics.csv', 'w', encoding='utf-8') as f:
-    # csv header
-    f.write('target_lang,sentences_count,avg_subwords_src,avg_subwords_tgt,total_subwords_src,total_subwords_tgt\n')
-    for lang in languages:
-        f.write(f'{lang},')
-        f.write(f'{sentences_count.get(lang, "")},')
-        f.write(f'{avg_src_len.get(lang, "")},')
-        f.write(f'{avg_tgt_len.get(lang, "")},')
-        f.write(f'{len(source_subwords[lang])},')
-        f.write(f'{len(target_subwords[lang])}\n')
-
-print('Done')
+    return (
+        sentences_count, src_subwords_count, tgt_subwords_count,
+        {lang: counter.result() for lang, counter in source_subwords.items()},
+        {lang: counter.result() for lang, counter in target_subwords.items()},
+    )
+
+
+def new_counter():
+    return StringCounter() if _vocab is None else IdCounter(_vocab)
+
+
+class StringCounter:
+    def __init__(self):
+        self.counter = Counter()
+
+    def update(self, tokens, position):
+        self.counter.update(tokens)
+
+    def result(self):
+        return self.counter
+
+    @staticmethod
+    def merge(total, partial, offset):
+        if total is None:
+            total = Counter()
+        total.update(partial)
+        return total
+
+    @staticmethod
+    def ranked(total, id_to_subword):
+        return total.most_common()
+
+
+class IdCounter:
+    """
+    Counts in-vocabulary subwords into an array indexed by vocabulary id;
+    keeps position of the first occurrence to reproduce most_common() order
+    """
+    def __init__(self, vocab):
+        self.vocab = vocab
+        self.ids = []
+        self.positions = []
+        self.oov = {}
+
+    def update(self, tokens, position):
+        get = self.vocab.get
+        for i, token in enumerate(tokens):
+            subword_id = get(token)
+            if subword_id is None:
+                if token in self.oov:
+                    self.oov[token][0] += 1
+                else:
+                    self.oov[token] = [1, position + i]
+            else:
+                self.ids.append(subword_id)
+                self.positions.append(position + i)
+
+    def result(self):
+        size = len(self.vocab)
+        ids = np.array(self.ids, dtype=np.int64)
+        positions = np.array(self.positions, dtype=np.int64)
+        counts = np.bincount(ids, minlength=size)
+        first_seen = np.full(size, np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(first_seen, ids, positions)
+        return counts, first_seen, self.oov
+
+    @staticmethod
+    def merge(total, partial, offset):
+        counts, first_seen, oov = partial
+        if total is None:
+            return counts, first_seen, dict(oov)
+        total_counts, total_first_seen, total_oov = total
+        unseen = (total_counts == 0) & (counts > 0)
+        total_first_seen[unseen] = first_seen[unseen] + offset
+        total_counts += counts
+        for token, (count, position) in oov.items():
+            if token in total_oov:
+                total_oov[token][0] += count
+            else:
+                total_oov[token] = [count, position + offset]
+        return total_counts, total_first_seen, total_oov
+
+    @staticmethod
+    def ranked(total, id_to_subword):
+        counts, first_seen, oov = total
+        present = np.flatnonzero(counts)
+        entries = [
+            (int(count), int(position), id_to_subword[subword_id])
+            for subword_id, count, position
+            in zip(present, counts[present], first_seen[present])
+        ]
+        entries.extend((count, position, token) for token, (count, position) in oov.items())
+        entries.sort(key=lambda entry: (-entry[0], entry[1]))
+        return [(subword, count) for count, _, subword in entries]
+
+
+def plan_chunks(source, target, chunk_lines):
+    from line_index import ParallelCorpus
+    with ParallelCorpus(source, target) as corpus:
+        src_offsets = corpus.source.offsets
+        tgt_offsets = corpus.target.offsets
+        tasks = []
+        for start in range(0, len(corpus), chunk_lines):
+            end = min(start + chunk_lines, len(corpus))
+            tasks.append((
+                source, target,
+                (src_offsets[start], src_offsets[end]),
+                (tgt_offsets[start], tgt_offsets[end]),
+            ))
+    return tasks
+
+
+def count_parallel(source, target, jobs, chunk_lines, vocab_path):
+    counter_class = StringCounter if vocab_path is None else IdCounter
+    id_to_subword = None
+    if vocab_path is not None:
+        vocab = load_vocab(vocab_path)
+        id_to_subword = [None] * len(vocab)
+        for subword, subword_id in vocab.items():
+            id_to_subword[subword_id] = subword
+
+    sentences_count = {}
+    src_subwords_count = {}
+    tgt_subwords_count = {}
+    source_subwords = {}
+    target_subwords = {}
+
+    tasks = plan_chunks(source, target, chunk_lines)
+    with Pool(jobs, initializer=init_worker, initargs=(vocab_path,)) as pool:
+        for n, partial in enumerate(pool.imap(count_chunk, tasks), 1):
+            sentences, src_count, tgt_count, src_subwords, tgt_subwords = partial
+            for lang in sentences:
+                src_offset = src_subwords_count.get(lang, 0)
+                tgt_offset = tgt_subwords_count.get(lang, 0)
+                source_subwords[lang] = counter_class.merge(source_subwords.get(lang), src_subwords[lang], src_offset)
+                target_subwords[lang] = counter_class.merge(target_subwords.get(lang), tgt_subwords[lang], tgt_offset)
+                sentences_count[lang] = sentences_count.get(lang, 0) + sentences[lang]
+                src_subwords_count[lang] = src_offset + src_count[lang]
+                tgt_subwords_count[lang] = tgt_offset + tgt_count[lang]
+            print(f'chunk {n}/{len(tasks)}', flush=True)
+
+    ranked = lambda subwords: {
+        lang: counter_class.ranked(total, id_to_subword)
+        for lang, total in subwords.items()
+    }
+    return (
+        sentences_count, src_subwords_count, tgt_subwords_count,
+        ranked(source_subwords), ranked(target_subwords),
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+# cache of the combination corpora data/interim/en2<langs>.{train,val}.{source,target}
+# shared by the trainings, with reference counts and LRU eviction under a disk budget
+#
+# cd experiments/en-to-36
+# ../../scripts/corpus_cache.py acquire en2arcs --pid $$ --build ./prepare_data.sh ar cs
+#   registers the calling shell as a user of the corpus, builds it if missing
+#   (one builder, the other tasks wait for it)
+# ../../scripts/corpus_cache.py build en2arcs -- ./prepare_data.sh ar cs
+#   builds it if missing without registering a user (e.g. in a separate cpu job)
+# ../../scripts/corpus_cache.py release en2arcs --pid $$
+# ../../scripts/corpus_cache.py list
+#   corpus, size, users, last use
+# ../../scripts/corpus_cache.py evict --max-size 200G --min-free 50G
+#
+# Bookkeeping is in <cache>/.corpus_cache:
+#   <name>.ready      written after a successful build, its mtime is the last use
+#   <name>.lock       flock held by the builder
+#   <name>.users/     one file per user, <host>.<pid>
+#   cache.lock        flock held while users are registered and entries evicted
+# Entries without users and without a running build are removed, least
+# recently used first, while the ready entries take more than --max-size or
+# the disk has less than --min-free space. A user whose process is gone (on
+# this host) or older than --stale-days (other hosts) does not count.
+
+import argparse
+import fcntl
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+from eval_cache import size_value
+
+DEFAULT_CACHE = 'data/interim'
+DEFAULT_MAX_SIZE = '500G'
+DEFAULT_MIN_FREE = '50G'
+DEFAULT_STALE_DAYS = 14
+META_DIR = '.corpus_cache'
+SPLITS = ('train', 'val')
+SIDES = ('source', 'target')
+
+
+def main():
+    args = parse_args()
+    cache = CorpusCache(args.cache, args.max_size, args.min_free, args.stale_days * 24 * 3600)
+    sys.exit(args.func(cache, args))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Reference-counted cache of combination corpora')
+    parser.add_argument(
+        '--cache', '-c',
+        type=str,
+        default=os.environ.get('CORPUS_CACHE', DEFAULT_CACHE),
+        help='Folder of the corpora ($CORPUS_CACHE)',
+    )
+    parser.add_argument(
+        '--max-size',
+        type=size_value,
+        default=os.environ.get('CORPUS_CACHE_SIZE', DEFAULT_MAX_SIZE),
+        help='Budget of all cached corpora, e.g. 500G ($CORPUS_CACHE_SIZE)',
+    )
+    parser.add_argument(
+        '--min-free',
+        type=size_value,
+        default=os.environ.get('CORPUS_CACHE_MIN_FREE', DEFAULT_MIN_FREE),
+        help='Free disk space to keep, e.g. 50G ($CORPUS_CACHE_MIN_FREE)',
+    )
+    parser.add_argument(
+        '--stale-days',
+        type=float,
+        default=DEFAULT_STALE_DAYS,
+        help='Users on other hosts older than this do not count',
+    )
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    acquire = subparsers.add_parser('acquire', help='Register a user of a corpus (and build it)')
+    acquire.add_argument('name', help='Corpus, e.g. en2arcs')
+    acquire.add_argument('--pid', type=int, default=os.getppid(), help='Process using the corpus, the caller by default')
+    acquire.add_argument(
+        '--build',
+        nargs=argparse.REMAINDER,
+        default=None,
+        help='Command building the corpus if it is missing (the rest of the arguments)',
+    )
+    acquire.set_defaults(func=acquire_corpus)
+
+    release = subparsers.add_parser('release', help='Unregister a user of a corpus')
+    release.add_argument('name', help='Corpus, e.g. en2arcs')
+    release.add_argument('--pid', type=int, default=os.getppid(), help='Process given to acquire')
+    release.set_defaults(func=release_corpus)
+
+    build = subparsers.add_parser('build', help='Build a corpus if it is missing')
+    build.add_argument('name', help='Corpus, e.g. en2arcs')
+    build.add_argument('command', nargs=argparse.REMAINDER, help='Command building the corpus (after --)')
+    build.set_defaults(func=build_corpus)
+
+    ready = subparsers.add_parser('ready', help='Exit status 0 if a corpus is built')
+    ready.add_argument('name', help='Corpus, e.g. en2arcs')
+    ready.set_defaults(func=lambda cache, args: 0 if cache.is_ready(args.name) else 1)
+
+    listing = subparsers.add_parser('list', help='Cached corpora')
+    listing.set_defaults(func=list_corpora)
+
+    evict = subparsers.add_parser('evict', help='Remove unused corpora over the budget')
+    evict.set_defaults(func=evict_corpora)
+
+    args = parser.parse_args()
+    return args
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+@contextmanager
+def flocked(path, blocking=True):
+    """ exclusive flock of the file, yields False if not blocking and held by another process """
+    with open(path, 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class CorpusCache:
+    def __init__(self, root, max_size, min_free, stale_seconds=DEFAULT_STALE_DAYS * 24 * 3600):
+        self.root = root
+        self.max_size = max_size
+        self.min_free = min_free
+        self.stale_seconds = stale_seconds
+        self.meta = os.path.join(root, META_DIR)
+        os.makedirs(self.meta, exist_ok=True)
+
+    def files(self, name):
+        return [os.path.join(self.root, f'{name}.{split}.{side}') for split in SPLITS for side in SIDES]
+
+    def _meta(self, name, suffix):
+        return os.path.join(self.meta, name + suffix)
+
+    def _user_path(self, name, pid):
+        return os.path.join(self._meta(name, '.users'), f'{socket.gethostname()}.{pid}')
+
+    def is_ready(self, name):
+        return os.path.exists(self._meta(name, '.ready'))
+
+    def touch(self, name):
+        try:
+            os.utime(self._meta(name, '.ready'))
+        except FileNotFoundError:
+            pass
+
+    def users(self, name):
+        """ live users (<host>.<pid>) of a corpus, files of stale users are removed """
+        users_dir = self._meta(name, '.users')
+        try:
+            entries = list(os.scandir(users_dir))
+        except FileNotFoundError:
+            return []
+        host = socket.gethostname()
+        now = time.time()
+        users = []
+        for entry in entries:
+            user_host, _, pid = entry.name.rpartition('.')
+            try:
+                if user_host == host:
+                    stale = not process_alive(int(pid))
+                else:
+                    stale = now - entry.stat().st_mtime > self.stale_seconds
+            except (ValueError, FileNotFoundError):
+                stale = True
+            if stale:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+            else:
+                users.append(entry.name)
+        return users
+
+    def acquire(self, name, pid):
+        with flocked(os.path.join(self.meta, 'cache.lock')):
+            # registered under the lock, the corpus is not evicted from now on
+            os.makedirs(self._meta(name, '.users'), exist_ok=True)
+            with open(self._user_path(name, pid), 'w') as f:
+                f.write(f'{time.time()}\n')
+            self.touch(name)
+
+    def release(self, name, pid):
+        with flocked(os.path.join(self.meta, 'cache.lock')):
+            try:
+                os.remove(self._user_path(name, pid))
+            except FileNotFoundError:
+                pass
+            self.touch(name)
+
+    def build(self, name, command):
+        """
+        Runs the command unless the corpus is ready, concurrent builds of
+        the same corpus wait for the first one. Returns the exit status.
+        """
+        if self.is_ready(name):
+            self.touch(name)
+            return 0
+        with flocked(self._meta(name, '.lock')):
+            if self.is_ready(name):
+                # built by the process we waited for
+                self.touch(name)
+                return 0
+            # room for the new corpus
+            self.evict()
+            print(f'building {name}: {" ".join(command)}', file=sys.stderr)
+            status = subprocess.call(command)
+            missing = [path for path in self.files(name) if not os.path.exists(path)]
+            if status != 0 or missing:
+                print(f'building {name} failed (status {status}, missing {" ".join(missing)})', file=sys.stderr)
+                self._remove_files(name)
+                return status or 1
+            sizes = {os.path.basename(path): os.path.getsize(path) for path in self.files(name)}
+            tmp_path = f'{self._meta(name, ".ready")}.tmp.{os.getpid()}'
+            with open(tmp_path, 'w') as f:
+                json.dump({'command': command, 'sizes': sizes, 'host': socket.gethostname()}, f)
+            os.replace(tmp_path, self._meta(name, '.ready'))
+        # not the new corpus, its users may not have acquired it yet
+        self.evict(keep=name)
+        return 0
+
+    def size(self, name):
+        total = 0
+        for path in self.files(name):
+            try:
+                total += os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+        return total
+
+    def entries(self):
+        """ (last use, size, name) of the ready corpora """
+        entries = []
+        for entry in os.scandir(self.meta):
+            if not entry.name.endswith('.ready'):
+                continue
+            name = entry.name[:-len('.ready')]
+            try:
+                entries.append((entry.stat().st_mtime, self.size(name), name))
+            except FileNotFoundError:
+                continue
+        return entries
+
+    def _remove_files(self, name):
+        for path in self.files(name):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def evict(self, keep=None):
+        """ removes unused corpora (except keep), least recently used first, returns their names """
+        removed = []
+        with flocked(os.path.join(self.meta, 'cache.lock')):
+            entries = sorted(self.entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in entries:
+                if total <= self.max_size and shutil.disk_usage(self.root).free >= self.min_free:
+                    break
+                if name == keep or self.users(name):
+                    continue
+                with flocked(self._meta(name, '.lock'), blocking=False) as unlocked:
+                    if not unlocked:
+                        # being built
+                        continue
+                    # not ready first, nobody starts using half removed files
+                    os.remove(self._meta(name, '.ready'))
+                    self._remove_files(name)
+                total -= size
+                removed.append(name)
+                print(f'evicted {name} ({size / 1024**3:.1f}G)', file=sys.stderr)
+        return removed
+
+
+def acquire_corpus(cache, args):
+    cache.acquire(args.name, args.pid)
+    if args.build:
+        return cache.build(args.name, args.build)
+    return 0
+
+
+def release_corpus(cache, args):
+    cache.release(args.name, args.pid)
+    cache.evict()
+    return 0
+
+
+def build_corpus(cache, args):
+    command = args.command[1:] if args.command[:1] == ['--'] else args.command
+    if not command:
+        sys.exit('no build command')
+    return cache.build(args.name, command)
+
+
+def evict_corpora(cache, args):
+    cache.evict()
+    return 0
+
+
+def list_corpora(cache, args):
+    for last_use, size, name in sorted(cache.entries(), reverse=True):
+        used = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last_use))
+        print(f'{name}\t{size / 1024**3:.1f}G\t{len(cache.users(name))} users\t{used}')
+    return 0
+
+
+if __name__ == '__main__':
+    main()
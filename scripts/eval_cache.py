@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# content-addressed cache of postprocessed and of sacreBLEU-tokenized
+# references, shared by validation and test evaluation
+#
+# ./eval_cache.py score --cache cache --lang cs --reference gold.cs < translated.txt
+#   prints BLEU like sacrebleu.py --score-only, the tokenized reference comes from the cache
+# ./eval_cache.py evict --cache cache --max-size 2G
+#
+# python usage:
+#   cache = EvalCache('cache')
+#   references = postprocessed_references(cache, lines, 'cs', version, postprocess)
+#   bleu = reference_bleu(cache, references, 'cs')
+#   bleu.corpus_score(hypotheses, None)
+#
+# Entries are folders named by sha256 of (content, language, version of the
+# postprocessing). Files are written to a temporary name and renamed, so
+# concurrent readers and writers (also on NFS) see either nothing or the
+# whole file. Entries are plain text, the reference n-grams are counted
+# again by sacrebleu's public API from the tokenized lines. Reading an entry
+# updates its mtime; at most every EVICT_INTERVAL seconds a writer checks
+# the size of the cache and, when it is over the size cap, removes the least
+# recently used entries holding the eviction lock.
+
+import argparse
+import hashlib
+import os
+import shutil
+import socket
+import sys
+import time
+
+DEFAULT_MAX_SIZE = 2 * 1024**3
+EVICT_LOCK = '.evict.lock'
+# mtime is the last size check
+EVICT_STAMP = '.evicted'
+# seconds between size checks of the writers
+EVICT_INTERVAL = 300
+# eviction lock older than this is left over from a killed process
+STALE_LOCK_SECONDS = 600
+REFERENCES = 'references.txt'
+BLEU_REFERENCES = 'bleu_references.txt'
+
+
+def main():
+    args = parse_args()
+    args.func(args)
+
+
+def size_value(value):
+    """ 2G -> 2147483648 """
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    if value[-1:].upper() in units:
+        return int(float(value[:-1]) * units[value[-1].upper()])
+    return int(value)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Cache of postprocessed references and BLEU statistics')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    def add_cache_arguments(subparser):
+        subparser.add_argument(
+            '--cache', '-c',
+            type=str,
+            required=True,
+            help='Cache folder',
+        )
+        subparser.add_argument(
+            '--max-size',
+            type=size_value,
+            default=DEFAULT_MAX_SIZE,
+            help='Size cap, e.g. 500M or 2G',
+        )
+
+    score = subparsers.add_parser('score', help='BLEU of stdin against a cached reference')
+    add_cache_arguments(score)
+    score.add_argument('--lang', '-l', type=str, required=True, help='Target language')
+    score.add_argument('--reference', '-r', type=str, required=True, help='Reference file')
+    score.set_defaults(func=score_stdin)
+
+    evict = subparsers.add_parser('evict', help='Remove least recently used entries over the cap')
+    add_cache_arguments(evict)
+    evict.set_defaults(func=lambda args: EvalCache(args.cache, args.max_size).evict())
+
+    args = parser.parse_args()
+    return args
+
+
+def score_stdin(args):
+    cache = EvalCache(args.cache, args.max_size)
+    with open(args.reference, encoding='utf-8') as f:
+        references = [line.rstrip('\n') for line in f]
+    hypotheses = [line.rstrip('\n') for line in sys.stdin]
+    bleu = reference_bleu(cache, references, args.lang)
+    print(f'{bleu.corpus_score(hypotheses, None).score:.1f}')
+
+
+class EvalCache:
+    def __init__(self, root, max_size=DEFAULT_MAX_SIZE):
+        self.root = root
+        self.max_size = max_size
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(content, lang, version):
+        """ content: bytes or list of lines """
+        if not isinstance(content, bytes):
+            content = '\n'.join(content).encode('utf-8')
+        digest = hashlib.sha256()
+        for part in (lang.encode('utf-8'), version.encode('utf-8'), content):
+            digest.update(len(part).to_bytes(8, 'little'))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key, name):
+        """ bytes of the cached file or None """
+        entry = self._entry(key)
+        try:
+            with open(os.path.join(entry, name), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            # mtime of the entry is its last use
+            os.utime(entry)
+        except FileNotFoundError:
+            pass
+        return data
+
+    def put(self, key, name, data):
+        entry = self._entry(key)
+        path = os.path.join(entry, name)
+        tmp_path = f'{path}.tmp.{socket.gethostname()}.{os.getpid()}'
+        for attempt in range(2):
+            try:
+                os.makedirs(entry, exist_ok=True)
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+                break
+            except FileNotFoundError:
+                # the entry was evicted meanwhile, create it again
+                if attempt:
+                    raise
+        if self.eviction_due():
+            self.evict()
+
+    def cached(self, key, name, compute):
+        """ cached bytes, compute() gives them on a miss """
+        data = self.get(key, name)
+        if data is None:
+            data = compute()
+            self.put(key, name, data)
+        return data
+
+    def _entries(self):
+        """ (mtime, size, path) of all entries """
+        entries = []
+        for prefix in os.scandir(self.root):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                try:
+                    size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                    entries.append((entry.stat().st_mtime, size, entry.path))
+                except FileNotFoundError:
+                    # removed by another process meanwhile
+                    continue
+        return entries
+
+    def eviction_due(self):
+        """ the last size check is older than EVICT_INTERVAL """
+        try:
+            return time.time() - os.stat(os.path.join(self.root, EVICT_STAMP)).st_mtime > EVICT_INTERVAL
+        except FileNotFoundError:
+            return True
+
+    def evict(self):
+        """ removes least recently used entries while the cache is over the size cap """
+        lock_path = os.path.join(self.root, EVICT_LOCK)
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if time.time() - os.stat(lock_path).st_mtime > STALE_LOCK_SECONDS:
+                    os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+            # another process is evicting
+            return
+        try:
+            os.close(fd)
+            with open(os.path.join(self.root, EVICT_STAMP), 'w'):
+                pass
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_size:
+                    break
+                # renamed first, so nobody reads a half removed entry
+                trash = f'{path}.removed.{socket.gethostname()}.{os.getpid()}'
+                try:
+                    os.rename(path, trash)
+                except FileNotFoundError:
+                    continue
+                shutil.rmtree(trash, ignore_errors=True)
+                total -= size
+        finally:
+            os.remove(lock_path)
+
+
+def postprocessed_references(cache, lines, lang, version, postprocess):
+    """
+    Postprocessed reference lines from the cache; postprocess(lines, lang)
+    computes them on a miss. version identifies the postprocessing.
+    """
+    if cache is None:
+        return postprocess(lines, lang)
+    key = EvalCache.key(lines, lang, version)
+    data = cache.cached(
+        key, REFERENCES,
+        lambda: '\n'.join(postprocess(lines, lang)).encode('utf-8'),
+    )
+    return data.decode('utf-8').split('\n') if lines else []
+
+
+class ReferenceBLEU:
+    """
+    sacrebleu BLEU (default settings) of tokenized references, hypotheses
+    are tokenized as BLEU() does it; the scores are those of BLEU()
+    """
+    def __init__(self, tokenizer, tokenized_references):
+        from sacrebleu.metrics import BLEU
+        self.tokenizer = tokenizer
+        self.bleu = BLEU(tokenize='none', references=[tokenized_references])
+
+    def corpus_score(self, hypotheses, references=None):
+        return self.bleu.corpus_score([self.tokenizer(line.rstrip()) for line in hypotheses], references)
+
+
+def reference_bleu(cache, references, lang):
+    """
+    BLEU with n-gram statistics of the references,
+    score with bleu.corpus_score(hypotheses, None)
+    """
+    import sacrebleu
+    from sacrebleu.metrics import BLEU
+    if cache is None:
+        return BLEU(references=[references])
+    tokenizer = BLEU().tokenizer
+    # the tokenizer of the default BLEU settings, it only changes with the sacrebleu version
+    version = f'sacrebleu-{sacrebleu.__version__}-{tokenizer.signature()}'
+    key = EvalCache.key(references, lang, version)
+    data = cache.cached(
+        key, BLEU_REFERENCES,
+        lambda: '\n'.join(tokenizer(line.rstrip()) for line in references).encode('utf-8'),
+    )
+    return ReferenceBLEU(tokenizer, data.decode('utf-8').split('\n') if references else [])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,71 +1,201 @@
-#!/usr/bin/env python3 
+#!/usr/bin/env python3
+# adds validation lines of valid.log missing in train.log (older trainings
+# did not write the individual BLEU scores to train.log)
+#
+# ./fix_train_log.py -d experiments/en-to-36/model_en2bg
+#   fixes one model folder
+# ./fix_train_log.py --batch experiments/en-to-36 --jobs 8
+#   fixes all model_* folders of the experiments folder in parallel
+#
+# The logs are read line by line: train.log first for its [valid] lines,
+# then both together. valid.log lines that are nowhere in train.log (steps
+# repeat in restarted trainings) are inserted, in the order of valid.log,
+# before the first train.log line of their step (Up. xx) with the same or a
+# later time, at the latest before the first line of a later step or
+# 'Training finished'. Only the lines of one step and the [valid] lines are
+# kept in memory. The fixed log is written next to train.log and renamed
+# over it; it is left untouched if nothing is missing or if it changed
+# meanwhile.
 
 import argparse
+import fnmatch
 import os
 import sys
+from multiprocessing import Pool
+
 
 def main():
     args = parse_args()
-    fix_train_log(args)
-    
+    if args.experiment_dir is not None:
+        directories = [args.experiment_dir]
+    else:
+        directories = [
+            os.path.join(args.batch, name) for name in sorted(os.listdir(args.batch))
+            if fnmatch.fnmatch(name, args.pattern)
+            and os.path.isfile(os.path.join(args.batch, name, 'valid.log'))
+            and os.path.isfile(os.path.join(args.batch, name, 'train.log'))
+        ]
+
+    with Pool(min(args.jobs, len(directories)) or 1) as pool:
+        for directory, inserted in pool.imap(fix_train_log, directories):
+            if inserted is None:
+                print(f'{directory}: train.log changed while fixing, skipped', file=sys.stderr)
+            else:
+                print(f'{directory}: {inserted} lines added')
+
+    print('done')
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description='Fix for older train logs that did not contain intividual BLEU scores')
-    parser.add_argument(
+    folders = parser.add_mutually_exclusive_group(required=True)
+    folders.add_argument(
         '--experiment-dir', '-d',
         type=str,
         help='Folder with experiment',
     )
+    folders.add_argument(
+        '--batch', '-b',
+        type=str,
+        help='Folder with experiment folders, all of them are fixed',
+    )
+    parser.add_argument(
+        '--pattern', '-p',
+        type=str,
+        default='model_*',
+        help='Experiment folders of --batch',
+    )
+    parser.add_argument(
+        '--jobs', '-j',
+        type=int,
+        default=os.cpu_count(),
+        help='Number of folders fixed at once',
+    )
 
     args = parser.parse_args()
     return args
 
-def fix_train_log(args):
-    full_path = lambda x: os.path.join(args.experiment_dir, x)
-    with open(full_path('valid.log'), encoding='utf-8') as valid,\
-         open(full_path('train.log'), encoding='utf-8') as train,\
-         open(full_path('fixed_train.log'), 'w', encoding='utf-8') as fixed_train:
-        # find valid/translation, append lang/bleu_xx
-        train_lines = (line for line in train)
-        for step, valid_portion in generate_valid_portion(valid):
-            for line in train_lines:
-                line = line.strip()
-                current_step = get_step(line)
-                if current_step is None:
-                    print(line, file=fixed_train)
-                    continue
-                if current_step == step:
-                    valid_portion.discard(line)
-                if current_step > step:
-                    for leftover_line in valid_portion:
-                        print(leftover_line, file=fixed_train)
-                    print(line, file=fixed_train)
-                    break
-                print(line, file=fixed_train)
 
-    print('done')
+def fix_train_log(experiment_dir):
+    """ returns (experiment_dir, number of added lines), None instead of the number if train.log changed """
+    train_path = os.path.join(experiment_dir, 'train.log')
+    tmp_path = f'{train_path}.fixed.{os.getpid()}'
+    before = os.stat(train_path)
+    with open(train_path, encoding='utf-8') as train:
+        present = valid_lines(train)
+    with open(os.path.join(experiment_dir, 'valid.log'), encoding='utf-8') as valid,\
+         open(train_path, encoding='utf-8') as train,\
+         open(tmp_path, 'w', encoding='utf-8') as fixed_train:
+        inserted = merge(train, valid, fixed_train, present)
 
+    after = os.stat(train_path)
+    if (before.st_size, before.st_mtime_ns) != (after.st_size, after.st_mtime_ns):
+        os.remove(tmp_path)
+        return experiment_dir, None
+    if not inserted:
+        os.remove(tmp_path)
+        return experiment_dir, 0
+    os.chmod(tmp_path, before.st_mode & 0o7777)
+    os.replace(tmp_path, train_path)
+    return experiment_dir, inserted
 
-def generate_valid_portion(valid_file):
+
+def valid_lines(train_lines):
+    """ [valid] lines of train.log, they are not inserted again """
+    return {line.rstrip('\n') for line in train_lines if '[valid]' in line}
+
+
+def merge(train_lines, valid_lines, output, present=None):
     """
-    Yields set of valid.log lines with the same step (Up. xx)
+    Writes train lines with the missing valid lines inserted,
+    returns the number of inserted lines. present are the lines of
+    train.log that are not missing (valid_lines), by default the ones of
+    the step's region; steps repeat in restarted trainings.
     """
-    valid_lines = (line for line in valid_file)
-    first_line = valid_lines.__next__()
-    step = get_step(first_line)
-    accumulator = set([first_line])
+    valid_portions = generate_valid_portion(valid_lines)
+    step, valid_portion = next(valid_portions)
+    # train.log lines from the first one of the current valid step
+    region = None
+    inserted = 0
 
-    for line in valid_lines:
-        line = line.strip()
+    for line in train_lines:
+        line = line.rstrip('\n')
+        current_step = sys.maxsize if 'Training finished' in line else get_step(line)
+        while current_step is not None and current_step > step:
+            inserted += write_region(region or [], valid_portion, output, present)
+            region = None
+            step, valid_portion = next(valid_portions)
+        if current_step == step and region is None:
+            region = []
+        if region is None:
+            print(line, file=output)
+        else:
+            region.append(line)
+
+    while True:
+        inserted += write_region(region or [], valid_portion, output, present)
+        region = None
+        if step == sys.maxsize:
+            return inserted
+        step, valid_portion = next(valid_portions)
+
+
+def write_region(region, valid_portion, output, present=None):
+    """
+    Writes train lines of a step with the valid lines not among them
+    (nor in present, which gets the inserted lines), each before the first
+    train line of the same or a later time
+    """
+    in_region = set(region)
+    missing = []
+    for line in valid_portion:
+        if line in in_region or (present is not None and line in present):
+            continue
+        missing.append(line)
+        if present is not None:
+            present.add(line)
+    position = 0
+    for line in region:
+        line_time = get_time(line)
+        while position < len(missing) and line_time is not None \
+                and get_time(missing[position]) is not None \
+                and get_time(missing[position]) <= line_time:
+            print(missing[position], file=output)
+            position += 1
+        print(line, file=output)
+    for line in missing[position:]:
+        print(line, file=output)
+    return len(missing)
+
+
+def generate_valid_portion(valid_file):
+    """
+    Yields list of valid.log lines with the same step (Up. xx), in their
+    order; lines without a step belong to the previous step
+    """
+    step = None
+    accumulator = []
+    for line in valid_file:
+        line = line.rstrip('\n')
         current_step = get_step(line)
-        if current_step != step:
-            yield step, accumulator
+        if current_step is not None and current_step != step:
+            if accumulator:
+                yield step, accumulator
             step = current_step
-            accumulator = set()
+            accumulator = []
+        if step is not None:
+            accumulator.append(line)
+
+    if accumulator:
+        yield step, accumulator
+    yield sys.maxsize, []
 
-        accumulator.add(line)
 
-    yield step, accumulator
-    yield sys.maxsize, set()
+def get_time(line):
+    """ [2020-04-18 17:44:24] prefix, compares as the time """
+    if line.startswith('[') and line[20:21] == ']':
+        return line[:21]
+    return None
 
 
 def get_step(line):
@@ -75,7 +205,6 @@ def get_step(line):
     if 'Up.' not in line:
         return None
     update = int(line.split('Up.')[1].strip().split(' ')[0])
-    #print(line, update, 'update')
     return update
 
 
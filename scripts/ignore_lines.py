@@ -1,13 +1,30 @@
 #!/usr/bin/env python3
 # filter out lines specified in another file
+#
+# line mode (default), prints to stdout:
+#   ./ignore_lines.py --lines=overlap --source=corpus.src > filtered.src
+# bulk mode, filters both sides of the parallel corpus at once:
+#   ./ignore_lines.py --bulk --lines=overlap \
+#       --source=corpus.src --output=filtered.src \
+#       --source=corpus.tgt --output=filtered.tgt
 
 import sys
 import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+CHUNK_SIZE = 64 * 1024 * 1024
 
 def main():
     args = parse_args()
+    if args.bulk:
+        bulk_main(args)
+        return
+    if len(args.source) != 1:
+        sys.exit('line mode filters exactly one --source, use --bulk for more')
     skipped_lines_generator = get_skipped_line_generator(args.lines)
-    with open(args.source, encoding='utf-8') as f_data:
+    with open(args.source[0], encoding='utf-8') as f_data:
         skip_line = next(skipped_lines_generator)
         for i, data_line in enumerate(f_data, 1):
             if i == skip_line:
@@ -19,8 +36,14 @@ def parse_args():
     parser = argparse.ArgumentParser(description='Filter out lines specified in another file.')
     parser.add_argument('--lines', '-l', type=str,
                         help='File contains lines to skip')
-    parser.add_argument('--source', '-s', type=str,
-                        help='Source file to be filtered')
+    parser.add_argument('--source', '-s', type=str, action='append', default=[],
+                        help='Source file to be filtered (repeat with --bulk)')
+    parser.add_argument('--output', '-o', type=str, action='append', default=[],
+                        help='Output file for each --source (only with --bulk)')
+    parser.add_argument('--bulk', '-b', action='store_true',
+                        help='Filter all sources in one run with large binary reads')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='Bytes per read in bulk mode')
 
     args = parser.parse_args()
     return args
@@ -31,5 +54,129 @@ def get_skipped_line_generator(lines_file):
             yield int(line)
     yield -1
 
+
+# Bulk mode: lines are copied as raw bytes, only lines that
+# str.strip() could change are decoded, stripped and encoded again,
+# so the output is the same as in the line mode.
+
+def whitespace_table(extra_bytes):
+    import numpy as np
+    table = np.zeros(256, dtype=bool)
+    # ASCII characters that str.strip() removes
+    table[[0x09, 0x0a, 0x0b, 0x0c, 0x0d, 0x1c, 0x1d, 0x1e, 0x1f, 0x20]] = True
+    table[list(extra_bytes)] = True
+    return table
+
+# first bytes of UTF-8 encoded non-ASCII whitespace (U+0085, U+00A0, U+1680, U+2000..U+3000)
+LEAD_BYTES = (0xc2, 0xe1, 0xe2, 0xe3)
+# last bytes of the same characters
+TRAIL_BYTES = tuple(range(0x80, 0x8b)) + (0xa0, 0xa8, 0xa9, 0xaf, 0x9f)
+
+
+def bulk_main(args):
+    if len(args.source) != len(args.output):
+        sys.exit('--bulk needs one --output per --source')
+    skip = read_skipped_lines(args.lines)
+    tables = whitespace_table(LEAD_BYTES), whitespace_table(TRAIL_BYTES)
+    with ThreadPoolExecutor(max_workers=len(args.source)) as executor:
+        futures = [
+            executor.submit(filter_file, skip, tables, source, output, args.chunk_size)
+            for source, output in zip(args.source, args.output)
+        ]
+        for future in futures:
+            print(future.result(), file=sys.stderr)
+
+
+def read_skipped_lines(lines_file):
+    """ sorted unique array of 1-based line numbers """
+    import numpy as np
+    with open(lines_file, 'rb') as f:
+        return np.unique(np.array(f.read().split(), dtype=np.int64))
+
+
+def filter_file(skip, tables, source, output, chunk_size):
+    timer = {'read': 0., 'filter': 0., 'write': 0.}
+    start = time.time()
+    first_line = 1
+    n_bytes = 0
+    tmp_output = output + '.tmp'
+    try:
+        with open(source, 'rb', buffering=0) as f_data, \
+             open(tmp_output, 'wb', buffering=chunk_size) as f_out:
+            tail = b''
+            while True:
+                t = time.time()
+                data = f_data.read(chunk_size)
+                timer['read'] += time.time() - t
+                if not data:
+                    break
+                n_bytes += len(data)
+                chunk = tail + data if tail else data
+                end = chunk.rfind(b'\n') + 1
+                chunk, tail = chunk[:end], chunk[end:]
+                if chunk:
+                    first_line = filter_chunk(chunk, first_line, skip, tables, f_out, timer)
+            if tail:
+                # the last line without newline, print() adds one
+                first_line = filter_chunk(tail + b'\n', first_line, skip, tables, f_out, timer)
+        os.replace(tmp_output, output)
+    except BaseException:
+        if os.path.exists(tmp_output):
+            os.remove(tmp_output)
+        raise
+
+    elapsed = time.time() - start
+    n_lines = first_line - 1
+    n_skipped = int(((skip >= 1) & (skip <= n_lines)).sum())
+    return (
+        f'{source}: {n_lines} lines, {n_skipped} skipped, '
+        f'{n_bytes / 2**20:.0f} MB in {elapsed:.1f}s ({n_bytes / 2**20 / max(elapsed, 1e-9):.0f} MB/s); '
+        f'read {timer["read"]:.1f}s, filter {timer["filter"]:.1f}s, write {timer["write"]:.1f}s'
+    )
+
+
+def filter_chunk(chunk, first_line, skip, tables, f_out, timer):
+    """
+    Writes lines of the chunk (ends with newline) that are not in skip.
+    Returns number of the first line of the next chunk.
+    """
+    import numpy as np
+    t = time.time()
+    if b'\r' in chunk:
+        # text mode would split lines on \r as well, line numbers would differ
+        raise ValueError('carriage return in input, use the line mode')
+    lead_table, trail_table = tables
+    buffer = np.frombuffer(chunk, dtype=np.uint8)
+    ends = np.flatnonzero(buffer == 0x0a)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    n_lines = len(ends)
+
+    lo, hi = np.searchsorted(skip, [first_line, first_line + n_lines])
+    skipped = np.zeros(n_lines, dtype=bool)
+    skipped[skip[lo:hi] - first_line] = True
+
+    nonempty = ends > starts
+    to_strip = np.zeros(n_lines, dtype=bool)
+    to_strip[nonempty] = lead_table[buffer[starts[nonempty]]] | trail_table[buffer[ends[nonempty] - 1]]
+    special = np.flatnonzero(skipped | to_strip)
+    timer['filter'] += time.time() - t
+
+    t = time.time()
+    view = memoryview(chunk)
+    run_start = 0
+    for i in special.tolist():
+        f_out.write(view[run_start:starts[i]])
+        if not skipped[i]:
+            line = chunk[starts[i]:ends[i]].decode('utf-8').strip()
+            f_out.write(line.encode('utf-8') + b'\n')
+        run_start = ends[i] + 1
+    f_out.write(view[run_start:])
+    view.release()
+    timer['write'] += time.time() - t
+
+    return first_line + n_lines
+
 if __name__=='__main__':
     main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# persistent line-offset index for large text files (e.g. corpus.multi.bpe.src)
+#
+# ./line_index.py raw/train/corpus.multi.bpe.src raw/train/corpus.multi.bpe.tgt
+#   (re)builds the sidecar indexes
+# ./line_index.py raw/train/corpus.multi.bpe.src --lines 1,10-20
+#   prints selected lines (1-based, as in interim/overlap_test_in_train)
+#
+# python usage:
+#   corpus = ParallelCorpus('corpus.multi.bpe.src', 'corpus.multi.bpe.tgt')
+#   src, tgt = corpus[42]
+#   for n, (src, tgt) in corpus.select([3, 17, 1000]): ...
+
+import argparse
+import mmap
+import os
+import sys
+from array import array
+
+INDEX_SUFFIX = '.idx'
+MAGIC = 0x31584449454e494c  # b'LINEIDX1'
+HEADER_SIZE = 4  # magic, file size, file mtime (ns), number of lines
+CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def main():
+    args = parse_args()
+    if args.lines is None:
+        for path in args.files:
+            index = LineIndex(path)
+            print(f'{path}: {len(index)} lines')
+            index.close()
+        return
+
+    indexes = [LineIndex(path) for path in args.files]
+    out = sys.stdout.buffer
+    for n in args.lines:
+        out.write(b'\t'.join(index.raw(n - 1).rstrip(b'\n') for index in indexes) + b'\n')
+
+
+def line_numbers(value):
+    """ 1,4-6 -> [1, 4, 5, 6] """
+    result = []
+    for number in value.split(','):
+        if '-' in number:
+            _from, _to = number.split('-')
+            result.extend(range(int(_from), int(_to) + 1))
+        else:
+            result.append(int(number))
+    if any(n < 1 for n in result):
+        raise argparse.ArgumentTypeError(f'line numbers start at 1: {value}')
+    return result
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Build line-offset indexes, print selected lines')
+    parser.add_argument(
+        'files',
+        nargs='+',
+        help='Indexed files; with --lines several files are printed tab separated',
+    )
+    parser.add_argument(
+        '--lines', '-l',
+        type=line_numbers,
+        default=None,
+        help='Lines to print (1-based), e.g. 1,10-20',
+    )
+
+    args = parser.parse_args()
+    return args
+
+
+def index_path(path):
+    return path + INDEX_SUFFIX
+
+
+def file_stamp(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def build_index(path):
+    """
+    Streams through the file, writes offsets of line starts (plus the file size)
+    as uint64 into the sidecar index
+    """
+    size, mtime = file_stamp(path)
+    tmp_path = index_path(path) + '.tmp.' + str(os.getpid())
+    with open(path, 'rb') as f, open(tmp_path, 'wb') as index:
+        array('Q', [0] * HEADER_SIZE).tofile(index)
+        array('Q', [0]).tofile(index)
+        n_offsets = 1
+        position = 0
+        last_byte = b'\n'
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            offsets = array('Q')
+            newline = chunk.find(b'\n')
+            while newline >= 0:
+                offsets.append(position + newline + 1)
+                newline = chunk.find(b'\n', newline + 1)
+            offsets.tofile(index)
+            n_offsets += len(offsets)
+            position += len(chunk)
+            last_byte = chunk[-1:]
+        if last_byte != b'\n':
+            # last line without trailing newline
+            array('Q', [position]).tofile(index)
+            n_offsets += 1
+        index.seek(0)
+        array('Q', [MAGIC, size, mtime, n_offsets - 1]).tofile(index)
+    os.replace(tmp_path, index_path(path))
+
+
+class LineIndex:
+    """
+    Random access to lines of a text file via memory-mapped offsets.
+    Lines are numbered from 0. The index is rebuilt when the file changes.
+    """
+    def __init__(self, path, rebuild=True):
+        self.path = path
+        if not self._is_fresh():
+            if not rebuild:
+                raise ValueError(f'index of {path} is missing or outdated')
+            build_index(path)
+        self._index_file = open(index_path(path), 'rb')
+        self._index_map = mmap.mmap(self._index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._header = memoryview(self._index_map).cast('Q')
+        self.n_lines = self._header[3]
+        self.offsets = self._header[HEADER_SIZE:HEADER_SIZE + self.n_lines + 1]
+        self._data_file = open(path, 'rb')
+        if self.offsets[-1]:
+            self._data_map = mmap.mmap(self._data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # mmap of an empty file is not allowed
+            self._data_map = b''
+
+    def _is_fresh(self):
+        try:
+            with open(index_path(self.path), 'rb') as f:
+                header = array('Q')
+                header.fromfile(f, HEADER_SIZE)
+        except (FileNotFoundError, EOFError):
+            return False
+        magic, size, mtime, _ = header
+        return magic == MAGIC and (size, mtime) == file_stamp(self.path)
+
+    def __len__(self):
+        return self.n_lines
+
+    def raw(self, i):
+        """ i-th line as bytes, including the newline """
+        if i < 0:
+            i += self.n_lines
+        if not 0 <= i < self.n_lines:
+            raise IndexError(f'line {i} out of range')
+        return self._data_map[self.offsets[i]:self.offsets[i + 1]]
+
+    def __getitem__(self, i):
+        return self.raw(i).decode('utf-8').rstrip('\n')
+
+    def range(self, start, stop):
+        """ lines start..stop-1 """
+        start, stop, _ = slice(start, stop).indices(self.n_lines)
+        for i in range(start, stop):
+            yield self[i]
+
+    def select(self, line_numbers):
+        """ yields (i, line) for given line numbers """
+        for i in line_numbers:
+            yield i, self[i]
+
+    def close(self):
+        self.offsets.release()
+        self._header.release()
+        if isinstance(self._data_map, mmap.mmap):
+            self._data_map.close()
+        self._index_map.close()
+        self._index_file.close()
+        self._data_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ParallelCorpus:
+    """ src/tgt pair of LineIndex, items are (src_line, tgt_line) """
+    def __init__(self, source_path, target_path, rebuild=True):
+        self.source = LineIndex(source_path, rebuild=rebuild)
+        self.target = LineIndex(target_path, rebuild=rebuild)
+        if len(self.source) != len(self.target):
+            raise ValueError(
+                f'{source_path} and {target_path} differ in length: '
+                f'{len(self.source)} vs {len(self.target)}'
+            )
+
+    def __len__(self):
+        return len(self.source)
+
+    def __getitem__(self, i):
+        return self.source[i], self.target[i]
+
+    def range(self, start, stop):
+        return zip(self.source.range(start, stop), self.target.range(start, stop))
+
+    def select(self, line_numbers):
+        for i in line_numbers:
+            yield i, self[i]
+
+    def close(self):
+        self.source.close()
+        self.target.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# one process watching train.log of all experiments in a folder,
+# replaces a wandb_runner.py --wait-for-logs process per training job
+#
+# cd experiments/en-to-36
+# nohup ../../envs/wandb_env/bin/python3 ../../scripts/log_watcher.py \
+#     --tags=cluster:$CLUSTER_NAME --infer-language-tags -d . &
+# LOG_WATCHER=1 ./run-experiment-set.sh ...
+#
+# Changes are noticed with inotify (inotify_simple package) if available,
+# otherwise the folders are polled.
+
+import argparse
+import asyncio
+import copy
+import fnmatch
+import os
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+import wandb_runner
+from wandb_runner import LogParser, StepCoalescer, WandbSink, JsonLinesSink
+
+
+def main():
+    args = parse_args()
+    watcher = LogWatcher(args)
+    asyncio.run(watcher.run())
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Watch logs of many experiments, send them to wandb')
+    parser.add_argument(
+        '--experiments-dir', '-d',
+        type=str,
+        default='.',
+        help='Folder with experiment folders',
+    )
+    parser.add_argument(
+        '--pattern', '-p',
+        type=str,
+        default='model_*',
+        help='Experiment folder name pattern',
+    )
+    parser.add_argument(
+        '--project-name',
+        default='multitarget-mt',
+        help='Project name to save at wandb',
+    )
+    parser.add_argument(
+        '--tags', '-t',
+        type=lambda s: s.split(','),
+        default=[],
+        help='Tag of the experiment: e.g. random, mono, wals, etc.'
+    )
+    parser.add_argument(
+        '--infer-language-tags', '-l',
+        action='store_const',
+        const=True,
+        default=False,
+        help='Infer languages from model name, save as tags'
+    )
+    parser.add_argument(
+        '--recent',
+        type=float,
+        default=3600.,
+        help='Logs modified less than this many seconds before start are watched, '
+             'older ones only when they change again',
+    )
+    parser.add_argument(
+        '--poll-interval',
+        type=float,
+        default=5.,
+        help='Seconds between scans when inotify is not available',
+    )
+    parser.add_argument(
+        '--flush-delay',
+        type=float,
+        default=30.,
+        help='Max. seconds to hold records of one step before sending them',
+    )
+    parser.add_argument(
+        '--sink-dir',
+        type=str,
+        default=None,
+        help='Write records to <sink-dir>/<experiment>.jsonl instead of wandb',
+    )
+    parser.add_argument(
+        '--no-inotify',
+        action='store_true',
+        help='Poll even if inotify is available',
+    )
+
+    args = parser.parse_args()
+    return args
+
+
+class Experiment:
+    """ one watched experiment folder: wandb run, log parser and emitter """
+    def __init__(self, experiment_dir, args):
+        self.experiment_dir = experiment_dir
+        self.name = os.path.basename(os.path.normpath(experiment_dir))
+        self.args = args
+        self.run = None
+        self.parser = None
+        self.emitter = None
+        self.starting = False
+        self.finished = False
+
+    def ready_to_start(self):
+        # wandb_runner reads the config marian writes at the start of the training
+        return os.path.exists(os.path.join(self.experiment_dir, 'model.npz.yml'))
+
+    def start(self):
+        """ blocking, runs in a worker thread """
+        resume = wandb_runner.get_run_id(self.experiment_dir) is not False
+        if self.args.sink_dir is None:
+            run_args = copy.copy(self.args)
+            run_args.experiment_dir = self.experiment_dir
+            self.run = wandb_runner.init_wandb(run_args, reinit='create_new')
+            sink = WandbSink(self.run)
+        else:
+            sink = JsonLinesSink(os.path.join(self.args.sink_dir, self.name + '.jsonl'))
+        self.parser = LogParser(self.experiment_dir, resume=resume)
+        self.emitter = StepCoalescer(sink, max_delay=self.args.flush_delay, timer=False)
+        print(f'{self.name}: watching')
+
+    def update(self):
+        """ processes new lines of the log, returns True if the training has finished """
+        for step, log_data in self.parser.poll():
+            self.emitter.add(step, log_data)
+        return self.parser.finished
+
+    def flush_if_old(self):
+        self.emitter.flush_if_old()
+
+    def stop(self):
+        """ blocking, runs in a worker thread """
+        self.finished = True
+        self.emitter.close()
+        self.parser.checkpoint()
+        self.parser.close()
+        if self.parser.finished:
+            print(f'{self.name}: training finished')
+            if self.run is not None:
+                wandb_runner.save_best_models(self.experiment_dir, self.run)
+        if self.run is not None:
+            self.run.finish()
+
+
+class LogWatcher:
+    def __init__(self, args):
+        self.args = args
+        self.root = args.experiments_dir
+        self.started = time.time()
+        self.experiments = {}
+        # folders that have changed since the last update
+        self.dirty = set()
+        self.changed = None
+        self.stopping = None
+        # wandb.init and uploads at the end are blocking
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.inotify = None
+        self.watches = {}
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.changed = asyncio.Event()
+        self.stopping = asyncio.Event()
+        for handled_signal in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(handled_signal, self.stopping.set)
+
+        if inotify_simple is not None and not self.args.no_inotify:
+            self.inotify = inotify_simple.INotify()
+            self._watch(self.root)
+            loop.add_reader(self.inotify.fd, self._read_events)
+            print('Using inotify')
+        else:
+            loop.create_task(self._poll())
+            print(f'Polling every {self.args.poll_interval}s')
+
+        self._scan(initial=True)
+        loop.create_task(self._flush_old_records())
+
+        while not self.stopping.is_set():
+            changed = asyncio.ensure_future(self.changed.wait())
+            stopping = asyncio.ensure_future(self.stopping.wait())
+            await asyncio.wait([changed, stopping], return_when=asyncio.FIRST_COMPLETED)
+            changed.cancel()
+            stopping.cancel()
+            self.changed.clear()
+            await self._update_dirty()
+
+        print('Stopping log watcher...')
+        if self.inotify is not None:
+            loop.remove_reader(self.inotify.fd)
+        for experiment in self.experiments.values():
+            if experiment.parser is not None and not experiment.finished:
+                await loop.run_in_executor(self.executor, experiment.stop)
+        # waits for experiments that finished just before
+        self.executor.shutdown()
+
+    def _watch(self, path):
+        flags = inotify_simple.flags
+        mask = flags.CREATE | flags.MODIFY | flags.MOVED_TO | flags.CLOSE_WRITE
+        try:
+            wd = self.inotify.add_watch(path, mask)
+        except OSError:
+            return
+        self.watches[wd] = path
+
+    def _read_events(self):
+        for event in self.inotify.read(timeout=0):
+            path = self.watches.get(event.wd)
+            if path is None:
+                continue
+            if path == self.root:
+                if fnmatch.fnmatch(event.name, self.args.pattern):
+                    self._add(os.path.join(self.root, event.name))
+            elif path in self.experiments:
+                self._mark(path)
+        self.changed.set()
+
+    async def _poll(self):
+        sizes = {}
+        while True:
+            await asyncio.sleep(self.args.poll_interval)
+            self._scan()
+            for experiment_dir in self.experiments:
+                try:
+                    stat = os.stat(os.path.join(experiment_dir, 'train.log'))
+                except FileNotFoundError:
+                    stat = None
+                signature = None if stat is None else (stat.st_size, stat.st_mtime, stat.st_ino)
+                if sizes.get(experiment_dir) != signature:
+                    sizes[experiment_dir] = signature
+                    self._mark(experiment_dir)
+            self.changed.set()
+
+    def _scan(self, initial=False):
+        for name in sorted(os.listdir(self.root)):
+            experiment_dir = os.path.join(self.root, name)
+            if fnmatch.fnmatch(name, self.args.pattern) and os.path.isdir(experiment_dir):
+                if experiment_dir not in self.experiments:
+                    self._add(experiment_dir, initial=initial)
+        self.changed.set()
+
+    def _add(self, experiment_dir, initial=False):
+        if experiment_dir in self.experiments or not os.path.isdir(experiment_dir):
+            return
+        self.experiments[experiment_dir] = Experiment(experiment_dir, self.args)
+        if self.inotify is not None:
+            self._watch(experiment_dir)
+        if not initial or self._recently_modified(experiment_dir):
+            self._mark(experiment_dir)
+
+    def _recently_modified(self, experiment_dir):
+        try:
+            mtime = os.stat(os.path.join(experiment_dir, 'train.log')).st_mtime
+        except FileNotFoundError:
+            return True
+        return mtime >= self.started - self.args.recent
+
+    def _mark(self, experiment_dir):
+        experiment = self.experiments.get(experiment_dir)
+        if experiment is not None and not experiment.finished:
+            self.dirty.add(experiment_dir)
+
+    async def _update_dirty(self):
+        loop = asyncio.get_running_loop()
+        dirty, self.dirty = self.dirty, set()
+        for experiment_dir in sorted(dirty):
+            experiment = self.experiments[experiment_dir]
+            if experiment.finished or experiment.starting:
+                continue
+            if experiment.parser is None:
+                if not experiment.ready_to_start():
+                    continue
+                experiment.starting = True
+                loop.create_task(self._start(experiment))
+                continue
+            if experiment.update():
+                experiment.finished = True
+                loop.run_in_executor(self.executor, experiment.stop)
+
+    async def _start(self, experiment):
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.executor, experiment.start)
+        finally:
+            experiment.starting = False
+        # parse what has been written so far
+        self._mark(experiment.experiment_dir)
+        self.changed.set()
+
+    async def _flush_old_records(self):
+        while True:
+            await asyncio.sleep(self.args.flush_delay)
+            for experiment in self.experiments.values():
+                if experiment.emitter is not None and not experiment.finished:
+                    experiment.flush_if_old()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# parsing of marian train.log / valid.log lines, shared by wandb_runner.py
+# and the offline tools (no wandb needed)
+
+from datetime import datetime
+
+
+def extract_time(log_line):
+    '''[dtime] remaining log line'''
+    dtime = datetime.strptime(log_line[1:20], "%Y-%m-%d %H:%M:%S")
+    return dtime, log_line[22:]
+
+
+def extract_is_validation(log_line):
+    '''
+    [valid] remaining_line -> True, remaining_line
+    log_line -> False, log_line
+    '''
+    validation = '[valid]'
+    if log_line[:len(validation)] == validation:
+        return True, log_line[len(validation):]
+    else: return False, log_line
+
+
+def is_training_log(log_line):
+    return log_line.find('Ep. ') >= 0
+
+
+TRAIN_LOG_PROCESSING = {
+    "Ep.": lambda s: ('train/epoch', int(s)),
+    "Up.": lambda s: ('step', int(s)),
+    "Sen.": lambda s: ('train/sentences', int(s.replace(',',''))),
+    "Cost": lambda s: ('train/loss', float(s)),
+    "Time": lambda s: ('train/time', float(s[:-1])),
+    "words/s": lambda s: ('train/speed', float(s)),
+    "L.r.": lambda s: ('train/learning_rate', float(s)),
+}
+
+
+def parse_train_log(line):
+    """ Ep. 2 : Up. 1000 : Sen. 311,824 : Cost 4.95877838 : Time 163.05s : 33655.40 words/s : L.r. 1.0000e-04 """
+    def process(log_line_chunk):
+        first, second = log_line_chunk.strip().split(' ')
+        try:
+            return TRAIN_LOG_PROCESSING[first](second)
+        except KeyError:
+            try:
+                return TRAIN_LOG_PROCESSING[second](first)
+            except KeyError:
+                return None
+    log_data = dict(
+        process(info_chunk)
+        for info_chunk
+        in line.split(':')
+        if info_chunk is not None
+    )
+    step = log_data['step']
+    del log_data['step']
+    return step, log_data
+
+
+def parse_val_log(line):
+    """ Ep. 26 : Up. 35000 : ce-mean-words : 1.63575 : new best """
+    line = line.split(':')
+    step = int(line[1].strip().split(' ')[1])
+    log_data = {}
+    metric_name = line[2].strip()
+    metric_value = float(line[3].strip())
+    if 'lang/' not in metric_name:
+        metric_name = 'valid/' + metric_name
+    log_data[metric_name] = metric_value
+
+    metric_stalled = line[4].strip()
+    if 'no effect' not in metric_stalled:
+        if 'stalled' in metric_stalled:
+            metric_stalled = int(metric_stalled.split()[1])
+        else:
+            metric_stalled = 0
+        log_data[metric_name+'_stalled'] = metric_stalled
+
+    return step, log_data
+
+
+def parse_translation_line(line):
+    """ [dtime] Best translation 0 : translation -> [0, translation] """
+    # cut time
+    line = line[line.find(']')+1:]
+    colon = line.find(':')
+    n = line[:colon]
+    translation = line[colon+1:]
+    n = int(n.strip().split(' ')[-1])
+    translation = translation.strip()
+    return [n, translation]
+
+
+def parse_translation_time(line):
+    """ [dtime] Total translation time: 16.56000s """
+    return float(line.strip().split(' ')[-1][:-1])
+
+
+def training_finished(line):
+    return "Training finished" in line
+
+
+def translation_begins(line):
+    return "Translating" in line
+
+
+def translation_ends(line):
+    return "Total translation time" in line
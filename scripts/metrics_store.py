@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+# columnar store (numpy .npz) of metrics from train.log, valid.log and results.tsv
+# of all experiments, for analyses without wandb
+#
+# cd experiments/en-to-36
+# ../../scripts/metrics_store.py update -d . -s metrics.npz
+#   ingests new lines of the logs (only the appended part is parsed)
+# ../../scripts/metrics_store.py final -s metrics.npz --metric lang/bleu
+#   last validation value of each model and target language with n_targets
+# ../../scripts/metrics_store.py query -s metrics.npz --model model_en2bg --metric train/loss
+#
+# python usage:
+#   store = MetricsStore('metrics.npz')
+#   rows = store.final('lang/bleu')
+#   rows['model'], rows['lang'], rows['n_targets'], rows['value']
+
+import argparse
+import fnmatch
+import json
+import os
+import re
+import sys
+import time
+
+import numpy as np
+
+from bulk_log_parser import parse_log, TRANSLATION_EXAMPLE
+
+SOURCES = ('train.log', 'valid.log', 'results.tsv')
+# categorical columns and the string table of each, code 0 is ''
+CATEGORIES = {
+    'model': 'models',
+    'lang': 'langs',
+    'metric': 'metrics',
+    'best_by': 'best_by_values',
+    'dataset': 'datasets',
+}
+COLUMNS = {
+    'model': np.int32,
+    'lang': np.int16,
+    'metric': np.int16,
+    'step': np.int64,
+    'value': np.float64,
+    'source': np.int8,
+    'best_by': np.int16,
+    'dataset': np.int32,
+}
+# rows are kept sorted by these columns
+SORT_ORDER = ('model', 'metric', 'lang', 'source', 'step')
+# step of test results (results.tsv)
+NO_STEP = -1
+# bytes of the file start saved to recognize the same file
+HEAD_SIZE = 1024
+# lang/bleu-ar -> lang/bleu, ar
+LANG_METRIC = re.compile(r'(lang/.+)-([a-z]{2,3})((?:_stalled)?)$')
+
+
+def main():
+    args = parse_args()
+    args.func(args)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Columnar store of training and test metrics')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    def add_store_argument(subparser):
+        subparser.add_argument(
+            '--store', '-s',
+            type=str,
+            default='metrics.npz',
+            help='Store file',
+        )
+
+    update = subparsers.add_parser('update', help='Ingest new lines of logs and results')
+    add_store_argument(update)
+    update.add_argument(
+        '--experiments-dir', '-d',
+        type=str,
+        default='.',
+        help='Folder with experiment folders',
+    )
+    update.add_argument(
+        '--pattern', '-p',
+        type=str,
+        default='model_*',
+        help='Experiment folder name pattern',
+    )
+    update.set_defaults(func=update_store)
+
+    final = subparsers.add_parser('final', help='Last value of a metric per model and language')
+    add_store_argument(final)
+    final.add_argument(
+        '--metric', '-m',
+        type=str,
+        default='lang/bleu',
+        help='Metric name, per-language metrics without the language suffix',
+    )
+    final.add_argument(
+        '--source',
+        type=str,
+        default='valid.log',
+        choices=SOURCES,
+        help='File the metric comes from',
+    )
+    final.set_defaults(func=print_final)
+
+    query = subparsers.add_parser('query', help='Print selected rows')
+    add_store_argument(query)
+    query.add_argument('--model', type=str, default=None, help='Model folder name')
+    query.add_argument('--lang', type=str, default=None, help='Target language')
+    query.add_argument('--metric', '-m', type=str, default=None, help='Metric name')
+    query.add_argument('--source', type=str, default=None, choices=SOURCES, help='File the rows come from')
+    query.set_defaults(func=print_query)
+
+    args = parser.parse_args()
+    return args
+
+
+def update_store(args):
+    start = time.time()
+    store = MetricsStore(args.store)
+    n_rows = store.update(args.experiments_dir, args.pattern)
+    store.save()
+    print(f'{n_rows} new rows, {len(store)} in total, {time.time() - start:.2f}s')
+
+
+def print_final(args):
+    start = time.time()
+    rows = MetricsStore(args.store).final(args.metric, source=args.source)
+    elapsed = time.time() - start
+    print('model\tlang\tn_targets\tstep\tvalue')
+    for row in zip(*(rows[column] for column in ('model', 'lang', 'n_targets', 'step', 'value'))):
+        print('\t'.join(str(value) for value in row))
+    print(f'{len(rows["model"])} rows in {elapsed * 1000:.1f}ms', file=sys.stderr)
+
+
+def print_query(args):
+    start = time.time()
+    rows = MetricsStore(args.store).select(
+        model=args.model, lang=args.lang, metric=args.metric, source=args.source,
+    )
+    elapsed = time.time() - start
+    columns = ('model', 'lang', 'metric', 'step', 'value', 'source', 'best_by', 'dataset')
+    print('\t'.join(columns))
+    for row in zip(*(rows[column] for column in columns)):
+        print('\t'.join(str(value) for value in row))
+    print(f'{len(rows["model"])} rows in {elapsed * 1000:.1f}ms', file=sys.stderr)
+
+
+def n_targets(model):
+    """ model_en2fres -> 2 """
+    target = model.split('_')[-1].split('2')[-1]
+    return len(target) // 2
+
+
+def split_metric(name):
+    """ lang/bleu-ar -> lang/bleu, ar; valid/translation -> valid/translation, '' """
+    match = LANG_METRIC.match(name)
+    if match is None:
+        return name, ''
+    metric, lang, suffix = match.groups()
+    return metric + suffix, lang
+
+
+class MetricsStore:
+    """
+    Rows (model, lang, metric, step, value, source, best_by, dataset) in numpy
+    columns, categorical columns are codes into string tables. Rows are sorted
+    by model, metric, language, source and step, so rows of one model are
+    found by binary search.
+
+    update() parses only the lines appended since the previous update; rows
+    of a file that was truncated or replaced are dropped and the file is
+    parsed again.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.tables = {table: [''] for table in CATEGORIES.values()}
+        self.columns = {column: np.zeros(0, dtype=dtype) for column, dtype in COLUMNS.items()}
+        # 'model/source' -> parser position
+        self.state = {}
+        if os.path.exists(path):
+            self._load()
+        self.codes = {
+            table: {value: code for code, value in enumerate(values)}
+            for table, values in self.tables.items()
+        }
+
+    def _load(self):
+        with np.load(self.path, allow_pickle=False) as data:
+            for table in CATEGORIES.values():
+                self.tables[table] = data['table_' + table].tolist()
+            for column in COLUMNS:
+                self.columns[column] = data[column]
+            self.state = json.loads(str(data['state']))
+
+    def save(self):
+        arrays = dict(self.columns)
+        for table, values in self.tables.items():
+            arrays['table_' + table] = np.array(values, dtype=str)
+        arrays['state'] = np.array(json.dumps(self.state))
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, self.path)
+
+    def __len__(self):
+        return len(self.columns['step'])
+
+    def code(self, column, value):
+        table = CATEGORIES[column]
+        codes = self.codes[table]
+        if value not in codes:
+            codes[value] = len(self.tables[table])
+            self.tables[table].append(value)
+        return codes[value]
+
+    def update(self, experiments_dir, pattern='model_*'):
+        """ returns number of new rows """
+        new_rows = {column: [] for column in COLUMNS}
+        for name in sorted(os.listdir(experiments_dir)):
+            experiment_dir = os.path.join(experiments_dir, name)
+            if not fnmatch.fnmatch(name, pattern) or not os.path.isdir(experiment_dir):
+                continue
+            for source, source_file in enumerate(SOURCES):
+                path = os.path.join(experiment_dir, source_file)
+                if os.path.exists(path):
+                    self._ingest(name, source, path, new_rows)
+
+        n_rows = len(new_rows['step'])
+        for column, dtype in COLUMNS.items():
+            self.columns[column] = np.concatenate([
+                self.columns[column], np.array(new_rows[column], dtype=dtype),
+            ])
+        order = np.lexsort([self.columns[column] for column in reversed(SORT_ORDER)])
+        self.columns = {column: values[order] for column, values in self.columns.items()}
+        return n_rows
+
+    def _ingest(self, model, source, path, new_rows):
+        key = f'{model}/{SOURCES[source]}'
+        with open(path, 'rb') as f:
+            state = self.state.get(key)
+            size = os.fstat(f.fileno()).st_size
+            if state is not None:
+                head = f.read(len(state['head'].encode('latin-1'))).decode('latin-1')
+                if size < state['offset'] or head != state['head']:
+                    self._drop(model, source)
+                    state = None
+            if state is None:
+                state = {'offset': 0, 'last_step': 0, 'translation': None}
+            if size == state['offset']:
+                return
+
+            if SOURCES[source] == 'results.tsv':
+                rows = self._parse_results(f, state)
+            else:
+                rows = self._parse_log(f, state, source)
+            model_code = self.code('model', model)
+            for metric, lang, step, value, best_by, dataset in rows:
+                new_rows['model'].append(model_code)
+                new_rows['lang'].append(self.code('lang', lang))
+                new_rows['metric'].append(self.code('metric', metric))
+                new_rows['step'].append(step)
+                new_rows['value'].append(value)
+                new_rows['source'].append(source)
+                new_rows['best_by'].append(self.code('best_by', best_by))
+                new_rows['dataset'].append(self.code('dataset', dataset))
+
+            f.seek(0)
+            state['head'] = f.read(min(state['offset'], HEAD_SIZE)).decode('latin-1')
+            self.state[key] = state
+
+    @staticmethod
+    def _parse_log(f, state, source):
+        result = parse_log(f, state['offset'], state['last_step'], state['translation'])
+        state['offset'] = result.offset
+        state['last_step'] = result.last_step
+        state['translation'] = result.translation
+        rows = []
+        for step, log_data in result.records:
+            for name, value in log_data.items():
+                if name == TRANSLATION_EXAMPLE:
+                    continue
+                # validation lines of train.log are repeated in valid.log
+                if SOURCES[source] == 'train.log' and not name.startswith('train/') \
+                        and name != 'valid/translation_time':
+                    continue
+                metric, lang = split_metric(name)
+                rows.append((metric, lang, step, value, '', ''))
+        return rows
+
+    @staticmethod
+    def _parse_results(f, state):
+        """ model, lang, best_by, dataset, bleu """
+        f.seek(state['offset'])
+        data = f.read()
+        data = data[:data.rfind(b'\n') + 1]
+        state['offset'] += len(data)
+        rows = []
+        for line in data.decode('utf-8').splitlines():
+            fields = line.split('\t')
+            if len(fields) != 5:
+                continue
+            _, lang, best_by, dataset, bleu = fields
+            rows.append(('test/bleu', lang, NO_STEP, float(bleu), best_by, dataset))
+        return rows
+
+    def _drop(self, model, source):
+        model_code = self.codes[CATEGORIES['model']].get(model)
+        if model_code is None:
+            return
+        keep = (self.columns['model'] != model_code) | (self.columns['source'] != source)
+        self.columns = {column: values[keep] for column, values in self.columns.items()}
+
+    def _rows(self, model=None, lang=None, metric=None, source=None):
+        """ indexes of matching rows """
+        columns = self.columns
+        if model is None:
+            start, end = 0, len(self)
+        else:
+            model_code = self.codes[CATEGORIES['model']].get(model)
+            if model_code is None:
+                return np.zeros(0, dtype=np.int64)
+            # rows are sorted by model
+            start, end = np.searchsorted(columns['model'], [model_code, model_code + 1])
+        mask = np.ones(end - start, dtype=bool)
+        for column, value in (('lang', lang), ('metric', metric)):
+            if value is not None:
+                code = self.codes[CATEGORIES[column]].get(value)
+                if code is None:
+                    return np.zeros(0, dtype=np.int64)
+                mask &= columns[column][start:end] == code
+        if source is not None:
+            mask &= columns['source'][start:end] == SOURCES.index(source)
+        return start + np.flatnonzero(mask)
+
+    def select(self, model=None, lang=None, metric=None, source=None):
+        """ matching rows as dict column -> array, categorical columns as strings """
+        rows = self._rows(model, lang, metric, source)
+        result = {}
+        for column in COLUMNS:
+            values = self.columns[column][rows]
+            if column in CATEGORIES:
+                values = np.array(self.tables[CATEGORIES[column]], dtype=str)[values]
+            elif column == 'source':
+                values = np.array(SOURCES)[values]
+            result[column] = values
+        return result
+
+    def final(self, metric, source='valid.log'):
+        """
+        Value at the last step of each model and language as dict column -> array
+        (model, lang, n_targets, step, value)
+        """
+        rows = self._rows(metric=metric, source=source)
+        columns = self.columns
+        model = columns['model'][rows]
+        lang = columns['lang'][rows]
+        # rows of each (model, lang) are sorted by step, the last one is the final value
+        is_last = np.ones(len(rows), dtype=bool)
+        is_last[:-1] = (model[1:] != model[:-1]) | (lang[1:] != lang[:-1])
+        rows = rows[is_last]
+
+        models = np.array(self.tables['models'], dtype=str)[columns['model'][rows]]
+        return {
+            'model': models,
+            'lang': np.array(self.tables['langs'], dtype=str)[columns['lang'][rows]],
+            'n_targets': np.array([n_targets(model) for model in models], dtype=np.int32),
+            'step': columns['step'][rows],
+            'value': columns['value'][rows],
+        }
+
+
+if __name__ == '__main__':
+    main()
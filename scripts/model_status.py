@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# index of the state of the trainings in an experiments folder
+#
+# cd experiments/en-to-36
+# ../../scripts/model_status.py list
+#   model, state, last step and best validation metrics of each model_* folder
+# ../../scripts/model_status.py list --state converged --finished-line
+#   converged models with their 'Training finished' line (as converged_models.sh)
+# ../../scripts/model_status.py state model_en2bg
+#   prints converged, running, locked, failed or new
+#
+# python usage:
+#   index = StatusIndex('experiments/en-to-36')
+#   status = index.update()['model_en2bg']
+#   status['state'], status['last_step'], status['best']
+#
+# States:
+#   converged  train.log has 'Training finished'
+#   running    locks/<src>2<tgts>.lock exists and train.log grows
+#   locked     the lock exists, train.log did not change for --stale seconds
+#              (waiting for data or a GPU, or hanging)
+#   failed     train.log without the lock and unfinished (killed, time limit, error)
+#   new        neither train.log nor the lock
+#
+# The index (.model_status.json) keeps the offset of each train.log, only
+# appended bytes are read when it is updated. A log which is shorter or has
+# a different beginning than before is read again from the start. Concurrent
+# updates replace the file atomically; a lost update is only read again.
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+from bulk_log_parser import TIME_PREFIX, VALID_LINE
+
+INDEX_FILE = '.model_status.json'
+LOCKS_DIR = 'locks'
+# bytes of the file start saved to recognize the same file
+HEAD_SIZE = 1024
+# seconds without a change of train.log after which a locked training is not running
+DEFAULT_STALE_SECONDS = 1800
+UPDATE = re.compile(r' Up\. (\d+) :')
+STATES = ('converged', 'running', 'locked', 'failed', 'new')
+
+
+def main():
+    args = parse_args()
+    args.func(args)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='State of the trainings of an experiments folder')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    def add_index_arguments(subparser):
+        subparser.add_argument(
+            '--experiments-dir', '-d',
+            type=str,
+            default='.',
+            help='Folder with model_* folders',
+        )
+        subparser.add_argument(
+            '--stale',
+            type=float,
+            default=DEFAULT_STALE_SECONDS,
+            help='Seconds without a change of train.log to consider a locked training not running',
+        )
+
+    listing = subparsers.add_parser('list', help='Status of all models')
+    add_index_arguments(listing)
+    listing.add_argument('--state', '-s', choices=STATES, default=None, help='Only models in this state')
+    listing.add_argument(
+        '--finished-line',
+        action='store_true',
+        help="Print the 'Training finished' line instead of the status",
+    )
+    listing.set_defaults(func=list_models)
+
+    state = subparsers.add_parser('state', help='State of one model')
+    add_index_arguments(state)
+    state.add_argument('model', help='model_<src>2<tgts> folder')
+    state.set_defaults(func=print_state)
+
+    args = parser.parse_args()
+    return args
+
+
+def new_entry():
+    return {
+        'offset': 0,
+        'head': '',
+        'size': 0,
+        'mtime': 0.,
+        'last_step': 0,
+        'finished_line': None,
+        'best': {},
+    }
+
+
+def same_start(head, saved_head):
+    """ one is the beginning of the other, the saved one may be of a shorter file """
+    length = min(len(head), len(saved_head))
+    return head[:length] == saved_head[:length]
+
+
+def scan(entry, data):
+    """ updates the entry by complete lines of data """
+    for line in data.decode('utf-8', errors='replace').split('\n'):
+        if TIME_PREFIX.match(line) is None:
+            continue
+        rest = line[22:]
+        if 'Training finished' in rest:
+            entry['finished_line'] = line
+            continue
+        update = UPDATE.search(rest)
+        if update is None:
+            continue
+        entry['last_step'] = int(update.group(1))
+        if not rest.startswith('[valid]'):
+            continue
+        match = VALID_LINE.match(rest)
+        if match is None:
+            continue
+        _, metric, value, stalled = (group.strip() for group in match.groups())
+        try:
+            value = float(value)
+        except ValueError:
+            continue
+        best = entry['best']
+        if 'new best' in stalled:
+            # marked by marian for the early stopping metrics
+            best[metric] = value
+        elif 'no effect' in stalled and (metric not in best or value > best[metric]):
+            # lang/bleu-xx of validate.py, higher is better
+            best[metric] = value
+
+
+class StatusIndex:
+    def __init__(self, experiments_dir, stale=DEFAULT_STALE_SECONDS):
+        self.experiments_dir = experiments_dir
+        self.stale = stale
+        self.path = os.path.join(experiments_dir, INDEX_FILE)
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+
+    def models(self):
+        return sorted(
+            name for name in os.listdir(self.experiments_dir)
+            if name.startswith('model_') and os.path.isdir(os.path.join(self.experiments_dir, name))
+        )
+
+    def _read_log(self, model):
+        """ reads the appended part of train.log, returns its mtime or None without the log """
+        path = os.path.join(self.experiments_dir, model, 'train.log')
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            self.entries.pop(model, None)
+            return None
+        with f:
+            stat = os.fstat(f.fileno())
+            entry = self.entries.get(model)
+            if entry is not None and (entry['size'], entry['mtime']) == (stat.st_size, stat.st_mtime):
+                return stat.st_mtime
+            head = f.read(HEAD_SIZE).decode('utf-8', errors='replace')
+            if entry is None or stat.st_size < entry['offset'] or not same_start(head, entry['head']):
+                # new, truncated or replaced by another log
+                entry = new_entry()
+            f.seek(entry['offset'])
+            data = f.read()
+            # the incomplete last line is left for the next update
+            data = data[:data.rfind(b'\n') + 1]
+            scan(entry, data)
+            entry['offset'] += len(data)
+            entry['head'] = head
+            entry['size'] = stat.st_size
+            entry['mtime'] = stat.st_mtime
+            self.entries[model] = entry
+        return stat.st_mtime
+
+    def _lock_path(self, model):
+        """ model_en2bgru -> locks/en2bgru.lock (utils.sh create_lock) """
+        return os.path.join(self.experiments_dir, LOCKS_DIR, model[len('model_'):] + '.lock')
+
+    def status(self, model, now=None):
+        now = time.time() if now is None else now
+        mtime = self._read_log(model)
+        entry = self.entries.get(model) or new_entry()
+        locked = os.path.exists(self._lock_path(model))
+        if entry['finished_line'] is not None:
+            state = 'converged'
+        elif locked:
+            state = 'running' if mtime is not None and now - mtime < self.stale else 'locked'
+        elif mtime is not None:
+            state = 'failed'
+        else:
+            state = 'new'
+        return {
+            'state': state,
+            'last_step': entry['last_step'],
+            'best': entry['best'],
+            'finished_line': entry['finished_line'],
+        }
+
+    def update(self, models=None):
+        """ model -> status of the given (by default all) models, saves the index """
+        now = time.time()
+        result = {model: self.status(model, now) for model in (models or self.models())}
+        self.save()
+        return result
+
+    def save(self):
+        tmp_path = f'{self.path}.tmp.{os.getpid()}'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            # the index is only a cache of the logs
+            print(f'{self.path} not saved: {e}', file=sys.stderr)
+
+
+def format_best(best):
+    return ','.join(f'{metric}={value:g}' for metric, value in sorted(best.items()))
+
+
+def list_models(args):
+    statuses = StatusIndex(args.experiments_dir, args.stale).update()
+    for model, status in statuses.items():
+        if args.state is not None and status['state'] != args.state:
+            continue
+        if args.finished_line:
+            if status['finished_line'] is not None:
+                print(f'{model} {status["finished_line"]}')
+        else:
+            print(f'{model}\t{status["state"]}\t{status["last_step"]}\t{format_best(status["best"])}')
+
+
+def print_state(args):
+    model = os.path.basename(os.path.normpath(args.model))
+    print(StatusIndex(args.experiments_dir, args.stale).update([model])[model]['state'])
+
+
+if __name__ == '__main__':
+    main()
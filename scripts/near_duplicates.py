@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# lines of the train corpus with a source sentence similar to a test sentence
+# (MinHash-LSH), catches near duplicates that overlap_index.py does not
+#
+# ./near_duplicates.py --train raw/train/corpus.multi.bpe.src --threshold 0.7 \
+#     --output interim/near_overlap_test_in_train $(find ./raw/test/ -name '*.bpe.en')
+#   sorted 1-based train line numbers, one per line (as interim/overlap_test_in_train)
+#
+# python usage:
+#   index = MinHashIndex('raw/train/corpus.multi.bpe.src', jobs=8)
+#   lines = index.lookup(signatures(test_lines, index.permutations), threshold=0.7)
+#
+# Sentences are BPE-merged and normalized as in overlap_index.py; a sentence
+# is the set of its words and word bigrams. MinHash signatures (--permutations
+# uint32 values per sentence) of the train corpus are computed in parallel
+# chunks straight into a .npy file, and split into bands whose hashes are
+# sorted per band. Everything is kept in the <corpus>.minhash folder and
+# memory-mapped, until the corpus or the parameters change. A test sentence
+# is looked up by searchsorted of its band hashes; the candidates sharing a
+# band are kept if the estimated Jaccard similarity (share of equal
+# signature values) is at least --threshold. The number of bands is chosen
+# so that the LSH threshold (1/bands)^(1/rows) is close to --threshold.
+
+import argparse
+import json
+import os
+import sys
+import zlib
+from multiprocessing import Pool
+
+import numpy as np
+
+from line_index import LineIndex
+from overlap_index import chunks, file_stamp, normalize, read_file, read_lines, write_lines
+
+INDEX_SUFFIX = '.minhash'
+DEFAULT_PERMUTATIONS = 64
+DEFAULT_THRESHOLD = 0.7
+# lines hashed at once by one process
+BATCH_LINES = 10000
+SEED = 1
+MIX = np.uint64(0x9E3779B97F4A7C15)
+
+
+def main():
+    args = parse_args()
+    index = MinHashIndex(args.train, args.permutations, args.threshold, args.jobs)
+    matches = []
+    for path in args.test:
+        lines = index.lookup(signatures(read_file(path), index.permutations), args.threshold)
+        print(f'{path}: {len(lines)} train lines', file=sys.stderr)
+        matches.append(lines)
+    lines = np.unique(np.concatenate(matches)) if matches else np.empty(0, np.int64)
+    write_lines(lines, args.output)
+    print(f'{len(lines)} train lines in {len(args.test)} test files', file=sys.stderr)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Train lines with sentences similar to test sets')
+    parser.add_argument('test', nargs='*', help='Test (or dev) source files')
+    parser.add_argument('--train', '-t', type=str, required=True, help='Train source corpus')
+    parser.add_argument(
+        '--output', '-o',
+        type=str,
+        default=None,
+        help='File for the line numbers, stdout by default',
+    )
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help='Min. estimated Jaccard similarity of words and bigrams',
+    )
+    parser.add_argument(
+        '--permutations',
+        type=int,
+        default=DEFAULT_PERMUTATIONS,
+        help='Length of the signatures (changes rebuild the index)',
+    )
+    parser.add_argument(
+        '--jobs', '-j',
+        type=int,
+        default=os.cpu_count(),
+        help='Number of processes hashing the train corpus',
+    )
+
+    args = parser.parse_args()
+    return args
+
+
+def shingles(line):
+    """ crc32 of the words and word bigrams of a BPE-merged normalized line """
+    words = normalize(line.replace('@@ ', '').replace('@@', '')).split()
+    items = words + [f'{first} {second}' for first, second in zip(words, words[1:])]
+    return [zlib.crc32(item.encode('utf-8')) for item in items] or [0]
+
+
+def permutation_parameters(permutations):
+    """ odd multipliers and offsets of the multiply-shift hashes """
+    random = np.random.RandomState(SEED)
+    multipliers = random.randint(0, 2**63, size=permutations, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    offsets = random.randint(0, 2**63, size=permutations, dtype=np.uint64)
+    return multipliers, offsets
+
+
+def signatures(lines, permutations):
+    """ (len(lines), permutations) uint32 MinHash signatures """
+    multipliers, offsets = permutation_parameters(permutations)
+    result = np.empty((len(lines), permutations), dtype=np.uint32)
+    for start in range(0, len(lines), BATCH_LINES):
+        batch = [shingles(line) for line in lines[start:start + BATCH_LINES]]
+        values = np.fromiter((h for items in batch for h in items), dtype=np.uint64)
+        starts = np.cumsum([0] + [len(items) for items in batch[:-1]])
+        for p in range(permutations):
+            # uint64 arithmetic wraps around, the upper 32 bits are the hash
+            hashed = (values * multipliers[p] + offsets[p]) >> np.uint64(32)
+            result[start:start + len(batch), p] = np.minimum.reduceat(hashed, starts)
+    return result
+
+
+def choose_bands(permutations, threshold):
+    """ number of bands (dividing permutations) with the LSH threshold closest to threshold """
+    return min(
+        (bands for bands in range(1, permutations + 1) if permutations % bands == 0),
+        key=lambda bands: abs((1 / bands) ** (bands / permutations) - threshold),
+    )
+
+
+def band_key(signature_rows, band, rows):
+    """ uint64 hashes of one band (rows columns) of the signatures """
+    key = np.full(len(signature_rows), band, dtype=np.uint64)
+    for column in range(band * rows, (band + 1) * rows):
+        key = (key ^ signature_rows[:, column].astype(np.uint64)) * MIX
+    return key
+
+
+def band_keys(signature_rows, bands):
+    """ (bands, n) uint64 hashes of the bands of the signatures """
+    rows = signature_rows.shape[1] // bands
+    return np.stack([band_key(signature_rows, band, rows) for band in range(bands)])
+
+
+def signature_chunk(path, start, stop, permutations, signatures_path):
+    """ writes signatures of lines start..stop-1 into the shared .npy file """
+    output = np.load(signatures_path, mmap_mode='r+')
+    output[start:stop] = signatures(read_lines(path, start, stop), permutations)
+    output.flush()
+    del output
+
+
+class MinHashIndex:
+    """ MinHash signatures and sorted LSH band hashes of the lines of a corpus """
+    def __init__(self, path, permutations=DEFAULT_PERMUTATIONS, threshold=DEFAULT_THRESHOLD, jobs=1):
+        self.path = path
+        self.permutations = permutations
+        self.bands = choose_bands(permutations, threshold)
+        self.directory = path + INDEX_SUFFIX
+        self.parameters = {
+            'stamp': file_stamp(path).tolist(),
+            'permutations': permutations,
+        }
+        if self._saved_parameters() != self.parameters:
+            self._build_signatures(jobs)
+        self.signatures = np.load(self._file('signatures.npy'), mmap_mode='r')
+        # bands of another threshold are kept next to these
+        if not os.path.exists(self._file(f'band_lines.{self.bands}.npy')):
+            self._build_bands()
+        self.keys = np.load(self._file(f'band_keys.{self.bands}.npy'), mmap_mode='r')
+        self.lines = np.load(self._file(f'band_lines.{self.bands}.npy'), mmap_mode='r')
+
+    def _file(self, name):
+        return os.path.join(self.directory, name)
+
+    def _saved_parameters(self):
+        try:
+            with open(self._file('parameters.json')) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _build_signatures(self, jobs):
+        if os.path.isdir(self.directory):
+            # signatures and bands of the previous corpus or parameters
+            for name in os.listdir(self.directory):
+                os.remove(self._file(name))
+        os.makedirs(self.directory, exist_ok=True)
+        with LineIndex(self.path) as index:
+            n_lines = len(index)
+        signatures_path = self._file('signatures.npy')
+        np.lib.format.open_memmap(
+            signatures_path, mode='w+', dtype=np.uint32, shape=(n_lines, self.permutations),
+        ).flush()
+        tasks = [
+            (self.path, start, stop, self.permutations, signatures_path)
+            for start, stop in chunks(n_lines)
+        ]
+        if jobs == 1 or len(tasks) <= 1:
+            for task in tasks:
+                signature_chunk(*task)
+        else:
+            with Pool(jobs) as pool:
+                pool.starmap(signature_chunk, tasks)
+        # written last, an interrupted build is not used
+        with open(self._file('parameters.json'), 'w') as f:
+            json.dump(self.parameters, f)
+
+    def _build_bands(self):
+        n_lines = len(self.signatures)
+        rows = self.permutations // self.bands
+        keys = np.lib.format.open_memmap(
+            self._file(f'band_keys.{self.bands}.npy.tmp'), mode='w+',
+            dtype=np.uint64, shape=(self.bands, n_lines),
+        )
+        lines = np.lib.format.open_memmap(
+            self._file(f'band_lines.{self.bands}.npy.tmp'), mode='w+',
+            dtype=np.uint32 if n_lines < 2**32 else np.uint64, shape=(self.bands, n_lines),
+        )
+        for band in range(self.bands):
+            key = band_key(self.signatures, band, rows)
+            order = np.argsort(key, kind='stable')
+            keys[band] = key[order]
+            lines[band] = order
+        keys.flush()
+        lines.flush()
+        del keys, lines
+        os.replace(self._file(f'band_keys.{self.bands}.npy.tmp'), self._file(f'band_keys.{self.bands}.npy'))
+        # lines are checked for existence, renamed last
+        os.replace(self._file(f'band_lines.{self.bands}.npy.tmp'), self._file(f'band_lines.{self.bands}.npy'))
+
+    def candidates(self, query_keys):
+        """ (query, line) pairs sharing a band hash, lines are 0-based """
+        queries, lines = [], []
+        for band in range(self.bands):
+            keys = self.keys[band]
+            left = np.searchsorted(keys, query_keys[band], side='left')
+            right = np.searchsorted(keys, query_keys[band], side='right')
+            counts = right - left
+            starts = np.repeat(left - np.cumsum(counts) + counts, counts)
+            queries.append(np.repeat(np.arange(len(counts)), counts))
+            lines.append(self.lines[band][starts + np.arange(counts.sum())].astype(np.int64))
+        pairs = np.unique(np.stack([np.concatenate(queries), np.concatenate(lines)]), axis=1)
+        return pairs[0], pairs[1]
+
+    def lookup(self, query_signatures, threshold=DEFAULT_THRESHOLD):
+        """ 1-based line numbers (sorted) of lines similar to any of the queries """
+        if not len(query_signatures):
+            return np.empty(0, np.int64)
+        queries, lines = self.candidates(band_keys(query_signatures, self.bands))
+        similarity = (self.signatures[lines] == query_signatures[queries]).mean(axis=1)
+        return np.unique(lines[similarity >= threshold]) + 1
+
+
+if __name__ == '__main__':
+    main()
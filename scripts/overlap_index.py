@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# lines of the train corpus whose source sentence is in a test set
+# (the train lines mark_known_sentences --preproc=droptags,lc,digits reports)
+#
+# ./overlap_index.py --train raw/train/corpus.multi.bpe.src \
+#     --output interim/overlap_test_in_train $(find ./raw/test/ -name '*.bpe.en')
+#   sorted 1-based train line numbers, one per line
+#
+# python usage:
+#   index = OverlapIndex('raw/train/corpus.multi.bpe.src', jobs=8)
+#   lines = index.lookup(*hash_lines(test_lines))   # 1-based train line numbers
+#
+# As in mark_known_sentences, a test sentence matches the train sentences
+# equal to it after trimming whitespace; only if there are none, it matches
+# the ones equal after normalization (tags <...> dropped, lowercased, digits
+# replaced by 0, whitespace squeezed). Both forms are hashed to 64 bits,
+# the hashes of the train sentences are sorted with their line numbers and
+# saved next to the corpus (.overlap.npz); they are computed in parallel
+# chunks of lines given by the line_index.py index and only again when the
+# corpus changes. Test files are matched by searchsorted; the matches of
+# each test file are kept in --cache-dir, so a new test set costs only its
+# own hashing.
+
+import argparse
+import hashlib
+import os
+import re
+import sys
+from multiprocessing import Pool
+
+import numpy as np
+
+from line_index import LineIndex
+
+INDEX_SUFFIX = '.overlap.npz'
+CHUNK_LINES = 1000000
+# matches of cached test files computed differently are recomputed
+CACHE_VERSION = 2
+# the patterns of mark_known_sentences: droptags, digits (ASCII) and \h
+TAG = re.compile(r'<[^>]*>')
+DIGIT = re.compile(r'[0-9]')
+SPACE = re.compile(r'[\t \xa0\u1680\u180e\u2000-\u200a\u202f\u205f\u3000]+')
+
+
+def main():
+    args = parse_args()
+    index = OverlapIndex(args.train, args.jobs)
+    matches = [
+        index.lookup_file(path, args.cache_dir)
+        for path in args.test
+    ]
+    lines = np.unique(np.concatenate(matches)) if matches else np.empty(0, np.int64)
+    write_lines(lines, args.output)
+    print(f'{len(lines)} train lines in {len(args.test)} test files', file=sys.stderr)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Train lines with sentences of test sets')
+    parser.add_argument('test', nargs='*', help='Test (or dev) source files')
+    parser.add_argument('--train', '-t', type=str, required=True, help='Train source corpus')
+    parser.add_argument(
+        '--output', '-o',
+        type=str,
+        default=None,
+        help='File for the line numbers, stdout by default',
+    )
+    parser.add_argument(
+        '--cache-dir',
+        type=str,
+        default=None,
+        help='Folder with matches of each test file; by default next to --output',
+    )
+    parser.add_argument(
+        '--jobs', '-j',
+        type=int,
+        default=os.cpu_count(),
+        help='Number of processes hashing the train corpus',
+    )
+
+    args = parser.parse_args()
+    if args.cache_dir is None and args.output is not None:
+        args.cache_dir = args.output + '.cache'
+    return args
+
+
+def trim(line):
+    """ the first tab separated column, horizontal whitespace stripped and squeezed """
+    return SPACE.sub(' ', line.split('\t', 1)[0]).strip(' ')
+
+
+def normalize(line):
+    """ droptags, lc, digits """
+    line = trim(TAG.sub(' ', trim(line)))
+    return DIGIT.sub('0', line.lower())
+
+
+def line_hash(line):
+    return int.from_bytes(hashlib.blake2b(line.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def hash_lines(lines):
+    """ uint64 hashes of the trimmed and of the normalized lines """
+    exact_hashes = np.empty(len(lines), dtype=np.uint64)
+    hashes = np.empty(len(lines), dtype=np.uint64)
+    for i, line in enumerate(lines):
+        line = trim(line)
+        exact_hashes[i] = line_hash(line)
+        hashes[i] = line_hash(normalize(line))
+    return exact_hashes, hashes
+
+
+def read_lines(path, start, stop, errors='replace'):
+    """ lines start..stop-1 of an indexed file """
+    with LineIndex(path) as index:
+        begin, end = index.offsets[start], index.offsets[stop]
+    with open(path, 'rb') as f:
+        f.seek(begin)
+        data = f.read(end - begin)
+    return data.decode('utf-8', errors=errors).split('\n')[:stop - start]
+
+
+def read_file(path):
+    with open(path, encoding='utf-8', errors='replace') as f:
+        return [line.rstrip('\n') for line in f]
+
+
+def hash_chunk(path, start, stop):
+    return hash_lines(read_lines(path, start, stop))
+
+
+def chunks(n_lines, chunk_lines=CHUNK_LINES):
+    return [(start, min(start + chunk_lines, n_lines)) for start in range(0, n_lines, chunk_lines)]
+
+
+def file_stamp(path):
+    stat = os.stat(path)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def hash_file(path, jobs):
+    """ exact and normalized hashes of all lines of a (large) file, computed in parallel chunks """
+    with LineIndex(path) as index:
+        n_lines = len(index)
+    parts = chunks(n_lines)
+    if jobs == 1 or len(parts) <= 1:
+        hashes = [hash_chunk(path, start, stop) for start, stop in parts]
+    else:
+        with Pool(jobs) as pool:
+            hashes = pool.starmap(hash_chunk, [(path, start, stop) for start, stop in parts])
+    if not hashes:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.uint64)
+    return tuple(np.concatenate(part) for part in zip(*hashes))
+
+
+def sorted_hashes(hashes):
+    """ sorted hashes and their 1-based line numbers """
+    order = np.argsort(hashes, kind='stable')
+    return hashes[order], (order + 1).astype(np.uint32 if len(order) < 2**32 else np.uint64)
+
+
+def find(sorted_hashes, lines, hashes):
+    """ line numbers of the lines with any of the hashes """
+    hashes = np.unique(hashes)
+    left = np.searchsorted(sorted_hashes, hashes, side='left')
+    right = np.searchsorted(sorted_hashes, hashes, side='right')
+    counts = right - left
+    # indexes left[i]..right[i]-1 of all found hashes
+    starts = np.repeat(left - np.cumsum(counts) + counts, counts)
+    positions = starts + np.arange(counts.sum())
+    return lines[positions].astype(np.int64)
+
+
+class OverlapIndex:
+    """
+    sorted hashes of the trimmed and of the normalized lines of a corpus
+    and their 1-based line numbers
+    """
+    def __init__(self, path, jobs=1):
+        self.path = path
+        stamp = file_stamp(path)
+        try:
+            with np.load(path + INDEX_SUFFIX) as saved:
+                if np.array_equal(saved['stamp'], stamp):
+                    self.exact_hashes, self.exact_lines = saved['exact_hashes'], saved['exact_lines']
+                    self.hashes, self.lines = saved['hashes'], saved['lines']
+                    return
+        except (FileNotFoundError, KeyError, ValueError):
+            pass
+        exact_hashes, hashes = hash_file(path, jobs)
+        self.exact_hashes, self.exact_lines = sorted_hashes(exact_hashes)
+        self.hashes, self.lines = sorted_hashes(hashes)
+        tmp_path = f'{path}{INDEX_SUFFIX}.tmp.{os.getpid()}.npz'
+        np.savez(
+            tmp_path, stamp=stamp,
+            exact_hashes=self.exact_hashes, exact_lines=self.exact_lines,
+            hashes=self.hashes, lines=self.lines,
+        )
+        os.replace(tmp_path, path + INDEX_SUFFIX)
+
+    def lookup(self, exact_hashes, hashes):
+        """
+        1-based line numbers (sorted) of the matches of test lines given by
+        their exact and normalized hashes: the exact matches of a test line,
+        its normalized matches if it has none
+        """
+        left = np.searchsorted(self.exact_hashes, exact_hashes, side='left')
+        right = np.searchsorted(self.exact_hashes, exact_hashes, side='right')
+        exact = right > left
+        lines = np.concatenate([
+            find(self.exact_hashes, self.exact_lines, exact_hashes[exact]),
+            find(self.hashes, self.lines, hashes[~exact]),
+        ])
+        return np.unique(lines)
+
+    def lookup_file(self, path, cache_dir=None):
+        """ matches of the lines of a file, cached by its size and mtime """
+        if cache_dir is None:
+            return self.lookup(*hash_lines(read_file(path)))
+        name = hashlib.sha256(os.path.abspath(path).encode('utf-8')).hexdigest()
+        cache_path = os.path.join(cache_dir, name + '.npz')
+        stamp = np.concatenate([file_stamp(path), file_stamp(self.path), [CACHE_VERSION]])
+        try:
+            with np.load(cache_path) as saved:
+                if np.array_equal(saved['stamp'], stamp):
+                    return saved['lines']
+        except (FileNotFoundError, KeyError, ValueError):
+            pass
+        lines = self.lookup(*hash_lines(read_file(path)))
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f'{cache_path}.tmp.{os.getpid()}.npz'
+        np.savez(tmp_path, stamp=stamp, lines=lines)
+        os.replace(tmp_path, cache_path)
+        return lines
+
+
+def write_lines(lines, output):
+    text = ''.join(f'{n}\n' for n in lines.tolist())
+    if output is None:
+        sys.stdout.write(text)
+        return
+    tmp_path = f'{output}.tmp.{os.getpid()}'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, output)
+
+
+if __name__ == '__main__':
+    main()
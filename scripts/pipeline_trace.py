@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+# timeline of the pipeline stages of each model, rebuilt from the logs
+#
+# cd experiments/en-to-36
+# ../../scripts/pipeline_trace.py --trace trace.json
+#   summary table on stdout, trace.json opens in chrome://tracing or ui.perfetto.dev
+# ../../scripts/pipeline_trace.py --pattern 'model_en2bg*' --run-logs run_logs logs
+#
+# Sources:
+#   model_*/train.log    startup, training, saving, validation (translation of
+#                        the validation set and validate.sh), words/s
+#   model_*/valid.log    validate.sh results missing in older train.logs
+#   run_logs/, logs/     'Job submitted/started/finished: <time>' lines of the
+#                        SGE jobs (run-marian.sh) and 'Data preparation of
+#                        en2xx started/finished: <time>' (prepare_data.sh)
+#   test_results/logs/   marian-server log of each tested decoder
+#
+# Stages follow the train.log lines: Saving lines start a save, 'Translating
+# validation set' to the last [valid] line of the step is the validation, in
+# which 'Total translation time' ends the translation and the first [valid]
+# line after it ends validate.sh. The GPU is idle while validate.sh runs, the
+# summary gives its share of the validation time. Times have the one-second
+# resolution of the logs; a restarted training adds a new startup.
+
+import argparse
+import fnmatch
+import json
+import os
+import re
+from datetime import datetime
+from multiprocessing import Pool
+
+from bulk_log_parser import TIME_PREFIX, TRAIN_LINE
+
+# stage -> thread of the model's process in the trace
+LANES = {
+    'sge': 1,
+    'data': 2,
+    'startup': 3,
+    'training': 3,
+    'saving': 3,
+    'validation': 3,
+    'translation': 4,
+    'validate.sh': 4,
+    'test': 5,
+}
+LANE_NAMES = {1: 'SGE', 2: 'data', 3: 'marian', 4: 'validation', 5: 'test'}
+JOB_LINE = re.compile(r'^Job (submitted|started|finished): (\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)')
+DATA_LINE = re.compile(r'^Data preparation of (\S+) (started|finished): (\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)')
+# run_logs/en2bg.o123 (run-marian.sh), run_logs/pr_en2bg.o124 (prepare_data.sh)
+JOB_FILE = re.compile(r'^(?:pr_)?(\w+2\w+)\.o(\d+)')
+# test_results/logs/model_en2bg_model.npz.best-translation.npz.decoder.yml.log
+TEST_FILE = re.compile(r'^(model_\w+?)_model\.npz')
+# share of train lines at the beginning and the end compared in the words/s trend
+TREND_SHARE = 0.1
+
+
+def main():
+    args = parse_args()
+    models = find_models(args.experiments_dir, args.pattern)
+    with Pool(max(1, min(args.jobs, len(models)))) as pool:
+        timelines = dict(zip(models, pool.map(
+            model_timeline, [os.path.join(args.experiments_dir, model) for model in models],
+        )))
+    for directory in args.run_logs:
+        add_job_logs(timelines, os.path.join(args.experiments_dir, directory))
+    add_test_logs(timelines, os.path.join(args.experiments_dir, args.test_logs))
+
+    if args.trace is not None:
+        tmp_path = f'{args.trace}.tmp.{os.getpid()}'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(chrome_trace(timelines), f)
+        os.replace(tmp_path, args.trace)
+    print_summary(timelines)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Per-stage timeline of the trainings from their logs')
+    parser.add_argument(
+        '--experiments-dir', '-d',
+        type=str,
+        default='.',
+        help='Folder with model_* folders',
+    )
+    parser.add_argument(
+        '--pattern', '-p',
+        type=str,
+        default='model_*',
+        help='Experiment folder name pattern',
+    )
+    parser.add_argument(
+        '--run-logs',
+        nargs='*',
+        default=['run_logs'],
+        help='Folders with SGE job logs, relative to --experiments-dir',
+    )
+    parser.add_argument(
+        '--test-logs',
+        type=str,
+        default='test_results/logs',
+        help='Folder with marian-server logs of the tests, relative to --experiments-dir',
+    )
+    parser.add_argument(
+        '--trace', '-t',
+        type=str,
+        default=None,
+        help='Output file of the Chrome trace-event JSON',
+    )
+    parser.add_argument(
+        '--jobs', '-j',
+        type=int,
+        default=os.cpu_count(),
+        help='Number of worker processes',
+    )
+
+    args = parser.parse_args()
+    return args
+
+
+def find_models(experiments_dir, pattern):
+    return [
+        name for name in sorted(os.listdir(experiments_dir))
+        if fnmatch.fnmatch(name, pattern) and os.path.isfile(os.path.join(experiments_dir, name, 'train.log'))
+    ]
+
+
+def timestamp(text):
+    """ '2020-05-14 16:54:15' -> seconds since the epoch (local time) """
+    return datetime.fromisoformat(text).timestamp()
+
+
+class Timeline:
+    """ spans (stage, start, end, args) and words/s samples (time, speed) of one model """
+    def __init__(self):
+        self.spans = []
+        self.speeds = []
+
+    def add(self, stage, start, end, **args):
+        self.spans.append((stage, start, max(start, end), args))
+
+    def total(self, stage):
+        return sum(end - start for span_stage, start, end, _ in self.spans if span_stage == stage)
+
+
+class TrainLogReader:
+    """ state machine turning the lines of train.log into spans """
+    def __init__(self, timeline, script_ends):
+        self.timeline = timeline
+        # step -> times of the lang/bleu lines of valid.log
+        self.script_ends = script_ends
+        self.stage = None
+        self.start = None
+        self.last = None
+        self.step = 0
+        self.translation_start = None
+        self.translation_end = None
+        self.translation_time = 0.
+        self.script_open = False
+
+    def close(self, end):
+        if self.stage is None:
+            return
+        if self.stage == 'validation':
+            self.close_script(end)
+            self.timeline.add(
+                'validation', self.start, end,
+                step=self.step, translation_time=self.translation_time,
+            )
+        else:
+            self.timeline.add(self.stage, self.start, end)
+        self.stage = None
+
+    def close_script(self, end):
+        if self.script_open:
+            self.timeline.add('validate.sh', self.translation_end, end, step=self.step)
+            self.script_open = False
+
+    def enter(self, stage, time):
+        if stage == self.stage:
+            return
+        # training continues after the last line of a save or a validation
+        self.close(self.last if stage == 'training' else time)
+        self.stage = stage
+        self.start = self.last if stage == 'training' else time
+        if stage == 'validation':
+            self.translation_time = 0.
+            self.translation_start = None
+
+    def line(self, line):
+        line = line.rstrip('\n')
+        if TIME_PREFIX.match(line) is None:
+            return
+        time = timestamp(line[1:20])
+        rest = line[22:]
+        if rest.startswith('[marian] Marian'):
+            # (re)started training
+            self.close(self.last)
+            self.stage, self.start = 'startup', time
+        elif self.stage is None:
+            # log without its beginning
+            self.stage, self.start = 'training', time
+        elif 'Training finished' in rest:
+            self.close(time)
+        elif self.stage == 'startup':
+            if 'Training started' in rest:
+                self.close(time)
+                self.stage, self.start = 'training', time
+        elif rest.startswith('Saving'):
+            self.enter('saving', time)
+        elif rest.startswith('Translating'):
+            self.enter('validation', time)
+            self.translation_start = time
+        elif rest.startswith('Best translation'):
+            self.enter('validation', time)
+        elif rest.startswith('Total translation time'):
+            self.enter('validation', time)
+            self.translation_time += float(rest.split(' ')[-1].rstrip('s'))
+            self.timeline.add(
+                'translation', self.translation_start if self.translation_start is not None else time, time,
+                step=self.step,
+            )
+            self.translation_end = time
+            self.script_open = True
+        elif rest.startswith('[valid]'):
+            self.enter('validation', time)
+            if self.script_open:
+                # a restarted training validates the same steps again
+                ends = [
+                    end for end in self.script_ends.get(self.step, [])
+                    if self.translation_end <= end <= time
+                ]
+                self.close_script(max(ends, default=time))
+        else:
+            self.enter('training', time)
+            match = TRAIN_LINE.search(rest)
+            if match is not None:
+                self.step = int(match.group(2))
+                self.timeline.speeds.append((time, float(match.group(6))))
+        self.last = time
+
+    def finish(self):
+        if self.last is not None:
+            self.close(self.last)
+
+
+def valid_script_ends(path):
+    """ step -> times of the lang/bleu lines in valid.log (written by validate.py) """
+    ends = {}
+    try:
+        f = open(path, encoding='utf-8', errors='replace')
+    except FileNotFoundError:
+        return ends
+    with f:
+        for line in f:
+            if TIME_PREFIX.match(line) is None or 'lang/' not in line or ' Up. ' not in line:
+                continue
+            step = int(line.split(' Up. ')[1].split(' ')[0])
+            ends.setdefault(step, []).append(timestamp(line[1:20]))
+    return ends
+
+
+def model_timeline(model_dir):
+    timeline = Timeline()
+    reader = TrainLogReader(timeline, valid_script_ends(os.path.join(model_dir, 'valid.log')))
+    with open(os.path.join(model_dir, 'train.log'), encoding='utf-8', errors='replace') as f:
+        for line in f:
+            reader.line(line)
+    reader.finish()
+    return timeline
+
+
+def add_job_logs(timelines, directory):
+    """ SGE queue wait and run time, data preparation """
+    try:
+        names = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        return
+    for name in names:
+        match = JOB_FILE.match(name)
+        job_model = 'model_' + match.group(1) if match is not None else None
+        times = {}
+        data = {}
+        with open(os.path.join(directory, name), encoding='utf-8', errors='replace') as f:
+            for line in f:
+                job = JOB_LINE.match(line)
+                if job is not None:
+                    times[job.group(1)] = timestamp(job.group(2))
+                    continue
+                prep = DATA_LINE.match(line)
+                if prep is not None:
+                    data.setdefault('model_' + prep.group(1), {})[prep.group(2)] = timestamp(prep.group(3))
+        if job_model in timelines:
+            timeline = timelines[job_model]
+            if 'started' not in times and 'started' in data.get(job_model, {}):
+                # data preparation job
+                times['started'] = data[job_model]['started']
+            if 'submitted' in times and 'started' in times:
+                timeline.add('sge', times['submitted'], times['started'], job=name, wait=True)
+            if 'started' in times and 'finished' in times:
+                timeline.add('sge', times['started'], times['finished'], job=name)
+        for model, prep_times in data.items():
+            if model in timelines and 'started' in prep_times and 'finished' in prep_times:
+                timelines[model].add('data', prep_times['started'], prep_times['finished'], log=name)
+
+
+def add_test_logs(timelines, directory):
+    """ marian-server of a tested decoder, from its first to its last line """
+    try:
+        names = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        return
+    for name in names:
+        match = TEST_FILE.match(name)
+        if match is None or match.group(1) not in timelines:
+            continue
+        first = last = None
+        with open(os.path.join(directory, name), encoding='utf-8', errors='replace') as f:
+            for line in f:
+                if TIME_PREFIX.match(line) is not None:
+                    last = timestamp(line[1:20])
+                    first = last if first is None else first
+        if first is not None:
+            timelines[match.group(1)].add('test', first, last, decoder=name[len(match.group(1)) + 1:-len('.log')])
+
+
+def chrome_trace(timelines):
+    """ trace-event JSON: a process per model, a thread per lane, words/s counters """
+    events = []
+    for pid, (model, timeline) in enumerate(timelines.items(), 1):
+        events.append({'ph': 'M', 'name': 'process_name', 'pid': pid, 'args': {'name': model}})
+        for tid, lane in LANE_NAMES.items():
+            events.append({'ph': 'M', 'name': 'thread_name', 'pid': pid, 'tid': tid, 'args': {'name': lane}})
+        for stage, start, end, args in timeline.spans:
+            name = 'queue wait' if args.get('wait') else 'job' if stage == 'sge' else stage
+            events.append({
+                'ph': 'X', 'name': name, 'cat': stage, 'pid': pid, 'tid': LANES[stage],
+                'ts': int(start * 1e6), 'dur': int((end - start) * 1e6), 'args': args,
+            })
+        for time, speed in timeline.speeds:
+            events.append({
+                'ph': 'C', 'name': 'words/s', 'pid': pid, 'ts': int(time * 1e6), 'args': {'words/s': speed},
+            })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def speed_trend(speeds):
+    """ mean words/s of the first and the last TREND_SHARE of the train lines """
+    if not speeds:
+        return None, None
+    n = max(1, int(len(speeds) * TREND_SHARE))
+    mean = lambda values: sum(speed for _, speed in values) / len(values)
+    return mean(speeds[:n]), mean(speeds[-n:])
+
+
+def summary_row(model, timeline):
+    hours = lambda seconds: f'{seconds / 3600:.2f}'
+    queue = sum(end - start for stage, start, end, args in timeline.spans if stage == 'sge' and args.get('wait'))
+    validation = timeline.total('validation')
+    script = timeline.total('validate.sh')
+    first, last = speed_trend(timeline.speeds)
+    return [
+        model,
+        hours(queue),
+        hours(timeline.total('data')),
+        hours(timeline.total('startup')),
+        hours(timeline.total('training')),
+        hours(timeline.total('saving')),
+        hours(validation),
+        hours(timeline.total('translation')),
+        hours(script),
+        f'{script / validation:.1%}' if validation else '-',
+        hours(timeline.total('test')),
+        f'{first:.0f}' if first is not None else '-',
+        f'{last:.0f}' if last is not None else '-',
+        f'{last / first - 1:+.1%}' if first else '-',
+    ]
+
+
+def print_summary(timelines):
+    header = [
+        'model', 'queue_h', 'data_h', 'startup_h', 'train_h', 'save_h', 'valid_h',
+        'translate_h', 'validate.sh_h', 'gpu_idle_valid', 'test_h', 'wps_first', 'wps_last', 'wps_change',
+    ]
+    rows = [summary_row(model, timeline) for model, timeline in timelines.items()]
+    total = Timeline()
+    for timeline in timelines.values():
+        total.spans.extend(timeline.spans)
+    rows.append(summary_row('total', total)[:-3] + ['-', '-', '-'])
+    widths = [max(len(row[i]) for row in rows + [header]) for i in range(len(header))]
+    for row in [header] + rows:
+        print('  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
+
+
+if __name__ == '__main__':
+    main()
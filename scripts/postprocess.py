@@ -0,0 +1,45 @@
+# postprocessing of translations and references before scoring:
+# remove BPE separators, detruecase, detokenize
+#
+# With script=None it is done by sacremoses; detokenizers are created once
+# per process, so worker pools keep them. With script (postprocess.sh, moses
+# perl scripts) the lines are piped through the script for exact parity.
+
+import hashlib
+import os
+import subprocess
+
+_detruecaser = None
+_detokenizers = {}
+
+
+def postprocess(lines, lang, script=None):
+    """ list of lines -> list of postprocessed lines """
+    if script is not None:
+        env = dict(os.environ, tgt=lang)
+        output = subprocess.run(
+            [script], input='\n'.join(lines) + '\n',
+            stdout=subprocess.PIPE, env=env, encoding='utf-8', check=True,
+        ).stdout
+        return output.split('\n')[:len(lines)]
+
+    global _detruecaser
+    from sacremoses import MosesDetokenizer, MosesDetruecaser
+    if _detruecaser is None:
+        _detruecaser = MosesDetruecaser()
+    if lang not in _detokenizers:
+        _detokenizers[lang] = MosesDetokenizer(lang=lang)
+    detokenizer = _detokenizers[lang]
+    return [
+        detokenizer.detokenize(_detruecaser.detruecase(line.replace('@@ ', '')), return_str=True)
+        for line in lines
+    ]
+
+
+def postprocess_version(script=None):
+    """ identifies the postprocessing in cache keys """
+    if script is not None:
+        with open(script, 'rb') as f:
+            return 'postprocess.sh-' + hashlib.sha256(f.read()).hexdigest()
+    import sacremoses
+    return 'sacremoses-' + sacremoses.__version__
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# sqlite store of test results, written by many evaluation tasks at once
+#
+# cd experiments/en-to-36
+# ../../scripts/results_store.py import -s test_results/results.sqlite test_results/results.tsv
+#   loads existing results.tsv files (later lines replace earlier ones)
+# ../../scripts/results_store.py export -s test_results/results.sqlite > test_results/results.tsv
+# ../../scripts/results_store.py export -s test_results/results.sqlite --model model_en2bg \
+#       -o model_en2bg/results.tsv
+#   the results.tsv layout: model, lang, best_by, dataset, bleu
+# ../../scripts/results_store.py export -s test_results/results.sqlite --lang bg --n-targets 1
+# ../../scripts/results_store.py evaluated -s test_results/results.sqlite [--add model_en2bg]
+#   lists (or adds to) the evaluated models
+# ../../scripts/results_store.py evaluated -s test_results/results.sqlite -o test_results/evaluated_models
+#
+# python usage:
+#   with ResultsStore('test_results/results.sqlite') as store:
+#       store.put('model_en2bg', 'bg', 'bleu-detok', 'data/raw/test/en2bg/...', 31.2)
+#       rows = store.select(lang='bg', n_targets=1)
+#
+# The store is on the shared storage and written by tasks on several hosts,
+# so it uses the rollback journal (journal_mode=DELETE): sqlite locks the
+# file with fcntl locks, which NFS forwards to the server, while WAL needs
+# shared memory of a single host. Each write is one transaction taking the
+# write lock up front (BEGIN IMMEDIATE), concurrent tasks wait for it
+# instead of failing. A result is identified by (model, lang, best_by,
+# dataset); evaluating again replaces the value.
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+# seconds a writer waits for the lock of another one
+BUSY_TIMEOUT = 600
+COLUMNS = ('model', 'lang', 'best_by', 'dataset', 'bleu')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS results (
+    model TEXT NOT NULL,
+    lang TEXT NOT NULL,
+    best_by TEXT NOT NULL,
+    dataset TEXT NOT NULL,
+    bleu REAL NOT NULL,
+    n_targets INTEGER NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (model, lang, best_by, dataset)
+);
+CREATE INDEX IF NOT EXISTS results_lang ON results (lang, n_targets);
+CREATE INDEX IF NOT EXISTS results_n_targets ON results (n_targets, lang);
+CREATE TABLE IF NOT EXISTS evaluated (
+    model TEXT PRIMARY KEY,
+    updated REAL NOT NULL
+);
+'''
+
+UPSERT = (
+    'INSERT INTO results (model, lang, best_by, dataset, bleu, n_targets, updated) '
+    'VALUES (?, ?, ?, ?, ?, ?, ?) '
+    'ON CONFLICT (model, lang, best_by, dataset) DO UPDATE SET '
+    'bleu = excluded.bleu, updated = excluded.updated'
+)
+
+
+def main():
+    args = parse_args()
+    args.func(args)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Store of test results')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    def add_store_argument(subparser):
+        subparser.add_argument(
+            '--store', '-s',
+            type=str,
+            default=os.environ.get('RESULTS_STORE', 'test_results/results.sqlite'),
+            help='Database file',
+        )
+
+    add = subparsers.add_parser('import', help='Load results.tsv files')
+    add_store_argument(add)
+    add.add_argument('files', nargs='+', help='results.tsv files')
+    add.set_defaults(func=import_files)
+
+    export = subparsers.add_parser('export', help='Results in the results.tsv layout')
+    add_store_argument(export)
+    export.add_argument('--model', '-m', type=str, default=None, help='Only this model')
+    export.add_argument('--lang', '-l', type=str, default=None, help='Only this target language')
+    export.add_argument('--best-by', type=str, default=None, help='Only this validation metric')
+    export.add_argument('--n-targets', '-n', type=int, default=None, help='Only models with this number of targets')
+    export.add_argument(
+        '--output', '-o',
+        type=str,
+        default=None,
+        help='Write to this file (replaced at once) instead of stdout',
+    )
+    export.set_defaults(func=export_results)
+
+    evaluated = subparsers.add_parser('evaluated', help='List or add evaluated models')
+    add_store_argument(evaluated)
+    evaluated.add_argument('--add', type=str, default=None, help='Model to add')
+    evaluated.add_argument(
+        '--output', '-o',
+        type=str,
+        default=None,
+        help='Write the list to this file (replaced at once) instead of stdout',
+    )
+    evaluated.set_defaults(func=evaluated_models)
+
+    args = parser.parse_args()
+    return args
+
+
+def n_targets(model):
+    """ model_en2arbg -> 2 """
+    return len(os.path.basename(os.path.normpath(model)).split('en2', 1)[1]) // 2
+
+
+class ResultsStore:
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # transactions are opened explicitly
+        self.connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=DELETE')
+        self.connection.executescript(SCHEMA)
+
+    def _write(self):
+        return _Transaction(self.connection)
+
+    def put(self, model, lang, best_by, dataset, bleu):
+        self.put_many([(model, lang, best_by, dataset, bleu)])
+
+    def put_many(self, rows):
+        """ rows of (model, lang, best_by, dataset, bleu), inserted or replaced at once """
+        now = time.time()
+        with self._write():
+            self.connection.executemany(UPSERT, [
+                (model, lang, best_by, dataset, float(bleu), n_targets(model), now)
+                for model, lang, best_by, dataset, bleu in rows
+            ])
+
+    def import_tsv(self, path):
+        rows = []
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) == len(COLUMNS):
+                    rows.append(fields)
+        self.put_many(rows)
+        return len(rows)
+
+    def select(self, model=None, lang=None, best_by=None, n_targets=None):
+        """ (model, lang, best_by, dataset, bleu) rows, in the order of the first evaluation """
+        conditions, parameters = [], []
+        for column, value in (('model', model), ('lang', lang), ('best_by', best_by), ('n_targets', n_targets)):
+            if value is not None:
+                conditions.append(f'{column} = ?')
+                parameters.append(value)
+        where = f' WHERE {" AND ".join(conditions)}' if conditions else ''
+        return self.connection.execute(
+            f'SELECT {", ".join(COLUMNS)} FROM results{where} ORDER BY rowid', parameters,
+        ).fetchall()
+
+    def mark_evaluated(self, model):
+        with self._write():
+            self.connection.execute(
+                'INSERT OR REPLACE INTO evaluated (model, updated) VALUES (?, ?)', (model, time.time()),
+            )
+
+    def evaluated_models(self):
+        return [model for model, in self.connection.execute('SELECT model FROM evaluated ORDER BY updated')]
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _Transaction:
+    """ BEGIN IMMEDIATE ... COMMIT, ROLLBACK on an exception """
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+
+    def __exit__(self, exc_type, *exc):
+        self.connection.execute('ROLLBACK' if exc_type else 'COMMIT')
+
+
+def format_row(row):
+    model, lang, best_by, dataset, bleu = row
+    return f'{model}\t{lang}\t{best_by}\t{dataset}\t{bleu:.2f}\n'
+
+
+def import_files(args):
+    with ResultsStore(args.store) as store:
+        for path in args.files:
+            print(f'{path}: {store.import_tsv(path)} results', file=sys.stderr)
+
+
+def export_results(args):
+    with ResultsStore(args.store) as store:
+        rows = store.select(args.model, args.lang, args.best_by, args.n_targets)
+    write_output(args.output, [format_row(row) for row in rows])
+
+
+def evaluated_models(args):
+    with ResultsStore(args.store) as store:
+        if args.add is not None:
+            store.mark_evaluated(args.add)
+        else:
+            write_output(args.output, [f'{model}\n' for model in store.evaluated_models()])
+
+
+def write_output(path, lines):
+    """ lines to stdout or to the file, replaced at once """
+    if path is None:
+        sys.stdout.writelines(lines)
+        return
+    tmp_path = f'{path}.tmp.{os.getpid()}'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.writelines(lines)
+    os.replace(tmp_path, path)
+
+
+if __name__ == '__main__':
+    main()
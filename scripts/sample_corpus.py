@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# combination corpus of a fixed size sampled from the per-language shards
+# (shard_corpus.py split), train lines shuffled across the languages
+#
+# ./sample_corpus.py --shards shards --output data/interim/en2arcsde --temperature 5 \
+#     --max-lines 20000000 ar cs de
+#   languages sampled by (lines / all lines)^(1/5), 20M train lines in total
+# ./sample_corpus.py --shards shards --output data/interim/en2arcsde --cap 2000000 ar cs de
+#   at most 2M lines of each language
+#
+# The number of lines of each language is computed from the manifest;
+# languages smaller than their share are repeated (whole copies and a
+# sample of the rest). Shards are read once, line by line: the sample is
+# drawn by selection sampling and every pair goes to a random one of the
+# bucket files. The buckets are then shuffled in memory one at a time and
+# concatenated: a bucket is read into one bytes buffer and the pairs are
+# reordered by a numpy array of line offsets, so shuffling a bucket takes
+# its file size plus PAIR_INDEX_BYTES per pair (and fixed buffers of some
+# tens of MB). The number of buckets makes that BUCKET_FILL of --memory on
+# average. The result only depends on --seed. The val split is
+# concatenated as in shard_corpus.py.
+
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+from eval_cache import size_value
+from shard_corpus import BUFFER_SIZE, concatenate, is_stale, link_or_copy, read_manifest, shard_path
+
+DEFAULT_MEMORY = '2G'
+# bucket sizes vary, headroom for the larger ones
+BUCKET_FILL = 0.8
+# line ends (two int64), pair start and position in the shuffled order
+PAIR_INDEX_BYTES = 32
+# bytes of a bucket searched for newlines at once
+SCAN_BLOCK = 16 * 1024**2
+# pairs written at once (their offsets are python ints meanwhile)
+WRITE_BLOCK = 64 * 1024
+
+
+def main():
+    args = parse_args()
+    manifest = read_manifest(args.shards)
+    languages = sorted(set(args.languages))
+    for split in ('train', 'dev'):
+        if split not in manifest:
+            sys.exit(f'no {split} shards in {args.shards}')
+        if is_stale(manifest[split]):
+            sys.exit(f'{split} shards in {args.shards} are older than the corpus, run split again')
+        missing = [lang for lang in languages if lang not in manifest[split]['languages']]
+        if missing:
+            sys.exit(f'no {split} data for: {" ".join(missing)}')
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+
+    stats = manifest['train']['languages']
+    counts = sample_counts(
+        {lang: stats[lang]['lines'] for lang in languages},
+        args.temperature, args.max_lines, args.cap,
+    )
+    for lang in languages:
+        print(f'{lang}: {counts[lang]} of {stats[lang]["lines"]} lines', file=sys.stderr)
+    size = sum(
+        (stats[lang]['src_bytes'] + stats[lang]['tgt_bytes']) * counts[lang] / max(stats[lang]['lines'], 1)
+        for lang in languages
+    ) + PAIR_INDEX_BYTES * sum(counts.values())
+    n_buckets = max(1, math.ceil(size / (args.memory * BUCKET_FILL)))
+
+    start = time.time()
+    sample_shuffled(
+        [(lang, shard_path(args.shards, 'train', lang, 'src'), shard_path(args.shards, 'train', lang, 'tgt'),
+          stats[lang]['lines'], counts[lang]) for lang in languages],
+        f'{args.output}.train.source', f'{args.output}.train.target',
+        n_buckets, args.seed, args.tmp_dir or os.path.dirname(args.output) or '.',
+    )
+    print(f'{args.output}.train: {sum(counts.values())} lines, {n_buckets} buckets, '
+          f'{time.time() - start:.1f}s', file=sys.stderr)
+
+    for side, suffix in (('src', 'source'), ('tgt', 'target')):
+        shards = [shard_path(args.shards, 'dev', lang, side) for lang in languages]
+        output = f'{args.output}.val.{suffix}'
+        if len(shards) == 1:
+            link_or_copy(shards[0], output)
+        else:
+            concatenate(shards, output)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Sampled and shuffled combination corpus')
+    parser.add_argument(
+        '--shards', '-d',
+        type=str,
+        required=True,
+        help='Folder with shards and manifest (shard_corpus.py split)',
+    )
+    parser.add_argument(
+        '--output', '-o',
+        type=str,
+        required=True,
+        help='Output prefix, e.g. data/interim/en2arcs',
+    )
+    parser.add_argument(
+        '--temperature', '-T',
+        type=float,
+        default=1.,
+        help='Sampling temperature, 1 keeps the proportions, higher values flatten them',
+    )
+    parser.add_argument(
+        '--max-lines', '-n',
+        type=int,
+        default=None,
+        help='Train lines in total, all lines of the languages by default',
+    )
+    parser.add_argument(
+        '--cap',
+        type=int,
+        default=None,
+        help='Max. train lines of one language',
+    )
+    parser.add_argument('--seed', '-s', type=int, default=1, help='Seed of sampling and shuffling')
+    parser.add_argument(
+        '--memory', '-m',
+        type=size_value,
+        default=DEFAULT_MEMORY,
+        help='Memory for shuffling one bucket, e.g. 2G; a bucket takes its bytes plus '
+             f'{PAIR_INDEX_BYTES} bytes per pair, {BUCKET_FILL} of this on average',
+    )
+    parser.add_argument(
+        '--tmp-dir',
+        type=str,
+        default=None,
+        help='Folder for the bucket files, next to the output by default',
+    )
+    parser.add_argument(
+        'languages',
+        nargs='+',
+        help='Target languages',
+    )
+
+    args = parser.parse_args()
+    return args
+
+
+def sample_counts(sizes, temperature=1., max_lines=None, cap=None):
+    """
+    lang -> number of lines: max_lines (by default all lines) split by
+    probabilities (size / total)^(1/temperature), at most cap per language
+    """
+    total = sum(sizes.values())
+    if max_lines is None:
+        max_lines = total
+    weights = {lang: (size / total) ** (1 / temperature) if size else 0. for lang, size in sizes.items()}
+    weight_sum = sum(weights.values())
+    shares = {lang: max_lines * weight / weight_sum for lang, weight in weights.items()}
+    counts = {lang: math.floor(share) for lang, share in shares.items()}
+    # largest remainders get the lines lost by rounding down
+    by_remainder = sorted(sizes, key=lambda lang: counts[lang] - shares[lang])
+    for lang in by_remainder[:max_lines - sum(counts.values())]:
+        counts[lang] += 1
+    if cap is not None:
+        counts = {lang: min(count, cap) for lang, count in counts.items()}
+    return counts
+
+
+def sampled_pairs(source, target, n_lines, count, rng):
+    """
+    Yields (src_line, tgt_line) count times: every line count // n_lines
+    times and a sample (selection sampling) of count % n_lines lines once more
+    """
+    copies, rest = divmod(count, n_lines) if n_lines else (0, 0)
+    with open(source, 'rb', buffering=BUFFER_SIZE) as src, open(target, 'rb', buffering=BUFFER_SIZE) as tgt:
+        remaining = n_lines
+        for src_line, tgt_line in zip(src, tgt):
+            extra = 0
+            if rest and rng.random() * remaining < rest:
+                extra = 1
+                rest -= 1
+            remaining -= 1
+            for _ in range(copies + extra):
+                yield src_line, tgt_line
+
+
+def ensure_newline(line):
+    return line if line.endswith(b'\n') else line + b'\n'
+
+
+def line_ends(data):
+    """ int64 offsets after each newline of the buffer """
+    ends = np.empty(data.count(b'\n'), dtype=np.int64)
+    n = 0
+    for start in range(0, len(data), SCAN_BLOCK):
+        block = np.frombuffer(data, dtype=np.uint8, count=min(SCAN_BLOCK, len(data) - start), offset=start)
+        found = np.flatnonzero(block == ord('\n')) + (start + 1)
+        ends[n:n + len(found)] = found
+        n += len(found)
+    return ends
+
+
+def write_shuffled(data, source, target, rng):
+    """ data: lines of source and target alternating, each pair is written in random order """
+    ends = line_ends(data)
+    source_ends, target_ends = ends[0::2], ends[1::2]
+    starts = np.concatenate(([0], target_ends[:-1]))
+    order = rng.permutation(len(target_ends))
+    view = memoryview(data)
+    for block in range(0, len(order), WRITE_BLOCK):
+        pairs = order[block:block + WRITE_BLOCK]
+        middles = source_ends[pairs].tolist()
+        source.writelines(view[start:middle] for start, middle in zip(starts[pairs].tolist(), middles))
+        target.writelines(view[middle:end] for middle, end in zip(middles, target_ends[pairs].tolist()))
+    view.release()
+
+
+def sample_shuffled(inputs, source_output, target_output, n_buckets, seed, tmp_dir):
+    """
+    inputs: (lang, source, target, lines, count) of each language;
+    writes the sampled pairs in random order
+    """
+    os.makedirs(tmp_dir, exist_ok=True)
+    prefix = os.path.join(tmp_dir, f'.sample.{os.getpid()}')
+    bucket_paths = [f'{prefix}.{i}' for i in range(n_buckets)]
+    try:
+        buckets = [open(path, 'wb', buffering=BUFFER_SIZE // 16) for path in bucket_paths]
+        try:
+            bucket_rng = random.Random(f'{seed} buckets')
+            for lang, source, target, n_lines, count in inputs:
+                # per language, counts of other languages do not change its sample
+                rng = random.Random(f'{seed} {lang}')
+                for src_line, tgt_line in sampled_pairs(source, target, n_lines, count, rng):
+                    bucket = buckets[bucket_rng.randrange(n_buckets)]
+                    bucket.write(ensure_newline(src_line))
+                    bucket.write(ensure_newline(tgt_line))
+        finally:
+            for bucket in buckets:
+                bucket.close()
+
+        with open(source_output + '.tmp', 'wb', buffering=BUFFER_SIZE) as source, \
+             open(target_output + '.tmp', 'wb', buffering=BUFFER_SIZE) as target:
+            for i, path in enumerate(bucket_paths):
+                with open(path, 'rb') as f:
+                    data = f.read()
+                os.remove(path)
+                rng = np.random.default_rng(random.Random(f'{seed} bucket {i}').getrandbits(64))
+                write_shuffled(data, source, target, rng)
+                del data
+        os.replace(source_output + '.tmp', source_output)
+        os.replace(target_output + '.tmp', target_output)
+    finally:
+        for path in bucket_paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
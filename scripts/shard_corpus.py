@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# split the multi-target corpus into per-target-language shards (one pass)
+# and build combination corpora from those shards
+#
+# ./shard_corpus.py split --source train.src --target train.tgt --name train -o shards
+# ./shard_corpus.py build --shards shards --output data/interim/en2arcs ar cs
+
+import argparse
+import fcntl
+import json
+import os
+import shutil
+import sys
+import time
+
+MANIFEST = 'manifest.json'
+BUFFER_SIZE = 16 * 1024 * 1024
+# corpus split name -> name used for combination corpora
+SPLITS = {
+    'train': 'train',
+    'dev': 'val',
+}
+
+
+def main():
+    args = parse_args()
+    args.func(args)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Per-target-language shards of the multi-target corpus')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    split = subparsers.add_parser('split', help='Split corpus into per-language shards')
+    split.add_argument(
+        '--source', '-s',
+        type=str,
+        required=True,
+        help='Source side of the corpus (lines start with <2xx> tag)',
+    )
+    split.add_argument(
+        '--target', '-t',
+        type=str,
+        required=True,
+        help='Target side of the corpus',
+    )
+    split.add_argument(
+        '--name', '-n',
+        type=str,
+        required=True,
+        choices=sorted(SPLITS),
+        help='Name of the split',
+    )
+    split.add_argument(
+        '--shards', '-o',
+        type=str,
+        required=True,
+        help='Folder with shards and manifest',
+    )
+    split.set_defaults(func=split_corpus)
+
+    build = subparsers.add_parser('build', help='Build corpus for a combination of languages')
+    build.add_argument(
+        '--shards', '-d',
+        type=str,
+        required=True,
+        help='Folder with shards and manifest',
+    )
+    build.add_argument(
+        '--output', '-o',
+        type=str,
+        required=True,
+        help='Output prefix, e.g. data/interim/en2arcs',
+    )
+    build.add_argument(
+        'languages',
+        nargs='+',
+        help='Target languages',
+    )
+    build.set_defaults(func=build_corpus)
+
+    args = parser.parse_args()
+    return args
+
+
+def shard_path(shards_dir, split, lang, side):
+    return os.path.join(shards_dir, f'{split}.{lang}.{side}')
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def read_manifest(shards_dir):
+    try:
+        with open(os.path.join(shards_dir, MANIFEST), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_manifest(shards_dir, manifest):
+    path = os.path.join(shards_dir, MANIFEST)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def get_tag(src_line):
+    """ b'<2ar> source sentence' -> 'ar' """
+    end = src_line.find(b'>')
+    if not src_line.startswith(b'<2') or end < 0:
+        return None
+    return src_line[2:end].decode('ascii')
+
+
+def split_corpus(args):
+    os.makedirs(args.shards, exist_ok=True)
+    start = time.time()
+    outputs = {}
+    stats = {}
+    try:
+        with open(args.source, 'rb', buffering=BUFFER_SIZE) as source, \
+             open(args.target, 'rb', buffering=BUFFER_SIZE) as target:
+            for n, (src_line, tgt_line) in enumerate(zip(source, target), 1):
+                lang = get_tag(src_line)
+                if lang is None:
+                    sys.exit(f'{args.source}:{n}: no target language tag')
+                if lang not in outputs:
+                    outputs[lang] = (
+                        open(shard_path(args.shards, args.name, lang, 'src') + '.tmp', 'wb', buffering=BUFFER_SIZE),
+                        open(shard_path(args.shards, args.name, lang, 'tgt') + '.tmp', 'wb', buffering=BUFFER_SIZE),
+                    )
+                    stats[lang] = {'lines': 0, 'src_bytes': 0, 'tgt_bytes': 0}
+                src_out, tgt_out = outputs[lang]
+                src_out.write(src_line)
+                tgt_out.write(tgt_line)
+                lang_stats = stats[lang]
+                lang_stats['lines'] += 1
+                lang_stats['src_bytes'] += len(src_line)
+                lang_stats['tgt_bytes'] += len(tgt_line)
+    finally:
+        for src_out, tgt_out in outputs.values():
+            src_out.close()
+            tgt_out.close()
+
+    for lang in outputs:
+        for side in ('src', 'tgt'):
+            path = shard_path(args.shards, args.name, lang, side)
+            os.replace(path + '.tmp', path)
+
+    # train and dev may be split concurrently
+    with open(os.path.join(args.shards, MANIFEST + '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        manifest = read_manifest(args.shards)
+        manifest[args.name] = {
+            'source': file_signature(args.source),
+            'target': file_signature(args.target),
+            'languages': stats,
+        }
+        write_manifest(args.shards, manifest)
+
+    total = sum(s['lines'] for s in stats.values())
+    print(f'{args.name}: {total} lines, {len(stats)} languages, {time.time() - start:.1f}s')
+
+
+def is_stale(split_info):
+    for side in ('source', 'target'):
+        signature = split_info[side]
+        try:
+            stat = os.stat(signature['path'])
+        except FileNotFoundError:
+            continue
+        if stat.st_size != signature['size'] or stat.st_mtime != signature['mtime']:
+            return True
+    return False
+
+
+def link_or_copy(shard, output):
+    if os.path.lexists(output):
+        os.remove(output)
+    try:
+        os.link(shard, output)
+    except OSError:
+        shutil.copyfile(shard, output)
+
+
+def concatenate(shards, output):
+    with open(output + '.tmp', 'wb') as out:
+        for shard in shards:
+            with open(shard, 'rb') as f:
+                shutil.copyfileobj(f, out, BUFFER_SIZE)
+    os.replace(output + '.tmp', output)
+
+
+def build_corpus(args):
+    manifest = read_manifest(args.shards)
+    languages = sorted(set(args.languages))
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    for split, name in SPLITS.items():
+        if split not in manifest:
+            sys.exit(f'no {split} shards in {args.shards}')
+        if is_stale(manifest[split]):
+            sys.exit(f'{split} shards in {args.shards} are older than the corpus, run split again')
+        missing = [lang for lang in languages if lang not in manifest[split]['languages']]
+        if missing:
+            sys.exit(f'no {split} data for: {" ".join(missing)}')
+
+        for side, suffix in (('src', 'source'), ('tgt', 'target')):
+            shards = [shard_path(args.shards, split, lang, side) for lang in languages]
+            output = f'{args.output}.{name}.{suffix}'
+            if len(shards) == 1:
+                link_or_copy(shards[0], output)
+            else:
+                concatenate(shards, output)
+
+        lines = sum(manifest[split]['languages'][lang]['lines'] for lang in languages)
+        print(f'{args.output}.{name}: {lines} lines')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+import io
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fix_train_log import merge, valid_lines
+
+# a training restarted from the checkpoint of step 200, validated at 200 twice
+TRAIN_LOG = '''\
+[2020-04-21 04:00:00] [marian] Marian v1.7.6
+[2020-04-21 04:01:00] Ep. 1 : Up. 100 : Sen. 100 : Cost 9.0 : Time 60.00s : 1000.00 words/s : L.r. 1.0e-05
+[2020-04-21 04:02:00] Ep. 1 : Up. 200 : Sen. 200 : Cost 8.0 : Time 60.00s : 1000.00 words/s : L.r. 2.0e-05
+[2020-04-21 04:02:10] Total translation time: 5.00000s
+[2020-04-21 04:02:12] [valid] Ep. 1 : Up. 200 : translation : 10.0 : new best
+[2020-04-21 04:03:00] [marian] Marian v1.7.6
+[2020-04-21 04:04:00] Ep. 1 : Up. 200 : Sen. 200 : Cost 8.0 : Time 60.00s : 1000.00 words/s : L.r. 2.0e-05
+[2020-04-21 04:04:10] Total translation time: 5.00000s
+[2020-04-21 04:04:12] [valid] Ep. 1 : Up. 200 : translation : 10.5 : new best
+[2020-04-21 04:05:00] Ep. 1 : Up. 300 : Sen. 300 : Cost 7.0 : Time 60.00s : 1000.00 words/s : L.r. 3.0e-05
+[2020-04-21 04:05:30] Training finished
+'''
+VALID_LOG = '''\
+[2020-04-21 04:02:11] [valid] Ep. 1 : Up. 200 : lang/bleu-bg : 10.0 : no effect on early stopping
+[2020-04-21 04:02:12] [valid] Ep. 1 : Up. 200 : translation : 10.0 : new best
+[2020-04-21 04:04:11] [valid] Ep. 1 : Up. 200 : lang/bleu-bg : 10.5 : no effect on early stopping
+[2020-04-21 04:04:12] [valid] Ep. 1 : Up. 200 : translation : 10.5 : new best
+'''
+
+
+def fix(train_log):
+    output = io.StringIO()
+    present = valid_lines(io.StringIO(train_log))
+    inserted = merge(io.StringIO(train_log), io.StringIO(VALID_LOG), output, present)
+    return inserted, output.getvalue()
+
+
+def test_merge_inserts_missing_lines_before_their_time():
+    inserted, fixed = fix(TRAIN_LOG)
+    assert inserted == 2
+    lines = fixed.splitlines()
+    assert lines.index(VALID_LOG.splitlines()[0]) == lines.index(VALID_LOG.splitlines()[1]) - 1
+    assert lines.index(VALID_LOG.splitlines()[2]) == lines.index(VALID_LOG.splitlines()[3]) - 1
+
+
+def test_merge_of_restarted_log_is_idempotent():
+    _, fixed = fix(TRAIN_LOG)
+    inserted, fixed_again = fix(fixed)
+    assert inserted == 0
+    assert fixed_again == fixed
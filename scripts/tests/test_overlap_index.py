@@ -0,0 +1,60 @@
+import os
+import re
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+SCRIPTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, SCRIPTS)
+
+from overlap_index import OverlapIndex
+
+# multi-parallel sentences with different tags, tags with spaces and '<',
+# case, digits and whitespace differences
+TRAIN = '''\
+<2de> Hello world
+<2fr> Hello world
+<2cs>  Hello   world
+<2de> a < b > c
+<2de> other
+<2fr> Year 1999 was <b>great</b>
+<2de> year 2000 WAS great
+<2cs> x <y z> w
+<2de> x w
+<2de> tab\tseparated
+<2fr> tab
+'''
+TEST = '''\
+<2de> Hello world
+<2cs> a c
+<2bg> YEAR 1234 was great
+<2de> x w
+<2de> tab
+<2de> nothing like this
+'''
+
+
+def perl_matches(train_path, test_path):
+    """ train line numbers reported by mark_known_sentences """
+    with open(test_path, 'rb') as test:
+        output = subprocess.run(
+            [os.path.join(SCRIPTS, 'mark_known_sentences'), '--preproc=droptags,lc,digits', train_path],
+            stdin=test, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+        ).stdout.decode('utf-8')
+    return {int(n) for n in re.findall(r'[es]\(.*?:(\d+)\)', output)}
+
+
+@pytest.mark.skipif(shutil.which('perl') is None, reason='perl is not installed')
+def test_matches_are_those_of_mark_known_sentences(tmp_path):
+    train_path, test_path = str(tmp_path / 'train'), str(tmp_path / 'test')
+    with open(train_path, 'w', encoding='utf-8') as f:
+        f.write(TRAIN)
+    with open(test_path, 'w', encoding='utf-8') as f:
+        f.write(TEST)
+    expected = perl_matches(train_path, test_path)
+    lines = OverlapIndex(train_path).lookup_file(test_path)
+    assert set(lines.tolist()) == expected
+    # exact matches only, the other tags of the same sentence are not matched
+    assert 1 in expected and 2 not in expected and 3 not in expected
@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+# binary form of the BPE corpus: uint16 subword ids, sentence offsets and a
+# uint8 column with the <2xx> tag of each sentence
+#
+# ./token_corpus.py encode --vocab raw/vocab/vocab.multi.yml \
+#     --source raw/train/corpus.multi.bpe.src --target raw/train/corpus.multi.bpe.tgt \
+#     --output interim/corpus.multi.tok --jobs 8
+# ./token_corpus.py stats --corpus interim/corpus.multi.tok > statistics.csv
+#   the columns of train_set_statistics.csv (unique_subwords.py)
+# ./token_corpus.py decode --corpus interim/corpus.multi.tok \
+#     --source corpus.src --target corpus.tgt [--langs ar cs] [--ignore-lines overlap]
+#   text of all (or selected) sentences, byte-identical to the encoded files
+#
+# python usage:
+#   corpus = TokenCorpus('interim/corpus.multi.tok')
+#   lines = corpus.select(langs=['ar', 'cs'], ignore=overlap_lines)
+#   counts = corpus.subword_counts('tgt')   # lang -> np.bincount of ids
+#   corpus.source_line(42), corpus.target_line(42)
+#
+# Lines are split on single spaces, so decoding gives the same bytes.
+# Subwords missing in the vocabulary (and empty strings of repeated spaces)
+# get the ids after it (base64 in meta.json, they may have undecodable
+# bytes); all arrays are .npy files read by memory mapping.
+
+import argparse
+import base64
+import json
+import os
+import sys
+from multiprocessing import Pool
+
+import numpy as np
+
+from line_index import LineIndex
+from overlap_index import chunks, read_lines
+
+META = 'meta.json'
+# lang column of sentences without a <2xx> tag
+NO_LANG = 255
+MAX_ID = np.iinfo(np.uint16).max
+
+
+def main():
+    args = parse_args()
+    args.func(args)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='uint16 token-id corpus')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    encode = subparsers.add_parser('encode', help='Text corpus to token ids')
+    encode.add_argument('--vocab', '-v', type=str, required=True, help='Marian yml vocabulary')
+    encode.add_argument('--source', '-s', type=str, required=True, help='Source side, lines start with <2xx> tag')
+    encode.add_argument('--target', '-t', type=str, required=True, help='Target side')
+    encode.add_argument('--output', '-o', type=str, required=True, help='Folder of the binary corpus')
+    encode.add_argument('--jobs', '-j', type=int, default=os.cpu_count(), help='Number of worker processes')
+    encode.set_defaults(func=encode_corpus)
+
+    stats = subparsers.add_parser('stats', help='Per-language statistics (csv)')
+    stats.add_argument('--corpus', '-c', type=str, required=True, help='Folder of the binary corpus')
+    stats.set_defaults(func=print_statistics)
+
+    decode = subparsers.add_parser('decode', help='Token ids to text')
+    decode.add_argument('--corpus', '-c', type=str, required=True, help='Folder of the binary corpus')
+    decode.add_argument('--source', '-s', type=str, required=True, help='Output source side')
+    decode.add_argument('--target', '-t', type=str, required=True, help='Output target side')
+    decode.add_argument('--langs', '-l', nargs='*', default=None, help='Only sentences of these target languages')
+    decode.add_argument(
+        '--ignore-lines',
+        type=str,
+        default=None,
+        help='File with 1-based line numbers to leave out (interim/overlap_test_in_train)',
+    )
+    decode.set_defaults(func=decode_corpus)
+
+    args = parser.parse_args()
+    return args
+
+
+def load_vocab(path):
+    """ Marian yml vocabulary: subword -> id """
+    import yaml
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    with open(path, encoding='utf-8') as f:
+        return yaml.load(f, Loader=loader)
+
+
+_vocab = None
+
+
+def init_worker(vocab_path):
+    global _vocab
+    _vocab = load_vocab(vocab_path)
+
+
+def split_tag(line):
+    """ '<2cs> a b' -> 'cs', 'a b' """
+    if line.startswith('<2'):
+        end = line.find('>')
+        if end > 2 and (end + 1 == len(line) or line[end + 1] == ' '):
+            return line[2:end], line[end + 2:] if end + 1 < len(line) else None
+    return None, line
+
+
+def encode_chunk(task):
+    """
+    ids of a chunk; subwords out of the vocabulary get ids -1, -2, ...
+    of the returned list of them
+    """
+    source, target, start, stop = task
+    get = _vocab.get
+    oov = {}
+
+    def encode(text, ids, lengths):
+        if text is None:
+            lengths.append(0)
+            return
+        tokens = text.split(' ')
+        for token in tokens:
+            subword_id = get(token)
+            if subword_id is None:
+                subword_id = oov.setdefault(token, -len(oov) - 1)
+            ids.append(subword_id)
+        lengths.append(len(tokens))
+
+    src_ids, src_lengths, tgt_ids, tgt_lengths, langs = [], [], [], [], []
+    for src_line, tgt_line in zip(
+            read_lines(source, start, stop, 'surrogateescape'),
+            read_lines(target, start, stop, 'surrogateescape'),
+    ):
+        lang, text = split_tag(src_line)
+        langs.append(lang)
+        encode(text, src_ids, src_lengths)
+        encode(tgt_line, tgt_ids, tgt_lengths)
+    as_array = lambda values, dtype: np.array(values, dtype=dtype)
+    return (
+        as_array(src_ids, np.int32), as_array(src_lengths, np.int64),
+        as_array(tgt_ids, np.int32), as_array(tgt_lengths, np.int64),
+        langs, list(oov),
+    )
+
+
+def ends_with_newline(path):
+    with open(path, 'rb') as f:
+        if f.seek(0, os.SEEK_END) == 0:
+            return True
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+
+def encode_corpus(args):
+    with LineIndex(args.source) as source, LineIndex(args.target) as target:
+        n_lines = len(source)
+        if len(target) != n_lines:
+            sys.exit(f'{args.source} and {args.target} differ in length: {n_lines} vs {len(target)}')
+    vocab = load_vocab(args.vocab)
+    vocab_size = max(vocab.values()) + 1
+    extra = {}
+    lang_codes = {}
+    tasks = [(args.source, args.target, start, stop) for start, stop in chunks(n_lines)]
+
+    os.makedirs(args.output, exist_ok=True)
+    parts = {side: ([], []) for side in ('src', 'tgt')}
+    lang_column = []
+    with Pool(args.jobs, initializer=init_worker, initargs=(args.vocab,)) as pool:
+        for src_ids, src_lengths, tgt_ids, tgt_lengths, langs, oov in pool.imap(encode_chunk, tasks):
+            # ids of the chunk's unknown subwords in the whole corpus
+            mapping = np.array(
+                [0] + [extra.setdefault(token, vocab_size + len(extra)) for token in reversed(oov)],
+                dtype=np.int64,
+            )
+            if vocab_size + len(extra) > MAX_ID + 1:
+                sys.exit(f'more than {MAX_ID + 1} subwords, ids do not fit into uint16')
+            for side, ids, lengths in (('src', src_ids, src_lengths), ('tgt', tgt_ids, tgt_lengths)):
+                # -1 -> mapping[-1] (first unknown subword) ...
+                unknown = ids < 0
+                ids[unknown] = mapping[ids[unknown]]
+                ids = ids.astype(np.uint16)
+                parts[side][0].append(ids)
+                parts[side][1].append(lengths)
+            for lang in langs:
+                if lang is None:
+                    lang_column.append(NO_LANG)
+                else:
+                    if lang not in lang_codes and len(lang_codes) == NO_LANG:
+                        sys.exit(f'more than {NO_LANG} languages')
+                    lang_column.append(lang_codes.setdefault(lang, len(lang_codes)))
+
+    for side, (ids, lengths) in parts.items():
+        ids = np.concatenate(ids) if ids else np.empty(0, np.uint16)
+        lengths = np.concatenate(lengths) if lengths else np.empty(0, np.int64)
+        offsets = np.zeros(n_lines + 1, dtype=np.uint64)
+        np.cumsum(lengths, out=offsets[1:])
+        np.save(os.path.join(args.output, f'{side}.ids.npy'), ids)
+        np.save(os.path.join(args.output, f'{side}.offsets.npy'), offsets)
+    np.save(os.path.join(args.output, 'langs.npy'), np.array(lang_column, dtype=np.uint8))
+    # written last and renamed, the corpus is complete when it exists
+    meta_path = os.path.join(args.output, META)
+    tmp_path = f'{meta_path}.tmp.{os.getpid()}'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({
+            'vocab': os.path.abspath(args.vocab),
+            'vocab_size': vocab_size,
+            # bytes, the subwords may have undecodable bytes (surrogateescape)
+            'extra_subwords': [
+                base64.b64encode(token.encode('utf-8', errors='surrogateescape')).decode('ascii')
+                for token in extra
+            ],
+            'langs': list(lang_codes),
+            'n_lines': n_lines,
+            'final_newline': {
+                'src': ends_with_newline(args.source),
+                'tgt': ends_with_newline(args.target),
+            },
+        }, f)
+    os.replace(tmp_path, meta_path)
+    print(f'{n_lines} lines, {len(extra)} subwords out of the vocabulary', file=sys.stderr)
+
+
+class TokenCorpus:
+    """ memory-mapped binary corpus made by encode """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META), encoding='utf-8') as f:
+            self.meta = json.load(f)
+        load = lambda name: np.load(os.path.join(path, name), mmap_mode='r')
+        self.ids = {side: load(f'{side}.ids.npy') for side in ('src', 'tgt')}
+        self.offsets = {side: load(f'{side}.offsets.npy') for side in ('src', 'tgt')}
+        self.lang_column = load('langs.npy')
+        self.langs = self.meta['langs']
+        self._subwords = None
+        self._words = None
+
+    def __len__(self):
+        return self.meta['n_lines']
+
+    @property
+    def n_subwords(self):
+        return self.meta['vocab_size'] + len(self.meta['extra_subwords'])
+
+    @property
+    def subwords(self):
+        """ id -> subword (bytes) """
+        if self._subwords is None:
+            vocab = load_vocab(self.meta['vocab'])
+            subwords = [b''] * self.n_subwords
+            for subword, subword_id in vocab.items():
+                subwords[subword_id] = subword.encode('utf-8', errors='surrogateescape')
+            for i, subword in enumerate(self.meta['extra_subwords'], self.meta['vocab_size']):
+                subwords[i] = base64.b64decode(subword)
+            self._subwords = subwords
+        return self._subwords
+
+    @property
+    def words(self):
+        """ id -> tuple of the whitespace separated words of the subword (as str.split()) """
+        if self._words is None:
+            self._words = [
+                tuple(subword.decode('utf-8', errors='surrogateescape').split())
+                for subword in self.subwords
+            ]
+        return self._words
+
+    def lang_code(self, lang):
+        return self.langs.index(lang)
+
+    def lengths(self, side):
+        """ subwords of each sentence (the tag is not counted) """
+        return np.diff(self.offsets[side]).astype(np.int64)
+
+    def select(self, langs=None, lines=None, ignore=None):
+        """
+        0-based line numbers of sentences of the target languages,
+        of lines (0-based) and not in ignore (0-based)
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if langs is not None:
+            codes = [self.lang_code(lang) for lang in langs if lang in self.langs]
+            mask &= np.isin(self.lang_column, codes)
+        if lines is not None:
+            line_mask = np.zeros(len(self), dtype=bool)
+            line_mask[np.asarray(lines, dtype=np.int64)] = True
+            mask &= line_mask
+        if ignore is not None:
+            mask[np.asarray(ignore, dtype=np.int64)] = False
+        return np.flatnonzero(mask)
+
+    def token_langs(self, side):
+        """ lang code of each token """
+        return np.repeat(self.lang_column, self.lengths(side))
+
+    def subword_counts(self, side):
+        """ lang -> counts of each subword id """
+        ids = self.ids[side]
+        token_langs = self.token_langs(side)
+        order = np.argsort(token_langs, kind='stable')
+        bounds = np.searchsorted(token_langs[order], np.arange(len(self.langs) + 1))
+        return {
+            lang: np.bincount(ids[order[bounds[code]:bounds[code + 1]]], minlength=self.n_subwords)
+            for code, lang in enumerate(self.langs)
+        }
+
+    def statistics(self):
+        """
+        rows of train_set_statistics.csv, subwords are the words of
+        str.split() as in unique_subwords.py (empty tokens of repeated
+        spaces do not count)
+        """
+        words = self.words
+        word_counts = np.array([len(subword_words) for subword_words in words], dtype=np.int64)
+        sentences = np.bincount(self.lang_column, minlength=NO_LANG + 1)
+        rows = {lang: [lang, int(sentences[code])] for code, lang in enumerate(self.langs)}
+        for side in ('src', 'tgt'):
+            total = np.bincount(
+                self.token_langs(side), weights=word_counts[self.ids[side]], minlength=NO_LANG + 1,
+            )
+            for code, lang in enumerate(self.langs):
+                rows[lang].append(total[code] / max(sentences[code], 1))
+        for side in ('src', 'tgt'):
+            for lang, counts in self.subword_counts(side).items():
+                unique = set()
+                for subword_id in np.flatnonzero(counts).tolist():
+                    unique.update(words[subword_id])
+                rows[lang].append(len(unique))
+        return [tuple(row) for row in rows.values()]
+
+    def _text(self, side, i):
+        start, end = self.offsets[side][i], self.offsets[side][i + 1]
+        subwords = self.subwords
+        return b' '.join([subwords[subword_id] for subword_id in self.ids[side][start:end].tolist()])
+
+    def source_line(self, i):
+        """ bytes of the i-th source line without newline """
+        text = self._text('src', i)
+        code = self.lang_column[i]
+        if code == NO_LANG:
+            return text
+        tag = f'<2{self.langs[code]}>'.encode('utf-8')
+        if self.offsets['src'][i] == self.offsets['src'][i + 1]:
+            return tag
+        return tag + b' ' + text
+
+    def target_line(self, i):
+        return self._text('tgt', i)
+
+    def write_text(self, lines, source_path, target_path):
+        """ writes the given lines of both sides """
+        lines = np.asarray(lines, dtype=np.int64)
+        last = len(self) - 1
+        with open(source_path, 'wb') as source, open(target_path, 'wb') as target:
+            for i in lines.tolist():
+                source.write(self.source_line(i))
+                target.write(self.target_line(i))
+                if i != last or self.meta['final_newline']['src']:
+                    source.write(b'\n')
+                if i != last or self.meta['final_newline']['tgt']:
+                    target.write(b'\n')
+
+
+def read_line_numbers(path):
+    """ 1-based line numbers of a file -> 0-based array """
+    with open(path) as f:
+        return np.array([int(line) - 1 for line in f if line.strip()], dtype=np.int64)
+
+
+def print_statistics(args):
+    corpus = TokenCorpus(args.corpus)
+    print('target_lang,sentences_count,avg_subwords_src,avg_subwords_tgt,total_subwords_src,total_subwords_tgt')
+    for row in corpus.statistics():
+        print(','.join(str(value) for value in row))
+
+
+def decode_corpus(args):
+    corpus = TokenCorpus(args.corpus)
+    ignore = read_line_numbers(args.ignore_lines) if args.ignore_lines else None
+    lines = corpus.select(langs=args.langs, ignore=ignore)
+    corpus.write_text(lines, args.source, args.target)
+    print(f'{len(lines)} lines', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
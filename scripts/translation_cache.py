@@ -0,0 +1,103 @@
+# persistent cache of translations of one checkpoint (sqlite file per checkpoint)
+#
+# python usage:
+#   key = checkpoint_key('model_en2bg/model.npz.best-translation.npz.decoder.yml')
+#   with TranslationCache('cache/translations', key) as cache:
+#       known = cache.get_many(['<2bg> a sentence', ...])
+#       cache.put_many([('<2bg> other sentence', 'translation'), ...])
+#
+# The key is sha256 of the decoder config and of the model files it lists,
+# so a retrained or changed checkpoint never gets old translations. Sources
+# are tagged (<2xx> sentence), translations are stored as marian returns them,
+# before postprocessing.
+
+import hashlib
+import os
+import sqlite3
+
+import yaml
+
+HASH_SUFFIX = '.sha256'
+# sqlite limits the number of query parameters
+QUERY_SIZE = 500
+
+
+def file_sha256(path):
+    """ sha256 of a (large) file, remembered in a sidecar file with its size and mtime """
+    stat = os.stat(path)
+    stamp = f'{stat.st_size} {stat.st_mtime_ns}'
+    try:
+        with open(path + HASH_SUFFIX, encoding='utf-8') as f:
+            saved_stamp, digest = f.read().rsplit(' ', 1)
+        if saved_stamp == stamp:
+            return digest.strip()
+    except (FileNotFoundError, ValueError):
+        pass
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(16 * 1024 * 1024), b''):
+            digest.update(block)
+    digest = digest.hexdigest()
+    try:
+        with open(path + HASH_SUFFIX + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(f'{stamp} {digest}\n')
+        os.replace(path + HASH_SUFFIX + '.tmp', path + HASH_SUFFIX)
+    except OSError:
+        # read-only model folder, the hash is computed again next time
+        pass
+    return digest
+
+
+def checkpoint_key(decoder_path):
+    with open(decoder_path, 'rb') as f:
+        decoder_config = f.read()
+    digest = hashlib.sha256(decoder_config)
+    for model in yaml.safe_load(decoder_config)['models']:
+        digest.update(file_sha256(model).encode('ascii'))
+    return digest.hexdigest()
+
+
+class TranslationCache:
+    def __init__(self, cache_dir, key):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, key + '.sqlite')
+        self.connection = sqlite3.connect(self.path, timeout=60)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS translations ('
+            'source TEXT PRIMARY KEY, translation TEXT NOT NULL)'
+        )
+        self.connection.commit()
+
+    def get_many(self, sources):
+        """ source -> translation for the cached ones """
+        sources = list(sources)
+        result = {}
+        for i in range(0, len(sources), QUERY_SIZE):
+            chunk = sources[i:i + QUERY_SIZE]
+            rows = self.connection.execute(
+                'SELECT source, translation FROM translations WHERE source IN '
+                f'({",".join("?" * len(chunk))})',
+                chunk,
+            )
+            result.update(rows)
+        return result
+
+    def put_many(self, pairs):
+        """ pairs of (source, translation) """
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO translations (source, translation) VALUES (?, ?)',
+                pairs,
+            )
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM translations').fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -6,23 +6,45 @@ import copy
 import time
 import json
 import signal
+import threading
 import types
-from datetime import datetime
 from contextlib import contextmanager
 
 import wandb
 import yaml
 
+from marian_log import (
+    extract_time, extract_is_validation, is_training_log, parse_train_log, parse_val_log,
+    parse_translation_line, parse_translation_time, training_finished, translation_begins,
+    translation_ends,
+)
+
 
 def main():
     args = parse_args()
-    init_wandb(args)
-    log_parser = LogParser(args.experiment_dir, wait_for_new_lines=args.wait_for_logs)
-    for step, log_data in log_parser.main_loop():
-        wandb.log(log_data, step=step)
+    # continue parsing where the previous runner stopped only if the run is resumed
+    resume = get_run_id(args.experiment_dir) is not False and not args.replay
+    if args.sink_file is None:
+        init_wandb(args)
+        sink = WandbSink()
+    else:
+        sink = JsonLinesSink(args.sink_file)
+    log_parser = LogParser(
+        args.experiment_dir,
+        wait_for_new_lines=args.wait_for_logs,
+        resume=resume,
+    )
+    if args.bulk:
+        records = log_parser.bulk_records()
+    else:
+        records = log_parser.main_loop()
+    with StepCoalescer(sink, max_delay=args.flush_delay, max_records=args.flush_records) as emitter:
+        for step, log_data in records:
+            emitter.add(step, log_data)
 
     print('Parser stopped')
-    save_best_models(args.experiment_dir)
+    if args.sink_file is None:
+        save_best_models(args.experiment_dir)
 
 
 def parse_args():
@@ -62,27 +84,65 @@ def parse_args():
         default=False,
         help='Wait for new lines in logs (use during the training)'
     )
+    parser.add_argument(
+        '--replay',
+        action='store_const',
+        const=True,
+        default=False,
+        help='Parse the log from the start even if the previous runner saved its progress'
+    )
+    parser.add_argument(
+        '--bulk',
+        action='store_const',
+        const=True,
+        default=False,
+        help='Parse the whole log at once with bulk_log_parser (backfills, not with --wait-for-logs)'
+    )
+    parser.add_argument(
+        '--flush-delay',
+        type=float,
+        default=30.,
+        help='Max. seconds to hold records of one step before sending them',
+    )
+    parser.add_argument(
+        '--flush-records',
+        type=int,
+        default=100,
+        help='Max. number of records merged into one before sending them',
+    )
+    parser.add_argument(
+        '--sink-file',
+        type=str,
+        default=None,
+        help='Write merged records as json lines to this file instead of wandb',
+    )
 
     args = parser.parse_args()
+    if args.bulk and args.wait_for_logs:
+        parser.error('--bulk cannot wait for logs')
     return args
 
 
-def init_wandb(args):
+def init_wandb(args, reinit=None):
+    """ returns wandb run; reinit='create_new' allows several runs in one process """
     config = get_config(args.experiment_dir)
     run_id = get_run_id(args.experiment_dir)
     run_name = os.path.basename(os.path.normpath(args.experiment_dir))
     language_tags = get_language_tags(args)
     tags = args.tags + language_tags
     config = add_language_info(config, language_tags)
-    wandb.init(
+    init_kwargs = {} if reinit is None else {'reinit': reinit}
+    run = wandb.init(
         project=args.project_name,
         name=run_name,
         resume=run_id,
         dir=args.experiment_dir,
         tags=tags,
         config=config,
+        **init_kwargs,
     )
-    save_run_id(args.experiment_dir)
+    save_run_id(args.experiment_dir, run)
+    return run
 
 
 def get_run_id(experiment_dir):
@@ -94,9 +154,10 @@ def get_run_id(experiment_dir):
         return False
 
 
-def save_run_id(experiment_dir):
+def save_run_id(experiment_dir, run=None):
+    run = run or wandb.run
     with open(os.path.join(experiment_dir, '.run_id'), 'w', encoding='utf-8') as f:
-        f.write(str(wandb.run.id))
+        f.write(str(run.id))
 
 
 def get_language_tags(args):
@@ -222,43 +283,114 @@ def read_when_created(path, fn, mode='r', wait=2, stop=None):
 def read_when_created_gen(path, fn, mode='r', wait=5, stop=None):
     if stop is None:
         stop = lambda: False
+    encoding = None if 'b' in mode else 'utf-8'
     while not stop():
         try:
-            with open(path, mode, encoding='utf-8') as f:
+            with open(path, mode, encoding=encoding) as f:
                 yield from fn(f)
             break
         except FileNotFoundError:
             time.sleep(wait)
             continue
 
-def follow(thefile, stop=None):
+# yielded by follow() when the file was truncated or replaced
+LOG_RESTARTED = object()
+
+def log_restarted(thefile, path):
+    """ 'truncated', 'replaced' or None """
+    stat = os.fstat(thefile.fileno())
+    if stat.st_size < thefile.tell():
+        return 'truncated'
+    try:
+        if path is not None and os.stat(path).st_ino != stat.st_ino:
+            return 'replaced'
+    except FileNotFoundError:
+        pass
+    return None
+
+def follow(thefile, stop=None, path=None):
+    """
+    Yields complete lines (bytes) of a binary file, waits for new ones.
+    If the file is truncated or replaced (path is needed to notice that),
+    yields LOG_RESTARTED and continues from the beginning of the new file.
+    """
     if stop is None:
         stop = lambda: False
-    while True:
-        line = thefile.readline()
-        if not line:
-            time.sleep(0.1)
+    partial = b''
+    reopened = None
+    try:
+        while True:
+            line = thefile.readline()
+            if line.endswith(b'\n'):
+                yield partial + line
+                partial = b''
+                continue
+            # incomplete line - the rest has not been written yet
+            partial += line
+            restarted = log_restarted(thefile, path)
+            if restarted:
+                if restarted == 'replaced':
+                    if reopened is not None:
+                        reopened.close()
+                    reopened = thefile = open(path, 'rb')
+                thefile.seek(0)
+                partial = b''
+                yield LOG_RESTARTED
+                continue
             # read till the end but do not wait if stop() fired
-            if stop(): break
-            else: continue
-        yield line
+            if stop():
+                # leave the incomplete line for the next reader
+                thefile.seek(-len(partial), os.SEEK_CUR)
+                break
+            time.sleep(0.1)
+    finally:
+        if reopened is not None:
+            reopened.close()
 
 
 
-def save_best_models(experiment_dir):
+def save_best_models(experiment_dir, run=None):
+    run = run or wandb
     print('Saving models... ', end='')
-    wandb.save(os.path.join(experiment_dir, 'model.npz.best-*'))
-    wandb.save(os.path.join(experiment_dir, '*.log'))
-    wandb.save(os.path.join(experiment_dir, 'model.npz.yml'))
+    run.save(os.path.join(experiment_dir, 'model.npz.best-*'))
+    run.save(os.path.join(experiment_dir, '*.log'))
+    run.save(os.path.join(experiment_dir, 'model.npz.yml'))
     print('Done.')
 
 
 class LogParser:
-    def __init__(self, experiment_dir, wait_for_new_lines=False):
+    """
+    Parses marian train.log into (step, log_dict) records.
+
+    Progress (byte offset, last step, translation block being read) is
+    saved to STATE_FILE next to .run_id whenever a record with a new step
+    is emitted, so a restarted runner continues where the previous one
+    stopped (repeating records of the last step only) instead of replaying
+    the whole log. A truncated or replaced log is parsed from the start.
+    """
+    STATE_FILE = '.log_parser_state'
+    # bytes of the log start saved to recognize the same log file
+    HEAD_SIZE = 1024
+
+    def __init__(self, experiment_dir, wait_for_new_lines=False, resume=False):
         self.experiment_dir = experiment_dir
         self.train_log_path = os.path.join(self.experiment_dir, 'train.log')
+        self.state_path = os.path.join(self.experiment_dir, self.STATE_FILE)
         self.wait_for_new_lines = wait_for_new_lines
+        self.resume = resume
         self.should_be_stopped = False
+        self.finished = False
+        # file kept open between poll() calls
+        self.log_file = None
+        self.reset()
+
+    def reset(self):
+        self.offset = 0
+        self.last_step = 0
+        # list of [n, translation] while inside of a translation block
+        self.translation = None
+        self.head = None
+        self.emitted_step = None
 
     def stop(self, signum, frame):
         print('Stopping log parser...')
@@ -271,144 +403,312 @@ class LogParser:
             yield from read_when_created_gen(
                 self.train_log_path,
                 fn=lambda f: self._process_train_log_file(f),
+                mode='rb',
                 stop=lambda: self.should_be_stopped,
             )
 
+    def load_state(self, train_log_file):
+        try:
+            with open(self.state_path, encoding='utf-8') as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        train_log_file.seek(0)
+        head = train_log_file.read(len(state['head'].encode('latin-1')))
+        size = os.fstat(train_log_file.fileno()).st_size
+        if size < state['offset'] or head.decode('latin-1') != state['head']:
+            print('Log was truncated or replaced, parsing from the start')
+            return
+        self.offset = state['offset']
+        self.last_step = state['last_step']
+        self.translation = state['translation']
+        self.head = state['head']
+        print(f'Resuming log parsing from byte {self.offset}, step {self.last_step}')
+
+    def save_state(self, train_log_file, offset=None, last_step=None, translation=None):
+        """ saves given position (current one by default) """
+        if offset is None:
+            offset, last_step, translation = self.offset, self.last_step, self.translation
+        if self.head is None or len(self.head) < self.HEAD_SIZE:
+            position = train_log_file.tell()
+            train_log_file.seek(0)
+            self.head = train_log_file.read(min(offset, self.HEAD_SIZE)).decode('latin-1')
+            train_log_file.seek(position)
+        state = {
+            'offset': offset,
+            'last_step': last_step,
+            'translation': translation,
+            'head': self.head,
+        }
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
     def _process_train_log_file(self, train_log_file):
-        # TODO: refactor this monster
-        def extract_time(log_line):
-            '''[dtime] remaining log line'''
-            dtime = datetime.strptime(log_line[1:20], "%Y-%m-%d %H:%M:%S")
-            return dtime, log_line[22:]
-
-        def extract_is_validation(log_line):
-            '''
-            [valid] remaining_line -> True, remaining_line
-            log_line -> False, log_line
-            '''
-            validation = '[valid]'
-            if log_line[:len(validation)] == validation:
-                return True, log_line[len(validation):]
-            else: return False, log_line
-
-        def is_training_log(log_line):
-            return log_line.find('Ep. ') >= 0
-
-        def parse_train_log(line):
-            """ Ep. 2 : Up. 1000 : Sen. 311,824 : Cost 4.95877838 : Time 163.05s : 33655.40 words/s : L.r. 1.0000e-04 """
-            processing = {
-                "Ep.": lambda s: ('train/epoch', int(s)),
-                "Up.": lambda s: ('step', int(s)),
-                "Sen.": lambda s: ('train/sentences', int(s.replace(',',''))),
-                "Cost": lambda s: ('train/loss', float(s)),
-                "Time": lambda s: ('train/time', float(s[:-1])),
-                "words/s": lambda s: ('train/speed', float(s)),
-                "L.r.": lambda s: ('train/learning_rate', float(s)),
-            }
-            def process(log_line_chunk):
-                first, second = log_line_chunk.strip().split(' ')
-                try:
-                    return processing[first](second)
-                except KeyError:
-                    try:
-                        return processing[second](first)
-                    except KeyError:
-                        return None
-            log_data = dict(
-                process(info_chunk)
-                for info_chunk
-                in line.split(':')
-                if info_chunk is not None
-            )
-            step = log_data['step']
-            del log_data['step']
-            return step, log_data
-
-        def parse_val_log(line):
-            """ Ep. 26 : Up. 35000 : ce-mean-words : 1.63575 : new best """
-            line = line.split(':')
-            step = int(line[1].strip().split(' ')[1])
-            log_data = {}
-            metric_name = line[2].strip()
-            metric_value = float(line[3].strip())
-            if 'lang/' not in metric_name:
-                metric_name = 'valid/' + metric_name
-            log_data[metric_name] = metric_value
-
-            metric_stalled = line[4].strip()
-            if 'no effect' not in metric_stalled:
-                if 'stalled' in metric_stalled:
-                    metric_stalled = int(metric_stalled.split()[1])
-                else:
-                    metric_stalled = 0
-                log_data[metric_name+'_stalled'] = metric_stalled
-
-            return step, log_data
-
-        def parse_translation(lines):
-            data = []
-            log_data = {}
-            for line in lines:
-                if translation_ends(line):
-                    log_data['valid/translation_time'] = float(line.strip().split(' ')[-1][:-1])
+        if self.resume:
+            self.load_state(train_log_file)
+        train_log_file.seek(self.offset)
+
+        # a replaced log is reopened here rather than inside follow(),
+        # save_state() has to read the head of the current file
+        log_file = train_log_file
+        replaced = lambda: log_restarted(log_file, self.train_log_path) == 'replaced'
+        try:
+            while True:
+                lines = follow(
+                    log_file,
+                    stop=lambda: self.should_be_stopped or not self.wait_for_new_lines or replaced(),
+                )
+                yield from self._process_lines(lines, log_file)
+                if self.finished or not replaced():
                     break
-                if not 'Best translation' in line:
-                    return None
-                # cut time
-                line = line[line.find(']')+1:]
-                colon = line.find(':')
-                n = line[:colon]
-                translation = line[colon+1:]
-                n = int(n.strip().split(' ')[-1])
-                translation = translation.strip()
-                data.append([n, translation])
-            log_data['valid/translation_example'] = wandb.Table(
-                    data=data, columns=["N","Translation"]
+                print('Log was truncated or replaced, parsing from the start')
+                if log_file is not train_log_file:
+                    log_file.close()
+                log_file = open(self.train_log_path, 'rb')
+                self.reset()
+            self.save_state(log_file)
+        finally:
+            if log_file is not train_log_file:
+                log_file.close()
+
+    def poll(self):
+        """
+        Yields records for lines appended since the last call, does not wait.
+        Used to watch many logs from one process; call checkpoint() after
+        the pending records are sent.
+        """
+        if self.log_file is None:
+            try:
+                self.log_file = open(self.train_log_path, 'rb')
+            except FileNotFoundError:
+                return
+            if self.resume:
+                self.load_state(self.log_file)
+            self.log_file.seek(self.offset)
+
+        restarted = log_restarted(self.log_file, self.train_log_path)
+        if restarted:
+            print(f'{self.train_log_path} was truncated or replaced, parsing from the start')
+            if restarted == 'replaced':
+                self.log_file.close()
+                self.log_file = open(self.train_log_path, 'rb')
+            self.log_file.seek(0)
+            self.reset()
+
+        lines = follow(self.log_file, stop=lambda: True)
+        yield from self._process_lines(lines, self.log_file)
+
+    def bulk_records(self):
+        """
+        Yields records of the existing log parsed by bulk_log_parser, does not wait.
+        The state is saved once all records have been consumed.
+        """
+        import bulk_log_parser
+        with open(self.train_log_path, 'rb') as train_log_file:
+            if self.resume:
+                self.load_state(train_log_file)
+            result = bulk_log_parser.parse_log(
+                train_log_file, self.offset, self.last_step, self.translation,
             )
-
-            return log_data
-
-        def training_finished(line):
-            return "Training finished" in line
-
-        def translation_begins(line):
-            return "Translating" in line
-
-        def translation_ends(line):
-            return "Total translation time" in line
-
-        last_step=0
-        lines = follow(
-            train_log_file,
-            stop=lambda: self.should_be_stopped or not self.wait_for_new_lines
-        )
+            for step, log_data in result.records:
+                if bulk_log_parser.TRANSLATION_EXAMPLE in log_data:
+                    log_data[bulk_log_parser.TRANSLATION_EXAMPLE] = wandb.Table(
+                        data=log_data[bulk_log_parser.TRANSLATION_EXAMPLE], columns=["N","Translation"]
+                    )
+                yield step, log_data
+            self.offset = result.offset
+            self.last_step = result.last_step
+            self.translation = result.translation
+            self.finished = result.finished
+            self.save_state(train_log_file)
+
+    def checkpoint(self):
+        if self.log_file is not None:
+            self.save_state(self.log_file)
+
+    def close(self):
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+
+    def _process_lines(self, lines, train_log_file):
         for line in lines:
-
-            try:
-                dtime, line = extract_time(line)
-            except:
+            if line is LOG_RESTARTED:
+                print('Log was truncated or replaced, parsing from the start')
+                self.reset()
                 continue
 
-            if training_finished(line):
+            before_line = self.offset, self.last_step, self.translation
+            records = self.process_line(line.decode('utf-8', errors='replace'))
+            if records is None:
+                self.finished = True
                 break
-
-            is_validation, line = extract_is_validation(line)
-            
-            if is_validation:
-                step, log_data = parse_val_log(line)
-            elif is_training_log(line):
-                step, log_data = parse_train_log(line)
-            elif translation_begins(line):
-                # pass generator here to consume all lines with translations
-                log_data = parse_translation(lines)
+            self.offset += len(line)
+
+            for step, log_data in records:
+                yield step, log_data
+                if step != self.emitted_step:
+                    # the consumer has got all records of the previous steps
+                    # (StepCoalescer flushes them on step change), so the parser
+                    # can resume from the line that started the new step
+                    self.save_state(train_log_file, *before_line)
+                    self.emitted_step = step
+
+    def process_line(self, line):
+        """
+        Returns list of (step, log_data) completed by the line,
+        None if the training has finished
+        """
+        if self.translation is not None:
+            if translation_ends(line):
+                log_data = {
+                    'valid/translation_time': parse_translation_time(line),
+                    'valid/translation_example': wandb.Table(
+                        data=self.translation, columns=["N","Translation"]
+                    ),
+                }
+                self.translation = None
                 # translation does not have 'step', that is why there is this 'last_step' thing
-                step = last_step
-            else:
-                continue
+                return [(self.last_step, log_data)]
+            if 'Best translation' in line:
+                self.translation.append(parse_translation_line(line))
+                return []
+            # interrupted translation block (e.g. the job was restarted)
+            self.translation = None
 
-            last_step = step
-
-            yield step, log_data
+        try:
+            dtime, line = extract_time(line)
+        except:
+            return []
+
+        if training_finished(line):
+            return None
+
+        is_validation, line = extract_is_validation(line)
+
+        if is_validation:
+            step, log_data = parse_val_log(line)
+        elif is_training_log(line):
+            step, log_data = parse_train_log(line)
+        elif translation_begins(line):
+            self.translation = []
+            return []
+        else:
+            return []
+
+        self.last_step = step
+        return [(step, log_data)]
+
+
+class WandbSink:
+    def __init__(self, run=None):
+        self.run = run or wandb
+
+    def log(self, step, log_data):
+        self.run.log(log_data, step=step)
+
+    def close(self):
+        pass
+
+
+class JsonLinesSink:
+    """ one json line {"step": ..., "data": {...}} per record """
+    def __init__(self, path):
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def log(self, step, log_data):
+        def to_json(value):
+            if isinstance(value, wandb.Table):
+                return {'columns': value.columns, 'data': value.data}
+            return value
+        data = {key: to_json(value) for key, value in log_data.items()}
+        self.file.write(json.dumps({'step': step, 'data': data}) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class MemorySink:
+    def __init__(self):
+        self.records = []
+
+    def log(self, step, log_data):
+        self.records.append((step, log_data))
+
+    def close(self):
+        pass
+
+
+class StepCoalescer:
+    """
+    Merges consecutive records with the same step into one sink.log() call.
+    Pending record is sent when the step changes, when it is older than
+    max_delay seconds or merges max_records records, and on close().
+    """
+    def __init__(self, sink, max_delay=30., max_records=100, timer=True):
+        self.sink = sink
+        self.max_delay = max_delay
+        self.max_records = max_records
+        self.step = None
+        self.pending = None
+        self.n_records = 0
+        self.since = None
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.timer = None
+        if timer:
+            # otherwise the owner calls flush_if_old() periodically
+            self.timer = threading.Thread(target=self._flush_when_old, daemon=True)
+            self.timer.start()
+
+    def add(self, step, log_data):
+        with self.lock:
+            if self.pending is not None and step != self.step:
+                self._flush()
+            if self.pending is None:
+                self.step = step
+                self.pending = {}
+                self.since = time.time()
+            self.pending.update(log_data)
+            self.n_records += 1
+            if self.n_records >= self.max_records or time.time() - self.since >= self.max_delay:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.pending is not None:
+            self.sink.log(self.step, self.pending)
+        self.pending = None
+        self.n_records = 0
+
+    def flush_if_old(self):
+        with self.lock:
+            if self.pending is not None and time.time() - self.since >= self.max_delay:
+                self._flush()
+
+    def _flush_when_old(self):
+        # waiting for the next line of a log can take long
+        while not self.closed.wait(1.):
+            self.flush_if_old()
+
+    def close(self):
+        self.closed.set()
+        if self.timer is not None:
+            self.timer.join()
+        self.flush()
+        self.sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 
 @contextmanager